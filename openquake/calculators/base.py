@@ -56,6 +56,9 @@ class CalculatorNext(object):
     :param job: :class:`openquake.db.models.OqJob` instance.
     """
 
+    #: True if the calculator implements :meth:`resume`.
+    resumable = False
+
     def __init__(self, job):
         self.job = job
 
@@ -65,6 +68,17 @@ class CalculatorNext(object):
         initialize result records, perform detailed parsing of input data, etc.
         """
 
+    def resume(self):
+        """
+        Override this method in subclasses which support the resumption of
+        interrupted calculations. It is called instead of :meth:`pre_execute`
+        when the `pre_executing` phase was completed by a previous run of the
+        calculation, and should restore any state needed by :meth:`execute`
+        which was not persisted.
+        """
+        raise NotImplementedError(
+            '%s calculations cannot be resumed' % self.__class__.__name__)
+
     def execute(self):
         """
         This is the only method that subclasses are required to implement. This
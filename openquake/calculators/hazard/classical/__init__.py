@@ -130,6 +130,14 @@ samples in this case is determined by the total number of possible tree paths.
 (To perform end-branch enumeration, the user must specify
 `number_of_logic_tree_samples = 0` in the job configuration.
 
+With random sampling, the logic trees can also be sampled in waves of
+`logic_tree_samples_per_wave` samples (10 by default), until the mean hazard
+curves converge: after each wave, the mean curves are computed at a
+representative subset of the sites, and the sampling stops when no PoE
+changed by more than `logic_tree_convergence_tolerance`. In this case,
+`number_of_logic_tree_samples` is the maximum number of samples. The achieved
+convergence is recorded in the job statistics.
+
 The total number of mean curves calculated is
 
 ``T = P * I``
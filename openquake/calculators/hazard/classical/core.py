@@ -20,15 +20,21 @@ Core functionality for the classical PSHA hazard calculator.
 import nhlib
 import nhlib.calc
 import nhlib.imt
+import nhlib.tom
 import numpy
 
+from django.db import connections
 from django.db import transaction
+from django.db.models import F
 
 from openquake import logs
 from openquake import writer
 from openquake.calculators.hazard import general as haz_general
 from openquake.db import models
 from openquake.input import logictree
+from openquake.utils import config
+from openquake.utils.general import block_splitter
+from openquake.utils.general import str2bool
 from openquake.utils import stats
 from openquake.utils import tasks as utils_tasks
 
@@ -36,38 +42,65 @@ from openquake.db.aggregate_result_writer import (MeanCurveWriter,
                                                   QuantileCurveWriter)
 from openquake.calculators.hazard.classical import post_processing
 
+
+#: Maximum number of realizations whose partial results are combined at once
+#: by :func:`reduce_hazard_curve_partials` (their hazard curves for an IMT
+#: are all held in memory).
+REDUCE_BLOCK_SIZE = 32
+
+
+def curve_matrix_storage():
+    """
+    Returns `True` if the final hazard curves are stored as matrices
+    (:class:`openquake.db.models.HazardCurveMatrix`), `False` if they are
+    stored as one :class:`openquake.db.models.HazardCurveData` record per
+    site. This is given by the `hazard_curve_storage` parameter in the
+    [hazard] section of openquake.cfg.
+    """
+    return config.get('hazard', 'hazard_curve_storage') == 'matrix'
+
 @utils_tasks.oqtask
 @stats.count_progress('h')
-def hazard_curves(job_id, src_ids, lt_rlz_id):
+def hazard_curves(job_id, src_ids, lt_rlz_ids):
     """
     A celery task wrapper function around :func:`compute_hazard_curves`.
     See :func:`compute_hazard_curves` for parameter definitions.
     """
-    logs.LOG.debug('> starting task: job_id=%s, lt_realization_id=%s'
-                   % (job_id, lt_rlz_id))
+    logs.LOG.debug('> starting task: job_id=%s, lt_realization_ids=%s'
+                   % (job_id, lt_rlz_ids))
 
-    result = compute_hazard_curves(job_id, src_ids, lt_rlz_id)
+    result = compute_hazard_curves(job_id, src_ids, lt_rlz_ids)
     # Last thing, signal back the control node to indicate the completion of
     # task. The control node needs this to manage the task distribution and
     # keep track of progress.
     logs.LOG.debug('< task complete, signalling completion')
-    haz_general.signal_task_complete(job_id, len(src_ids))
+    haz_general.signal_task_complete(job_id, len(src_ids) * len(lt_rlz_ids))
 
     return result
 
 
 # Silencing 'Too many local variables'
 # pylint: disable=R0914
-def compute_hazard_curves(job_id, src_ids, lt_rlz_id):
+def compute_hazard_curves(job_id, src_ids, lt_rlz_ids):
     """
     Celery task for hazard curve calculator.
 
     Samples logic trees, gathers site parameters, and calls the hazard curve
     calculator.
 
-    Once hazard curve data is computed, result progress updated (within a
-    transaction, to prevent race conditions) in the
-    `htemp.hazard_curve_progress` table.
+    All of the given realizations must share the same source model logic tree
+    path: ruptures are generated only once and the hazard is computed for
+    each distinct GSIM logic tree path of the realizations (see
+    :func:`hazard_curves_poissonian_multi`).
+
+    Once hazard curve data is computed, the partial results are appended to
+    the `htemp.hazard_curve_partial` table, once per GSIM logic tree path
+    and IMT for all of the realizations sharing the path, and the progress
+    of the realizations is updated (within a transaction). No locks are
+    taken on the partial results; they are combined by
+    :func:`reduce_hazard_curve_partials` as soon as the realizations are
+    complete (see :meth:`ClassicalHazardCalculator.\
+reduce_completed_realizations`).
 
     Once all of this work is complete, a signal will be sent via AMQP to let
     the control node know that the work is complete. (If there is any work left
@@ -78,17 +111,27 @@ def compute_hazard_curves(job_id, src_ids, lt_rlz_id):
         ID of the currently running job.
     :param src_ids:
         List of ids of parsed source models to take into account.
-    :param lt_rlz_id:
-        Id of logic tree realization model to calculate for.
+    :param lt_rlz_ids:
+        List of ids of the logic tree realization models to calculate for.
     """
     hc = models.HazardCalculation.objects.get(oqjob=job_id)
 
-    lt_rlz = models.LtRealization.objects.get(id=lt_rlz_id)
+    lt_rlzs = models.LtRealization.objects.filter(
+        id__in=lt_rlz_ids).order_by('id')
     ltp = logictree.LogicTreeProcessor(hc.id)
 
     apply_uncertainties = ltp.parse_source_model_logictree_path(
-            lt_rlz.sm_lt_path)
-    gsims = ltp.parse_gmpe_logictree_path(lt_rlz.gsim_lt_path)
+            lt_rlzs[0].sm_lt_path)
+
+    # Group the realizations by GSIM logic tree path: realizations with the
+    # same path have the same results.
+    rlzs_by_gsim_path = {}
+    for lt_rlz in lt_rlzs:
+        rlzs_by_gsim_path.setdefault(
+            tuple(lt_rlz.gsim_lt_path), []).append(lt_rlz)
+    gsim_paths = sorted(rlzs_by_gsim_path)
+    gsims_list = [ltp.parse_gmpe_logictree_path(list(path))
+                  for path in gsim_paths]
 
     sources = haz_general.gen_sources(
         src_ids, apply_uncertainties, hc.rupture_mesh_spacing,
@@ -97,20 +140,15 @@ def compute_hazard_curves(job_id, src_ids, lt_rlz_id):
     imts = haz_general.im_dict_to_nhlib(hc.intensity_measure_types_and_levels)
 
     # Now initialize the site collection for use in the calculation.
-    # If there is no site model defined, we will use the same reference
-    # parameters (defined in the HazardCalculation) for every site.
-
-    # TODO: We could just create the SiteCollection once, pickle it, and store
-    # it in the DB (in SiteData). Creating the SiteCollection isn't an
-    # expensive operation (at least for small calculations), but this is
-    # wasted work.
+    # The site parameters are pre-computed in `pre_execute` and the collection
+    # is cached by each worker process, so this is only expensive the first
+    # time a process works on this calculation.
     logs.LOG.debug('> creating site collection')
     site_coll = haz_general.get_site_collection(hc)
     logs.LOG.debug('< done creating site collection')
 
     # Prepare args for the calculator.
-    calc_kwargs = {'gsims': gsims,
-                   'truncation_level': hc.truncation_level,
+    calc_kwargs = {'truncation_level': hc.truncation_level,
                    'time_span': hc.investigation_time,
                    'sources': sources,
                    'imts': imts,
@@ -123,73 +161,150 @@ def compute_hazard_curves(job_id, src_ids, lt_rlz_id):
         calc_kwargs['rupture_site_filter'] = (
                 nhlib.calc.filters.rupture_site_distance_filter(dist))
 
-    # mapping "imt" to 2d array of hazard curves: first dimension -- sites,
-    # second -- IMLs
+    # for each GSIM logic tree path, mapping "imt" to 2d array of hazard
+    # curves: first dimension -- sites, second -- IMLs
     logs.LOG.debug('> computing hazard matrices')
-    matrices = nhlib.calc.hazard_curve.hazard_curves_poissonian(**calc_kwargs)
+    if len(gsims_list) == 1:
+        [gsims] = gsims_list
+        matrices_list = [nhlib.calc.hazard_curve.hazard_curves_poissonian(
+            gsims=gsims, **calc_kwargs)]
+    else:
+        matrices_list = hazard_curves_poissonian_multi(
+            gsims_list=gsims_list, **calc_kwargs)
     logs.LOG.debug('< done computing hazard matrices')
 
     logs.LOG.debug('> starting transaction')
-    with transaction.commit_on_success():
+    with transaction.commit_on_success(using='reslt_writer'):
         logs.LOG.debug('looping over IMTs')
 
-        for imt in hc.intensity_measure_types_and_levels.keys():
-            logs.LOG.debug('> updating hazard for IMT=%s' % imt)
-            nhlib_imt = haz_general.imt_to_nhlib(imt)
-            query = """
-            SELECT * FROM htemp.hazard_curve_progress
-            WHERE lt_realization_id = %s
-            AND imt = %s
-            FOR UPDATE"""
-            [hc_progress] = models.HazardCurveProgress.objects.raw(
-                query, [lt_rlz.id, imt])
-
-            hc_progress.result_matrix = update_result_matrix(
-                hc_progress.result_matrix, matrices[nhlib_imt])
-            hc_progress.save()
-
-            logs.LOG.debug('< done updating hazard for IMT=%s' % imt)
+        # The partial results are appended to the staging table; no need to
+        # lock anything, since no other task is going to touch these rows.
+        # See :func:`reduce_hazard_curve_partials`.
+        for gsim_path, matrices in zip(gsim_paths, matrices_list):
+            path_rlz_ids = [
+                lt_rlz.id for lt_rlz in rlzs_by_gsim_path[gsim_path]]
+            for imt in hc.intensity_measure_types_and_levels.keys():
+                logs.LOG.debug('> storing partial hazard for IMT=%s' % imt)
+                nhlib_imt = haz_general.imt_to_nhlib(imt)
+                models.HazardCurvePartial.objects.create(
+                    hazard_calculation=hc, lt_realization_ids=path_rlz_ids,
+                    imt=imt, result_matrix=matrices[nhlib_imt])
+                logs.LOG.debug(
+                    '< done storing partial hazard for IMT=%s' % imt)
 
         # Before the transaction completes:
+        mark_sources_complete(src_ids, lt_rlz_ids)
 
-        # Check here if any of records in source progress model
-        # with parsed_source_id from src_ids are marked as complete,
-        # and rollback and abort if there is at least one
-        src_prog = models.SourceProgress.objects.filter(
-            lt_realization=lt_rlz, parsed_source__in=src_ids)
-
-        if any(x.is_complete for x in src_prog):
-            msg = (
-                'One or more `source_progress` records were marked as '
-                'complete. This was unexpected and probably means that the'
-                ' calculation workload was not distributed properly.'
-            )
-            logs.LOG.critical(msg)
-            transaction.rollback()
-            raise RuntimeError(msg)
-
-        # Mark source_progress records as complete
-        src_prog.update(is_complete=True)
-
-        # Update realiation progress,
-        # mark realization as complete if it is done
-        # First, refresh the logic tree realization record:
-        ltr_query = """
-        SELECT * FROM hzrdr.lt_realization
-        WHERE id = %s
-        FOR UPDATE
-        """
-
-        [lt_rlz] = models.LtRealization.objects.raw(
-            ltr_query, [lt_rlz.id])
+    logs.LOG.debug('< transaction complete')
 
-        lt_rlz.completed_sources += len(src_ids)
-        if lt_rlz.completed_sources == lt_rlz.total_sources:
-            lt_rlz.is_complete = True
 
-        lt_rlz.save()
+def mark_sources_complete(src_ids, lt_rlz_ids):
+    """
+    Mark the given sources as complete for the given realizations, and update
+    the progress of the realizations. To be called by the tasks, in the same
+    transaction which stores their results.
 
-    logs.LOG.debug('< transaction complete')
+    :param src_ids:
+        List of ids of parsed source models.
+    :param lt_rlz_ids:
+        List of ids of logic tree realization models.
+    :raises:
+        :exc:`RuntimeError` (after rolling back the transaction) if any of
+        the sources was already complete.
+    """
+    # Check here if any of records in source progress model
+    # with parsed_source_id from src_ids are marked as complete,
+    # and rollback and abort if there is at least one
+    src_prog = models.SourceProgress.objects.filter(
+        lt_realization__in=lt_rlz_ids, parsed_source__in=src_ids)
+
+    if any(x.is_complete for x in src_prog):
+        msg = (
+            'One or more `source_progress` records were marked as '
+            'complete. This was unexpected and probably means that the'
+            ' calculation workload was not distributed properly.'
+        )
+        logs.LOG.critical(msg)
+        transaction.rollback(using='reslt_writer')
+        raise RuntimeError(msg)
+
+    # Mark source_progress records as complete
+    src_prog.update(is_complete=True)
+
+    # Update realization progress, marking the realizations as complete if
+    # they are done. This is a single atomic statement, so the row locks on
+    # the realizations are only held for the duration of the update.
+    cursor = connections['reslt_writer'].cursor()
+    cursor.execute("""
+        UPDATE "%s"
+        SET completed_sources = completed_sources + %%s,
+            is_complete = (completed_sources + %%s = total_sources)
+        WHERE id IN %%s""" % models.LtRealization._meta.db_table,
+        [len(src_ids), len(src_ids), tuple(lt_rlz_ids)])
+
+
+def hazard_curves_poissonian_multi(
+        sources, sites, imts, time_span, gsims_list, truncation_level,
+        source_site_filter=nhlib.calc.filters.source_site_noop_filter,
+        rupture_site_filter=nhlib.calc.filters.rupture_site_noop_filter):
+    """
+    Compute the hazard curves for a set of sources, for several GSIM logic
+    tree paths at once.
+
+    This is equivalent to calling
+    :func:`nhlib.calc.hazard_curve.hazard_curves_poissonian` for each item of
+    `gsims_list`, but ruptures are generated and filtered only once. For each
+    rupture, the probabilities of exceedance are computed once for each
+    distinct GSIM which applies to the tectonic region of the rupture, and
+    reused for all of the logic tree paths which share that GSIM.
+
+    :param gsims_list:
+        List of dictionaries mapping tectonic region types to
+        :class:`nhlib.gsim.base.GMPE` objects (one per GSIM logic tree path).
+
+    For information about the other parameters, see
+    :func:`nhlib.calc.hazard_curve.hazard_curves_poissonian`.
+
+    :returns:
+        A list (one item per GSIM logic tree path, in the same order as
+        `gsims_list`) of dictionaries mapping IMTs to 2d arrays of hazard
+        curves (first dimension -- sites, second -- IMLs).
+    """
+    curves_list = [
+        dict((imt, numpy.ones([len(sites), len(imts[imt])])) for imt in imts)
+        for _ in gsims_list]
+    tom = nhlib.tom.PoissonTOM(time_span)
+    total_sites = len(sites)
+
+    sources_sites = ((source, sites) for source in sources)
+    for source, s_sites in source_site_filter(sources_sites):
+        ruptures_sites = ((rupture, s_sites)
+                          for rupture in source.iter_ruptures(tom))
+        for rupture, r_sites in rupture_site_filter(ruptures_sites):
+            prob = rupture.get_probability()
+            trt = rupture.tectonic_region_type
+
+            # probabilities of no exceedance, per GSIM class
+            no_exceedance = {}
+            for gsims, curves in zip(gsims_list, curves_list):
+                gsim = gsims[trt]
+                key = gsim.__class__
+                if not key in no_exceedance:
+                    sctx, rctx, dctx = gsim.make_contexts(r_sites, rupture)
+                    no_exceedance[key] = dict(
+                        (imt, r_sites.expand(
+                            (1 - prob) ** gsim.get_poes(
+                                sctx, rctx, dctx, imt, imts[imt],
+                                truncation_level),
+                            total_sites, placeholder=1))
+                        for imt in imts)
+                for imt in imts:
+                    curves[imt] *= no_exceedance[key][imt]
+
+    for curves in curves_list:
+        for imt in imts:
+            curves[imt] = 1 - curves[imt]
+    return curves_list
 
 
 
@@ -206,33 +321,58 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
     #: generated by :func:`task_arg_gen`.
     core_calc_task = hazard_curves
 
+    #: The object which computes the mean and quantile curves while the
+    #: calculation is running, if requested (see :meth:`execute`).
+    online_stats = None
+
+    def __init__(self, *args, **kwargs):
+        super(ClassicalHazardCalculator, self).__init__(*args, **kwargs)
+
+        # ids of the realizations whose partial results have been combined;
+        # see `reduce_completed_realizations`
+        self.reduced = set()
+
     def task_arg_gen(self, block_size):
         """
         Loop through realizations and sources to generate a sequence of
         task arg tuples. Each tuple of args applies to a single task.
 
-        Yielded results are triples of (job_id, realization_id,
-        source_id_list).
+        Realizations which share the same source model logic tree path and
+        have the same sources left to compute are grouped together, so that
+        the ruptures of those sources are generated only once for all of
+        them.
+
+        Yielded results are triples of (job_id, source_id_list,
+        realization_id_list).
 
         :param int block_size:
-            The (max) number of work items for each each task. In this case,
-            sources.
+            The average number of work items for each each task. In this case,
+            sources. Sources are packed into tasks according to their weight;
+            see :meth:`~openquake.calculators.hazard.general.\
+BaseHazardCalculatorNext.source_blocks`.
         """
         realizations = models.LtRealization.objects.filter(
-                hazard_calculation=self.hc, is_complete=False)
+                hazard_calculation=self.hc, is_complete=False).order_by('id')
 
+        rlz_groups = {}
         for lt_rlz in realizations:
-            source_progress = models.SourceProgress.objects.filter(
-                    is_complete=False, lt_realization=lt_rlz).order_by('id')
-            source_ids = source_progress.values_list('parsed_source_id',
-                                                     flat=True)
-            self.progress['total'] += len(source_ids)
-
-            for offset in xrange(0, len(source_ids), block_size):
+            src_ids = models.SourceProgress.objects.filter(
+                is_complete=False, lt_realization=lt_rlz).values_list(
+                    'parsed_source_id', flat=True)
+            key = (tuple(lt_rlz.sm_lt_path), frozenset(src_ids))
+            rlz_groups.setdefault(key, []).append(lt_rlz)
+
+        for lt_rlzs in sorted(rlz_groups.values(), key=lambda x: x[0].id):
+            lt_rlz_ids = [lt_rlz.id for lt_rlz in lt_rlzs]
+            blocks = self.source_blocks(lt_rlzs[0], block_size)
+            self.progress['total'] += (
+                sum(len(block) for block in blocks) * len(lt_rlz_ids))
+
+            for source_ids in blocks:
                 task_args = (
                     self.job.id,
-                    source_ids[offset:offset + block_size],
-                    lt_rlz.id
+                    source_ids,
+                    lt_rlz_ids
                 )
                 yield task_args
 
@@ -260,10 +400,159 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
         # work is complete.
         self.initialize_realizations(
             rlz_callbacks=[self.initialize_hazard_curve_progress])
+        # Estimate the cost of each source, so that the work can be evenly
+        # distributed among the tasks.
+        self.initialize_source_weights()
         self.initialize_pr_data()
 
         self.record_init_stats()
 
+    def resume(self):
+        """
+        Prepare the resumption of an interrupted calculation (see
+        :meth:`~openquake.calculators.hazard.general.\
+BaseHazardCalculatorNext.resume`).
+
+        The statistical curves computed while the calculation is running are
+        held in memory, so they must be computed again from scratch: the
+        blocks of curves folded in by the previous run are deleted.
+        """
+        super(ClassicalHazardCalculator, self).resume()
+        models.HazardCurveBlock.objects.filter(
+            lt_realization__hazard_calculation=self.hc.id).delete()
+
+    def execute(self):
+        """
+        Run the core calculation (see
+        :meth:`~openquake.calculators.hazard.general.\
+BaseHazardCalculatorNext.execute`).
+
+        If `online_statistics` is enabled in the [hazard] section of
+        openquake.cfg, the mean and quantile curves are computed while the
+        calculation is running: each realization is folded in as soon as it
+        is complete, and the statistical curves are saved at the end.
+        """
+        if (str2bool(config.get('hazard', 'online_statistics') or 'false')
+            and (self.hc.should_compute_mean_curves()
+                 or self.hc.should_compute_quantile_curves())):
+            self.online_stats = post_processing.OnlineCurveStatistics(
+                self.job)
+
+        if self.hc.is_adaptive_sampling():
+            self.execute_in_waves()
+        else:
+            super(ClassicalHazardCalculator, self).execute()
+
+        if self.online_stats is not None:
+            self.fold_completed_realizations()
+            self.online_stats.finalize(
+                dict(mean_curves=MeanCurveWriter,
+                     quantile_curves=QuantileCurveWriter))
+
+    def execute_in_waves(self):
+        """
+        Sample the logic trees and compute the realizations in waves, until
+        the mean hazard curves converge.
+
+        After each wave, the change of the mean curves at a representative
+        subset of sites is measured (see
+        :class:`~openquake.calculators.hazard.classical.post_processing.\
+MeanCurveConvergence`). The sampling stops when the change is not greater
+        than the `logic_tree_convergence_tolerance` of the calculation, or
+        when `number_of_logic_tree_samples` realizations have been sampled.
+        The number of realizations and the achieved convergence are recorded
+        in the :class:`~openquake.db.models.JobStats` of the job.
+        """
+        convergence = post_processing.MeanCurveConvergence(self.hc)
+        tolerance = self.hc.logic_tree_convergence_tolerance
+        # sources pruned in the waves sampled here (the ones pruned in the
+        # first wave are already recorded by `record_init_stats`)
+        num_pruned_sources = self.num_pruned_sources
+
+        while True:
+            super(ClassicalHazardCalculator, self).execute()
+
+            self.reduce_completed_realizations()
+            completed = list(models.LtRealization.objects.filter(
+                hazard_calculation=self.hc).exclude(
+                    id__in=convergence.added).order_by('id'))
+            change = convergence.update(completed)
+
+            num_rlzs = len(convergence.added)
+            if change is not None:
+                logs.LOG.info('%s realizations: mean curves changed by %s'
+                              % (num_rlzs, change))
+                if change <= tolerance:
+                    break
+
+            remaining = self.hc.number_of_logic_tree_samples - num_rlzs
+            if remaining <= 0:
+                logs.LOG.warn('the mean curves did not converge within the '
+                              'tolerance with %s realizations' % num_rlzs)
+                break
+
+            self.sample_realizations(
+                min(self.lt_samples_per_wave(), remaining),
+                rlz_callbacks=[self.initialize_hazard_curve_progress])
+            # the sources of the new realizations have the default weight
+            self.initialize_source_weights()
+            self.initialize_pr_data()
+
+        models.JobStats.objects.filter(oq_job=self.job.id).update(
+            num_realizations=num_rlzs, lt_convergence=change,
+            num_pruned_sources=F('num_pruned_sources') + (
+                self.num_pruned_sources - num_pruned_sources))
+
+    def get_task_complete_callback(self, task_arg_gen):
+        """
+        Same as the base class method, but the partial results of the
+        realizations completed by the task are combined (after the next task
+        has been enqueued), so that they don't pile up in the staging table
+        until the end of the calculation. When the statistical curves are
+        computed while the calculation is running, the realizations are
+        folded in as well.
+        """
+        callback = super(
+            ClassicalHazardCalculator, self).get_task_complete_callback(
+                task_arg_gen)
+
+        def reduce_callback(body, message):
+            """
+            See the base class callback.
+            """
+            callback(body, message)
+            if self.online_stats is None:
+                self.reduce_completed_realizations()
+            else:
+                self.fold_completed_realizations()
+
+        return reduce_callback
+
+    def reduce_completed_realizations(self):
+        """
+        Combine the partial results of the realizations which have been
+        completed since the last call (see
+        :func:`reduce_hazard_curve_partials`).
+        """
+        completed = list(models.LtRealization.objects.filter(
+            hazard_calculation=self.hc, is_complete=True).exclude(
+                id__in=self.reduced).order_by('id'))
+        reduce_hazard_curve_partials(completed)
+        self.reduced.update(lt_rlz.id for lt_rlz in completed)
+
+    def fold_completed_realizations(self):
+        """
+        Combine the partial results of the realizations which have been
+        completed since the last call and fold them in the statistical
+        curves (see :attr:`online_stats`).
+        """
+        self.reduce_completed_realizations()
+        completed = models.LtRealization.objects.filter(
+            hazard_calculation=self.hc, is_complete=True).exclude(
+                id__in=self.online_stats.folded).order_by('id')
+        for lt_rlz in completed:
+            self.online_stats.fold(lt_rlz)
+
     def post_execute(self):
         """
         Create the final output records for hazard curves. This is done by
@@ -272,13 +561,32 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
         the actual curve PoE values). Foreign keys are made from
         `hzrdr.hazard_curve` to `hzrdr.lt_realization` (realization information
         is need to export the full hazard curve results).
+
+        If the hazard curves are stored as matrices (see
+        :func:`curve_matrix_storage`), the curve PoE values of each
+        `hzrdr.hazard_curve` are copied to a single
+        `hzrdr.hazard_curve_matrix` record instead, and the sites are stored
+        once in `hzrdr.site_mesh`.
         """
         im = self.hc.intensity_measure_types_and_levels
         points = self.hc.points_to_compute()
 
+        site_mesh = None
+        if curve_matrix_storage():
+            site_mesh = models.SiteMesh.objects.create(
+                hazard_calculation=self.hc,
+                num_sites=len(points),
+                lons=[pt.longitude for pt in points],
+                lats=[pt.latitude for pt in points])
+
         realizations = models.LtRealization.objects.filter(
             hazard_calculation=self.hc.id)
 
+        # combine the partial results left by the tasks (all of them, when
+        # the calculation has been resumed)
+        reduce_hazard_curve_partials(realizations.exclude(
+            id__in=self.reduced))
+
         for rlz in realizations:
             # create a new `HazardCurve` 'container' record for each
             # realization for each intensity measure type
@@ -307,6 +615,14 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
                 [hc_progress] = models.HazardCurveProgress.objects.filter(
                     lt_realization=rlz.id, imt=imt)
 
+                if site_mesh is not None:
+                    models.HazardCurveMatrix.objects.create(
+                        hazard_curve=haz_curve,
+                        site_mesh=site_mesh,
+                        num_imls=len(imls),
+                        poes=hc_progress.result_matrix)
+                    continue
+
                 hc_data_inserter = writer.BulkInserter(models.HazardCurveData)
                 for i, location in enumerate(points):
                     poes = hc_progress.result_matrix[i]
@@ -326,11 +642,15 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
         tables found in the `htemp` schema space.
         """
         logs.LOG.debug('> cleaning up temporary DB data')
+        models.HazardCurvePartial.objects.filter(
+            hazard_calculation=self.hc.id).delete()
+        models.HazardCurveBlock.objects.filter(
+            lt_realization__hazard_calculation=self.hc.id).delete()
         models.HazardCurveProgress.objects.filter(
             lt_realization__hazard_calculation=self.hc.id).delete()
         models.SourceProgress.objects.filter(
             lt_realization__hazard_calculation=self.hc.id).delete()
-        models.SiteData.objects.filter(hazard_calculation=self.hc.id).delete()
+        super(ClassicalHazardCalculator, self).clean_up()
         logs.LOG.debug('< done cleaning up temporary DB data')
 
     def post_process(self):
@@ -339,10 +659,15 @@ class ClassicalHazardCalculator(haz_general.BaseHazardCalculatorNext):
         # If `mean_hazard_curves` is True and/or `quantile_hazard_curves`
         # has some value (not an empty list), do post processing.
         # Otherwise, just skip it altogether.
-        if self.hc.mean_hazard_curves or self.hc.quantile_hazard_curves:
+        # If the statistical curves have been computed during the
+        # calculation (see `execute`), there's nothing left to do.
+        if ((self.hc.mean_hazard_curves or self.hc.quantile_hazard_curves)
+                and self.online_stats is None):
             tasks = post_processing.setup_tasks(
                 self.job, self.job.hazard_calculation,
-                curve_finder=models.HazardCurveData.objects,
+                curve_finder=(models.HazardCurveMatrix.objects
+                              if curve_matrix_storage()
+                              else models.HazardCurveData.objects),
                 writers=dict(mean_curves=MeanCurveWriter,
                              quantile_curves=QuantileCurveWriter))
 
@@ -377,3 +702,75 @@ def update_result_matrix(current, new):
         the current value. This should be the same shape as `current`.
     """
     return 1 - (1 - current) * (1 - new)
+
+
+def reduce_hazard_curve_partials(lt_rlzs):
+    """
+    Combine all of the partial hazard curve results stored by the tasks for
+    the given realizations (in `htemp.hazard_curve_partial`) into the
+    `htemp.hazard_curve_progress` records of the realizations.
+
+    A partial result is shared by all of the realizations of a task with the
+    same GSIM logic tree path: it is loaded once and combined in each of the
+    given realizations it applies to, then it is deleted if no other
+    realization needs it (otherwise, the given realizations are removed from
+    its `lt_realization_ids`). The realizations are processed
+    :data:`REDUCE_BLOCK_SIZE` at a time, one IMT at a time.
+
+    :param lt_rlzs:
+        A sequence of :class:`openquake.db.models.LtRealization` objects of
+        the same calculation.
+    """
+    for block in block_splitter(lt_rlzs, REDUCE_BLOCK_SIZE):
+        _reduce_hazard_curve_partials([lt_rlz.id for lt_rlz in block],
+                                      block[0].hazard_calculation_id)
+
+
+@transaction.commit_on_success(using='reslt_writer')
+def _reduce_hazard_curve_partials(lt_rlz_ids, hc_id):
+    """
+    Combine the partial hazard curve results of a block of realizations.
+    See :func:`reduce_hazard_curve_partials`.
+
+    :param lt_rlz_ids:
+        List of :class:`openquake.db.models.LtRealization` ids.
+    :param int hc_id:
+        ID of the :class:`openquake.db.models.HazardCalculation` of the
+        realizations.
+    """
+    hc_progress = models.HazardCurveProgress.objects.filter(
+        lt_realization__in=lt_rlz_ids)
+    imts = hc_progress.values_list('imt', flat=True).distinct()
+
+    for imt in imts:
+        progress = dict((hc_prog.lt_realization_id, hc_prog)
+                        for hc_prog in hc_progress.filter(imt=imt))
+        results = dict((rlz_id, hc_prog.result_matrix)
+                       for rlz_id, hc_prog in progress.iteritems())
+
+        # the partial results of any of the realizations
+        partials = models.HazardCurvePartial.objects.filter(
+            hazard_calculation=hc_id, imt=imt).extra(
+                where=['lt_realization_ids && %s'], params=[lt_rlz_ids])
+        combined_ids = []
+        for partial in partials.order_by('id').iterator():
+            remaining = []
+            for rlz_id in partial.lt_realization_ids:
+                if rlz_id in results:
+                    results[rlz_id] = update_result_matrix(
+                        results[rlz_id], partial.result_matrix)
+                else:
+                    remaining.append(rlz_id)
+
+            if remaining:
+                models.HazardCurvePartial.objects.filter(
+                    id=partial.id).update(lt_realization_ids=remaining)
+            else:
+                combined_ids.append(partial.id)
+
+        for rlz_id, hc_prog in progress.iteritems():
+            if results[rlz_id] is not hc_prog.result_matrix:
+                hc_prog.result_matrix = results[rlz_id]
+                hc_prog.save()
+        models.HazardCurvePartial.objects.filter(
+            id__in=combined_ids).delete()
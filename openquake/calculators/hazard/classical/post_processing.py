@@ -25,7 +25,7 @@ import math
 import numpy
 
 from celery.task.sets import TaskSet
-from scipy.stats import mstats
+from shapely import geometry
 
 
 from openquake import logs
@@ -33,11 +33,16 @@ from openquake.db import models
 from openquake.utils import config
 from openquake.utils import tasks as utils_tasks
 from openquake.utils.general import block_splitter
+from openquake.writer import BulkInserter
 
 
 # Number of locations considered by each task
 DEFAULT_LOCATIONS_PER_TASK = 1000
 
+#: Maximum number of sites at which the convergence of the mean hazard curves
+#: is checked (see :class:`MeanCurveConvergence`)
+CONVERGENCE_SITES = 100
+
 
 def setup_tasks(job, calculation, curve_finder, writers,
                 locations_per_task=DEFAULT_LOCATIONS_PER_TASK):
@@ -82,10 +87,8 @@ def setup_tasks(job, calculation, curve_finder, writers,
     use_weights = calculation.number_of_logic_tree_samples == 0
     if use_weights:
         mean_curves_fn = "mean_weighted"
-        quantile_curves_fn = "quantile_weighted"
     else:
         mean_curves_fn = "mean"
-        quantile_curves_fn = "quantile"
 
     for imt in calculation.intensity_measure_types_and_levels:
 
@@ -101,21 +104,29 @@ def setup_tasks(job, calculation, curve_finder, writers,
                     [mean_curves_fn, (chunk, writer, use_weights)])
 
         if calculation.should_compute_quantile_curves():
-            for quantile in calculation.quantile_hazard_curves:
+            quantiles = calculation.quantile_hazard_curves
+            quantile_writers = []
+            for quantile in quantiles:
                 writer = writers['quantile_curves'](job, imt, quantile)
                 writer.create_aggregate_result()
-                for chunk in chunks:
-                    tasks.append(
-                        [quantile_curves_fn,
-                    (chunk, writer, use_weights, quantile)])
+                quantile_writers.append(writer)
+
+            # all of the quantiles of a chunk are computed by one task
+            for chunk in chunks:
+                tasks.append(
+                    ["quantiles",
+                     (chunk, quantile_writers, use_weights, quantiles)])
     return tasks
 
 
 def get_post_processing_fn(key):
     """
     Given a key it returns a scientific function decorated with the
-    persite_result_decorator
+    persite_result_decorator. The "quantiles" key returns
+    :func:`quantile_curves_task`, which computes several quantiles at once.
     """
+    if key == "quantiles":
+        return quantile_curves_task
     base_fns = {
         "mean_weighted": mean_curves_weighted,
         "quantile_weighted": quantile_curves_weighted,
@@ -147,18 +158,32 @@ def persite_result_decorator(func):
           other arguments passed to the wrapped function
         """
 
-        poe_matrix, weights, locations = _fetch_curves(chunk_of_curves)
+        for page in _pages(chunk_of_curves):
+            poe_matrix, weights, locations = _fetch_curves(page)
 
-        if use_weights:
-            results = func(poe_matrix, weights, *args, **kwargs)
-        else:
-            results = func(poe_matrix, *args, **kwargs)
+            if use_weights:
+                results = func(poe_matrix, weights, *args, **kwargs)
+            else:
+                results = func(poe_matrix, *args, **kwargs)
 
-        _write_aggregate_results(writer, results, locations)
+            _write_aggregate_results(writer, results, locations)
 
     return new_function
 
 
+def _pages(chunk_of_curves):
+    """
+    Return the pages of a chunk of curves, if the chunk can be processed in
+    pages (see
+    :meth:`openquake.db.models.IndividualHazardCurveChunk.pages`), or a
+    list with just the chunk itself otherwise.
+    """
+    pages = getattr(chunk_of_curves, 'pages', None)
+    if pages is None:
+        return [chunk_of_curves]
+    return pages()
+
+
 def _fetch_curves(chunk_of_curves):
     """
     Fetch the individual curves poes and their locations. See
@@ -223,13 +248,7 @@ def quantile_curves(poe_matrix, quantile):
     :param quantile:
       The quantile considered by the computation
     """
-
-    # mquantiles can not work on 3d matrixes, so we roll back the
-    # location axis as first dimension, then we iterate on each
-    # locations
-    poe_matrixes = numpy.rollaxis(poe_matrix, 1, 0)
-    return [mstats.mquantiles(curves, quantile, axis=0)[0]
-            for curves in poe_matrixes]
+    return quantile_curves_multi(poe_matrix, [quantile])[0]
 
 
 def quantile_curves_weighted(poe_matrix, weights, quantile):
@@ -247,28 +266,500 @@ def quantile_curves_weighted(poe_matrix, weights, quantile):
     :param quantile:
       The quantile considered by the computation
     """
-    # NOTE(LB): Weights might be passed as a list of `decimal.Decimal`
-    # types, and numpy.interp can't handle this (it throws TypeErrors).
-    # So we explicitly cast to floats here before doing interpolation.
-    weights = numpy.array(weights, dtype=numpy.float64)
-
-    # Here, we expect that weight values sum to 1. A weight
-    # describes the probability that a realization is expected
-    # to occur.
-    poe_matrixes = poe_matrix.transpose()
-    ret = []
-    for curves in poe_matrixes:  # iterate on locations
-        result_curve = []
-        for poes in curves:  # iterate on levels
-            sorted_poe_idxs = numpy.argsort(poes)
-            sorted_weights = weights[sorted_poe_idxs]
-            sorted_poes = poes[sorted_poe_idxs]
-
-            cum_weights = numpy.cumsum(sorted_weights)
-            result_curve.append(
-                numpy.interp(quantile, cum_weights, sorted_poes))
-        ret.append(result_curve)
-    return numpy.array(ret).transpose()
+    return quantile_curves_multi(poe_matrix, [quantile], weights)[0]
+
+
+#: Maximum number of PoEs sorted at once by :func:`quantile_curves_multi`.
+#: The sites are processed in blocks, to bound the memory required by the
+#: sorting.
+QUANTILE_BLOCK_VALUES = 10 ** 7
+
+# Plotting positions used for unweighted quantiles, the same as the default
+# ones of :func:`scipy.stats.mstats.mquantiles`.
+_QUANTILE_ALPHAP = 0.4
+_QUANTILE_BETAP = 0.4
+
+
+def quantile_curves_multi(poe_matrix, quantiles, weights=None):
+    """
+    Compute quantile curves for several quantiles at once.
+
+    The PoEs of a block of sites are sorted along the realizations axis
+    once for all of the quantiles, and then each quantile is computed with
+    numpy array operations for all of the sites and levels of the block.
+
+    :param poe_matrix:
+      a 3d matrix with shape given by (curves_per_location x
+      number of locations x intensity measure levels)
+
+    :param quantiles:
+      The list of quantiles considered by the computation
+
+    :param weights:
+      a vector of weights with size equal to the number of
+      curves per location. If `None`, the curves have all the same weight
+      (as in the case of random sampling of the logic trees) and the
+      quantiles are computed like :func:`scipy.stats.mstats.mquantiles`
+      does.
+
+    :returns:
+      a list with a 2d matrix (number of locations x intensity measure
+      levels) for each quantile
+    """
+    poe_matrix = numpy.asarray(poe_matrix, dtype=numpy.float64)
+    num_curves, num_sites, num_levels = poe_matrix.shape
+    if weights is not None:
+        # NOTE(LB): Weights might be passed as a list of `decimal.Decimal`
+        # types, so we explicitly cast to floats here.
+        # Here, we expect that weight values sum to 1. A weight
+        # describes the probability that a realization is expected
+        # to occur.
+        weights = numpy.array(weights, dtype=numpy.float64)
+
+    results = [numpy.empty((num_sites, num_levels)) for _ in quantiles]
+    block_size = max(1, QUANTILE_BLOCK_VALUES // (num_curves * num_levels))
+
+    for start in xrange(0, num_sites, block_size):
+        stop = min(start + block_size, num_sites)
+        # curves x (sites * levels)
+        block = poe_matrix[:, start:stop].reshape((num_curves, -1))
+
+        if weights is None:
+            block = numpy.sort(block, axis=0)
+            for i, quantile in enumerate(quantiles):
+                results[i][start:stop] = _sorted_quantile(
+                    block, quantile).reshape((stop - start, num_levels))
+        else:
+            sorted_idxs = numpy.argsort(block, axis=0)
+            cols = numpy.arange(block.shape[1])
+            sorted_poes = block[sorted_idxs, cols]
+            cum_weights = numpy.cumsum(weights[sorted_idxs], axis=0)
+            for i, quantile in enumerate(quantiles):
+                results[i][start:stop] = _interp_rows(
+                    quantile, cum_weights.T, sorted_poes.T
+                ).reshape((stop - start, num_levels))
+
+    return results
+
+
+def _sorted_quantile(data, quantile):
+    """
+    Compute a quantile of each column of ``data``, which must be sorted
+    along the first axis, with the same formula of
+    :func:`scipy.stats.mstats.mquantiles`.
+
+    :returns:
+        1D array with a value per column of ``data``.
+    """
+    num = data.shape[0]
+    if num == 1:
+        return data[0]
+
+    m = _QUANTILE_ALPHAP + quantile * (1. - _QUANTILE_ALPHAP - _QUANTILE_BETAP)
+    aleph = num * quantile + m
+    k = int(math.floor(min(max(aleph, 1), num - 1)))
+    gamma = min(max(aleph - k, 0), 1)
+    return (1. - gamma) * data[k - 1] + gamma * data[k]
+
+
+class QuantileSketch(object):
+    """
+    A fixed-size summary of the (weighted) distribution of the values of a
+    set of cells (e.g. the PoEs of each site and IML of a block of sites),
+    from which quantiles can be estimated with a bounded relative error.
+
+    Values are counted in buckets with logarithmically growing bounds
+    (as in DDSketch): bucket i > 0 holds the values in
+    (min_value * gamma ** (i - 1), min_value * gamma ** i], where
+    gamma = (1 + rel_error) / (1 - rel_error), and bucket 0 holds the values
+    not greater than `min_value`. The quantiles are estimated with a
+    relative error not greater than `rel_error` (values in bucket 0 are
+    estimated as 0).
+
+    The size of the sketch only depends on the number of cells,
+    `rel_error` and `min_value`, not on the number of values added. Two
+    sketches with the same parameters are merged by adding their counts,
+    so that merging partial sketches (e.g. built by different tasks) gives
+    exactly the same sketch as adding all of the values to a single one.
+
+    :param int num_cells:
+        The number of independent distributions.
+    :param float rel_error:
+        The relative error of the quantiles, between 0 and 1.
+    :param float min_value:
+        The smallest value distinguished from 0.
+    :param float max_value:
+        The largest value which can be added; larger values are counted in
+        the last bucket.
+    """
+
+    def __init__(self, num_cells, rel_error, min_value=1e-12, max_value=1.0):
+        if not 0 < rel_error < 1:
+            raise ValueError(
+                'Invalid relative error: %s. Value must be between 0 and 1.'
+                % rel_error)
+        self.num_cells = num_cells
+        self.rel_error = rel_error
+        self.min_value = min_value
+        self.max_value = max_value
+        self.log_gamma = math.log((1. + rel_error) / (1. - rel_error))
+        self.num_buckets = 2 + int(
+            math.ceil(math.log(max_value / min_value) / self.log_gamma))
+        # cells x buckets
+        self.counts = numpy.zeros((num_cells, self.num_buckets))
+
+    def _buckets(self, values):
+        """
+        Return the indices of the buckets of the given values.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        buckets = numpy.zeros(values.shape, dtype=int)
+        positive = values > self.min_value
+        buckets[positive] = numpy.ceil(
+            numpy.log(values[positive] / self.min_value) / self.log_gamma)
+        return numpy.clip(buckets, 0, self.num_buckets - 1)
+
+    def add(self, cells, values, weights=1.0):
+        """
+        Add values to the sketch.
+
+        :param cells:
+            1D array with the index of the cell of each value
+        :param values:
+            1D array of values
+        :param weights:
+            The weight of each value: a 1D array or a scalar
+        """
+        flat_idxs = (numpy.asarray(cells) * self.num_buckets
+                     + self._buckets(values))
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        if weights.ndim == 0:
+            weights = numpy.repeat(weights, len(flat_idxs))
+        self.counts += numpy.bincount(
+            flat_idxs, weights, minlength=self.counts.size
+        ).reshape(self.counts.shape)
+
+    def merge(self, other):
+        """
+        Add the values of another sketch (with the same parameters) to this
+        one.
+        """
+        if ((self.num_cells, self.rel_error, self.min_value, self.max_value)
+            != (other.num_cells, other.rel_error, other.min_value,
+                other.max_value)):
+            raise ValueError('Cannot merge sketches with different parameters')
+        self.counts += other.counts
+
+    def quantile(self, quantile):
+        """
+        Estimate a quantile of each cell.
+
+        :returns:
+            1D array with a value per cell.
+        """
+        cum_counts = numpy.cumsum(self.counts, axis=1)
+        total = cum_counts[:, -1]
+        # (allowing for rounding errors, and skipping the empty buckets for
+        # the 0 quantile)
+        rank = numpy.maximum(quantile * total * (1 - 1e-12), total * 1e-12)
+        # the first bucket where the cumulative count reaches the rank
+        buckets = (cum_counts < rank[:, numpy.newaxis]).sum(axis=1)
+        buckets = numpy.clip(buckets, 0, self.num_buckets - 1)
+
+        # the value with the minimum relative error over the bucket
+        gamma = math.exp(self.log_gamma)
+        values = (self.min_value * numpy.exp((buckets - 1) * self.log_gamma)
+                  * 2 * gamma / (gamma + 1))
+        values[buckets == 0] = 0.0
+        return values
+
+
+#: Number of realizations read at once by :func:`quantile_curves_task`, when
+#: quantile curves are estimated with a :class:`QuantileSketch`.
+SKETCH_BATCH_SIZE = 100
+
+
+def quantile_curves_sketch(batches, quantiles, rel_error, use_weights):
+    """
+    Estimate quantile curves for several quantiles at once, with a
+    :class:`QuantileSketch` per location and level, so that only a batch
+    of realizations is in memory at any time.
+
+    :param batches:
+      an iterable of chunks of curves (see :func:`setup_tasks`), for the same
+      locations, each one with the curves of a batch of realizations
+    :param quantiles:
+      The list of quantiles considered by the computation
+    :param float rel_error:
+      The relative error of the quantile curves
+    :param use_weights:
+      True if the weights of the curves should be considered
+    :returns:
+      a pair (list of 2d matrixes, one for each quantile, locations)
+    """
+    sketch = None
+    locations = None
+    for batch in batches:
+        poe_matrix, weights, locations = _fetch_curves(batch)
+        num_curves, num_sites, num_levels = poe_matrix.shape
+        if sketch is None:
+            sketch = QuantileSketch(num_sites * num_levels, rel_error)
+
+        # cell index of each PoE: site * num_levels + level
+        cells = numpy.tile(
+            numpy.arange(num_sites * num_levels), num_curves)
+        if use_weights:
+            weights = numpy.repeat(
+                numpy.array(weights, dtype=numpy.float64),
+                num_sites * num_levels)
+        else:
+            weights = 1.0
+        sketch.add(cells, poe_matrix.flatten(), weights)
+
+    if sketch is None:
+        return [], []
+    results = [sketch.quantile(quantile).reshape((-1, num_levels))
+               for quantile in quantiles]
+    return results, locations
+
+
+def quantile_curves_task(chunk_of_curves, writers, use_weights, quantiles):
+    """
+    Compute the quantile curves for a chunk of curves, for several
+    quantiles at once, and save them.
+
+    If `quantile_sketch_error` is set in the [hazard] section of
+    openquake.cfg (and the chunk can be read in batches of realizations),
+    the quantile curves are estimated with that relative error (see
+    :func:`quantile_curves_sketch`), with a memory usage which does not
+    depend on the number of realizations.
+
+    :param chunk_of_curves:
+      an object that implements the properties poes, weights,
+      locations and curves_per_location
+
+    :param writers:
+      a list of objects that can save the results, one for each quantile
+
+    :param use_weights:
+      True if the weights of the curves should be considered
+
+    :param quantiles:
+      The list of quantiles considered by the computation
+    """
+    rel_error = config.get('hazard', 'quantile_sketch_error')
+    if rel_error and hasattr(chunk_of_curves, 'realization_batches'):
+        for page in _pages(chunk_of_curves):
+            results, locations = quantile_curves_sketch(
+                page.realization_batches(SKETCH_BATCH_SIZE), quantiles,
+                float(rel_error), use_weights)
+            for writer, result in zip(writers, results):
+                _write_aggregate_results(writer, result, locations)
+        return
+
+    for page in _pages(chunk_of_curves):
+        poe_matrix, weights, locations = _fetch_curves(page)
+
+        results = quantile_curves_multi(
+            poe_matrix, quantiles, weights if use_weights else None)
+
+        for writer, result in zip(writers, results):
+            _write_aggregate_results(writer, result, locations)
+
+
+class OnlineCurveStatistics(object):
+    """
+    Compute the mean and quantile curves of a classical calculation
+    incrementally, while the calculation is running, instead of reading back
+    all of the individual curves in the post processing phase.
+
+    Each logic tree realization is folded in once it is complete (see
+    :meth:`fold`): its curves are added to a running (weighted)
+    sum, kept in memory, for the mean curves, and they are stored in blocks
+    of sites (see :class:`openquake.db.models.HazardCurveBlock`) for the
+    quantile curves. When all of the realizations are complete,
+    :meth:`finalize` computes and saves the statistical curves, one block
+    of sites at a time.
+
+    :param job:
+      The job associated with this computation
+    :param int block_size:
+      Number of sites in a block
+    """
+
+    def __init__(self, job, block_size=DEFAULT_LOCATIONS_PER_TASK):
+        self.job = job
+        self.hc = job.hazard_calculation
+        self.block_size = block_size
+        self.use_weights = self.hc.number_of_logic_tree_samples == 0
+        self.num_sites = len(self.hc.points_to_compute())
+
+        # ids of the realizations folded so far
+        self.folded = set()
+        self.weight_sum = 0.0
+        # imt -> 2d array (sites x IMLs) with the (weighted) sum of the
+        # PoEs of the realizations folded so far
+        self.mean_sums = {}
+
+    def fold(self, lt_rlz):
+        """
+        Fold in the curves of a complete realization. Its final curves must
+        be already stored in `htemp.hazard_curve_progress`.
+
+        :param lt_rlz:
+            :class:`openquake.db.models.LtRealization` object.
+        """
+        if self.use_weights:
+            weight = float(lt_rlz.weight)
+        else:
+            weight = 1.0
+
+        inserter = BulkInserter(models.HazardCurveBlock)
+        for imt in self.hc.intensity_measure_types_and_levels:
+            [hc_progress] = models.HazardCurveProgress.objects.filter(
+                lt_realization=lt_rlz.id, imt=imt)
+            matrix = hc_progress.result_matrix
+
+            if self.hc.should_compute_mean_curves():
+                if imt in self.mean_sums:
+                    self.mean_sums[imt] += weight * matrix
+                else:
+                    self.mean_sums[imt] = weight * matrix
+
+            if self.hc.should_compute_quantile_curves():
+                for start in xrange(0, self.num_sites, self.block_size):
+                    inserter.add_entry(
+                        lt_realization_id=lt_rlz.id, imt=imt,
+                        block_start=start,
+                        result_matrix=matrix[start:start + self.block_size])
+        inserter.flush()
+
+        self.weight_sum += weight
+        self.folded.add(lt_rlz.id)
+
+    def finalize(self, writers):
+        """
+        Compute and save the mean and quantile curves.
+
+        :param writers:
+          An dictionary of ResultWriters classes (see :func:`setup_tasks`).
+        :raises RuntimeError:
+          If some realizations of the calculation were not folded in.
+        """
+        rlz_ids = models.LtRealization.objects.filter(
+            hazard_calculation=self.hc).values_list('id', flat=True)
+        missing = set(rlz_ids) - self.folded
+        if missing:
+            raise RuntimeError(
+                'Realizations %s were not folded in the statistical curves'
+                % ', '.join(map(str, sorted(missing))))
+
+        locations = [geometry.Point(pt.longitude, pt.latitude).wkb
+                     for pt in self.hc.points_to_compute()]
+
+        for imt in self.hc.intensity_measure_types_and_levels:
+            if self.hc.should_compute_mean_curves():
+                writer = writers['mean_curves'](self.job, imt)
+                writer.create_aggregate_result()
+                _write_aggregate_results(
+                    writer, self.mean_sums[imt] / self.weight_sum, locations)
+
+            if self.hc.should_compute_quantile_curves():
+                self._write_quantiles(writers, imt, locations)
+
+    def _write_quantiles(self, writers, imt, locations):
+        """
+        Compute and save the quantile curves for an IMT, one block of sites
+        at a time.
+        """
+        quantiles = self.hc.quantile_hazard_curves
+        quantile_writers = []
+        for quantile in quantiles:
+            writer = writers['quantile_curves'](self.job, imt, quantile)
+            writer.create_aggregate_result()
+            quantile_writers.append(writer)
+
+        for start in xrange(0, self.num_sites, self.block_size):
+            blocks = models.HazardCurveBlock.objects.filter(
+                lt_realization__hazard_calculation=self.hc, imt=imt,
+                block_start=start).select_related('lt_realization').order_by(
+                    'lt_realization')
+            poe_matrix = []
+            weights = []
+            for block in blocks.iterator():
+                poe_matrix.append(block.result_matrix)
+                weights.append(block.lt_realization.weight)
+
+            results = quantile_curves_multi(
+                numpy.array(poe_matrix), quantiles,
+                weights if self.use_weights else None)
+            for writer, result in zip(quantile_writers, results):
+                _write_aggregate_results(
+                    writer, result,
+                    locations[start:start + self.block_size])
+
+
+class MeanCurveConvergence(object):
+    """
+    Track how much the mean hazard curves change as more logic tree
+    realizations are computed, to decide when to stop sampling the logic
+    trees.
+
+    The mean curves are computed only at a representative subset of the
+    sites of the calculation: at most `num_sites` sites, evenly spaced in the
+    list of sites. The realizations are sampled randomly, so they all have
+    the same weight.
+
+    :param hc:
+        :class:`openquake.db.models.HazardCalculation` object.
+    :param int num_sites:
+        Maximum number of sites at which the mean curves are computed.
+    """
+
+    def __init__(self, hc, num_sites=CONVERGENCE_SITES):
+        total_sites = len(hc.points_to_compute())
+        self.site_indices = numpy.unique(numpy.linspace(
+            0, total_sites - 1, min(total_sites, num_sites)).astype(int))
+
+        # ids of the realizations added so far
+        self.added = set()
+        # imt -> 2d array (sites x IMLs) with the sum of the PoEs of the
+        # realizations added so far
+        self.sums = {}
+        # imt -> 2d array (sites x IMLs) with the mean curves
+        self.means = None
+
+    def update(self, lt_rlzs):
+        """
+        Add the curves of complete realizations to the mean curves. Their
+        final curves must be already stored in
+        `htemp.hazard_curve_progress`.
+
+        :param lt_rlzs:
+            A sequence of :class:`openquake.db.models.LtRealization` objects.
+        :returns:
+            The largest absolute change of the PoEs of the mean curves, or
+            `None` if this is the first update.
+        """
+        for lt_rlz in lt_rlzs:
+            hc_progress = models.HazardCurveProgress.objects.filter(
+                lt_realization=lt_rlz.id)
+            for hc_prog in hc_progress:
+                matrix = hc_prog.result_matrix[self.site_indices]
+                if hc_prog.imt in self.sums:
+                    self.sums[hc_prog.imt] += matrix
+                else:
+                    self.sums[hc_prog.imt] = matrix
+            self.added.add(lt_rlz.id)
+
+        means = dict((imt, sums / len(self.added))
+                     for imt, sums in self.sums.iteritems())
+        change = None
+        if self.means is not None:
+            change = max(numpy.abs(means[imt] - self.means[imt]).max()
+                         for imt in means)
+        self.means = means
+        return change
 
 
 # Disabling "Unused argument 'job_id'" (this parameter is required by @oqtask):
@@ -287,11 +778,19 @@ def do_post_process(job_id, post_processing_task):
 do_post_process.ignore_result = False
 
 
-def compute_hazard_maps(curves, imls, poes):
+#: Smallest PoE considered by the log-log interpolation of hazard maps;
+#: smaller PoEs (zeros, in particular) are clipped to this value.
+MIN_LOG_POE = 1e-300
+
+
+def compute_hazard_maps(curves, imls, poes, log=False):
     """
     Given a set of hazard curve poes, interpolate a hazard map at the specified
     ``poe``.
 
+    All of the curves and all of the ``poes`` are interpolated at once, with
+    numpy array operations.
+
     :param curves:
         2D array of floats. Each row represents a curve, where the values
         in the row are the PoEs (Probabilities of Exceedance) corresponding to
@@ -302,6 +801,9 @@ def compute_hazard_maps(curves, imls, poes):
     :param float poes:
         Value(s) on which to interpolate a hazard map from the input
         ``curves``. Can be an array-like or scalar value (for a single PoE).
+    :param bool log:
+        If `True`, interpolate linearly the logarithms of PoEs and IMLs
+        (log-log interpolation) instead of the values themselves.
 
     :returns:
         A 2D numpy array of hazard map data. Each element/row in the resulting
@@ -313,21 +815,75 @@ def compute_hazard_maps(curves, imls, poes):
         hazard map results, and in a consistent way (no matter how many
         ``poes`` values are specified).
     """
-    poes = numpy.array(poes)
+    poes = numpy.array(poes, dtype=float)
 
     if len(poes.shape) == 0:
         # ``poes`` was passed in as a scalar;
         # convert it to 1D array of 1 element
         poes = poes.reshape(1)
 
-    result = []
-    imls = numpy.array(imls[::-1])
+    # ``curves`` can also be an iterator over the curves
+    if not isinstance(curves, numpy.ndarray):
+        curves = list(curves)
+    curves = numpy.array(curves, dtype=float)
+    if curves.size == 0:
+        return numpy.empty((len(poes), 0))
+
+    # PoEs must be increasing to be interpolated
+    curves = curves[:, ::-1]
+    imls = numpy.array(imls[::-1], dtype=float)
+
+    if log:
+        curves = numpy.log(numpy.clip(curves, MIN_LOG_POE, None))
+        imls = numpy.log(imls)
+        poes = numpy.log(numpy.clip(poes, MIN_LOG_POE, None))
 
-    for curve in curves:
-        hmap_val = numpy.interp(poes, curve[::-1], imls)
-        result.append(hmap_val)
+    result = numpy.array([_interp_rows(poe, curves, imls) for poe in poes])
 
-    return numpy.array(result).transpose()
+    if log:
+        result = numpy.exp(result)
+    return result
+
+
+def _interp_rows(x, xp, fp):
+    """
+    Interpolate each row of the 2D array ``xp`` at ``x``, like
+    :func:`numpy.interp` does for a single row.
+
+    :param float x:
+        The value to interpolate.
+    :param xp:
+        2D array with a (non-strictly) increasing sequence per row.
+    :param fp:
+        The values corresponding to ``xp``: a 1D array with a value per
+        column of ``xp`` (the same for all rows) or a 2D array with the same
+        shape of ``xp``.
+    :returns:
+        1D array with one value per row of ``xp``.
+    """
+    num_rows, num_cols = xp.shape
+    if fp.ndim == 1:
+        fp = numpy.tile(fp, (num_rows, 1))
+    if num_cols == 1:
+        return fp[:, 0].copy()
+
+    rows = numpy.arange(num_rows)
+    # index of the last value <= x of each row, such that
+    # xp[j] <= x < xp[j + 1]
+    j = numpy.clip((xp <= x).sum(axis=1) - 1, 0, num_cols - 2)
+    x0 = xp[rows, j]
+    dx = xp[rows, j + 1] - x0
+    y0 = fp[rows, j]
+    # where dx == 0 the value is replaced below, avoid dividing by zero
+    slope = (fp[rows, j + 1] - y0) / numpy.where(dx == 0, 1, dx)
+    result = y0 + (x - x0) * slope
+
+    # outside of the range of each row, take the value at the boundary
+    lower = x < xp[:, 0]
+    result[lower] = fp[lower, 0]
+    upper = x >= xp[:, -1]
+    result[upper] = fp[upper, -1]
+    return result
 
 
 _HAZ_MAP_DISP_NAME_MEAN_FMT = 'hazard-map(%(poe)s)-%(imt)s-mean'
@@ -357,26 +913,19 @@ def hazard_curves_to_hazard_map(job_id, hazard_curve_id, poes):
     job = models.OqJob.objects.get(id=job_id)
 
     hc = models.HazardCurve.objects.get(id=hazard_curve_id)
-    hcd = hc.hazardcurvedata_set.order_by('location')
-
-    curves = (curve.poes for curve in hcd)
-    hazard_maps = compute_hazard_maps(curves, hc.imls, poes)
-
-    for i, poe in enumerate(poes):
-        imls = hazard_maps[i]
-        lons = numpy.empty(imls.shape)
-        lats = numpy.empty(imls.shape)
 
-        for j, _ in enumerate(imls):
-            location = hcd[j].location
-            lons[j] = location.x
-            lats[j] = location.y
+    curves, lons, lats = _get_curves_and_locations(hc)
+    log = config.get('hazard', 'hazard_map_interpolation') == 'log-log'
+    hazard_maps = compute_hazard_maps(curves, hc.imls, poes, log=log)
 
-        imt = hc.imt
-        if imt == 'SA':
-            # if it's SA, include the period using the standard notation
-            imt = 'SA(%s)' % hc.sa_period
+    imt = hc.imt
+    if imt == 'SA':
+        # if it's SA, include the period using the standard notation
+        imt = 'SA(%s)' % hc.sa_period
 
+    # all of the maps are stored at once
+    inserter = BulkInserter(models.HazardMap)
+    for i, poe in enumerate(poes):
         # save the hazard map
         # create `Output` first:
         if hc.statistics == 'mean':
@@ -391,10 +940,9 @@ def hazard_curves_to_hazard_map(job_id, hazard_curve_id, poes):
         output = models.Output.objects.create_output(
             job, disp_name, 'hazard_map')
 
-        # now create and store the hazard map
-        models.HazardMap.objects.create(
-            output=output,
-            lt_realization=hc.lt_realization,
+        inserter.add_entry(
+            output_id=output.id,
+            lt_realization_id=hc.lt_realization_id,
             investigation_time=hc.investigation_time,
             imt=hc.imt,
             statistics=hc.statistics,
@@ -404,8 +952,36 @@ def hazard_curves_to_hazard_map(job_id, hazard_curve_id, poes):
             poe=poe,
             lons=lons,
             lats=lats,
-            imls=imls,
+            imls=hazard_maps[i],
         )
+    inserter.flush()
+
+
+def _get_curves_and_locations(hc):
+    """
+    Read all of the curves of a :class:`openquake.db.models.HazardCurve`,
+    with the coordinates of their locations, with a single query.
+
+    :returns:
+        A triple (curves, lons, lats) of numpy arrays: curves is a 2D array
+        (sites x IMLs), lons and lats are 1D arrays.
+    """
+    matrices = list(models.HazardCurveMatrix.objects.filter(
+        hazard_curve=hc.id).select_related('site_mesh'))
+    if matrices:
+        # the curves are stored as a single sites x IMLs matrix
+        [matrix] = matrices
+        lons, lats = matrix.site_mesh.get_coords()
+        return matrix.get_poes(), lons, lats
+
+    rows = hc.hazardcurvedata_set.order_by('location').extra(
+        select={'lon': 'ST_X(location)', 'lat': 'ST_Y(location)'}
+    ).values_list('poes', 'lon', 'lat')
+    if not rows:
+        return numpy.empty((0, len(hc.imls))), numpy.empty(0), numpy.empty(0)
+
+    poes, lons, lats = zip(*rows)
+    return numpy.array(poes), numpy.array(lons), numpy.array(lats)
 
 # Disabling 'invalid name'
 # pylint: disable=C0103
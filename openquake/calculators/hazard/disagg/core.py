@@ -16,15 +16,600 @@
 
 """
 Disaggregation calculator core functionality
+
+The disaggregation matrices are computed for each site of the calculation and
+for each IML of the `intensity_measure_types_and_levels`, in a single pass
+over the ruptures of the sources of each task (see
+:func:`disagg_poissonian_multi`). The work is distributed exactly as in the
+classical calculator.
+
+For each rupture, the probability that each IML is exceeded at each site is
+split in epsilon bins, and the contribution of the rupture
+(`poe * log(1 - probability of the rupture)`, the logarithm of the
+probability of no exceedance) is added to the bin of its magnitude, its
+distance from the site, the location of its point closest to the site, the
+epsilon and its tectonic region type. Since the contributions are added, the
+partial matrices computed by the tasks can be combined by summation; the
+probability of exceedance of a bin is `1 - exp(sum)`.
+
+The magnitude, distance and coordinate bins are aligned to fixed grids, so
+that the matrices of all of the tasks share the same bins. Only the non-empty
+bins are kept while computing and combining the matrices; the final matrices
+only span the non-empty bins of each site.
 """
 
+import numpy
+
+import nhlib.calc
+import nhlib.tom
+
+from django.db import transaction
+from nhlib import const
+from scipy.special import ndtr
+
+from openquake import logs
 from openquake.calculators.hazard import general as haz_general
+from openquake.calculators.hazard.classical import core as classical
+from openquake.db import models
+from openquake.input import logictree
+from openquake.utils import stats
+from openquake.utils import tasks as utils_tasks
+from openquake.writer import BulkInserter
+
+
+#: Upper bound of the magnitude of the ruptures, which defines the size of
+#: the magnitude dimension of the (sparse) disaggregation matrices
+MAX_MAG = 10.0
+
+#: Kilometers per degree of latitude
+KM_PER_DEGREE = 111.195
+
+#: Number of bin contributions collected by :class:`SparseSum` before they are
+#: combined
+DISAGG_BUFFER_SIZE = 10 ** 6
+
+
+def sum_by_index(indices, values):
+    """
+    Sum the values with the same index.
+
+    :param indices:
+        1d array of integer indices.
+    :param values:
+        1d array of values, of the same length as `indices`.
+    :returns:
+        A pair of arrays: the sorted distinct indices and the sum of the
+        values for each of them.
+    """
+    uniq, inverse = numpy.unique(indices, return_inverse=True)
+    return uniq, numpy.bincount(inverse, weights=values)
+
+
+class SparseSum(object):
+    """
+    Sum of sparse vectors, defined by the indices and the values of their
+    non-zero items. Items are buffered and combined (see
+    :func:`sum_by_index`) when the buffer is full.
+
+    :param int buffer_size:
+        Number of items buffered before they are combined.
+    """
+
+    def __init__(self, buffer_size=DISAGG_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.indices = []
+        self.values = []
+        self.size = 0
+
+    def add(self, indices, values):
+        """
+        Add a sparse vector.
+
+        :param indices:
+            1d array of integer indices.
+        :param values:
+            1d array of values, of the same length as `indices`.
+        """
+        self.indices.append(indices)
+        self.values.append(values)
+        self.size += len(indices)
+        if self.size > self.buffer_size:
+            self._combine()
+            # don't combine again and again if there are many distinct bins
+            self.buffer_size = max(self.buffer_size, 2 * self.size)
+
+    def _combine(self):
+        """
+        Replace the buffered items with their sum.
+        """
+        if len(self.indices) > 1:
+            indices, values = sum_by_index(
+                numpy.concatenate(self.indices),
+                numpy.concatenate(self.values))
+            self.indices = [indices]
+            self.values = [values]
+            self.size = len(indices)
+
+    def result(self):
+        """
+        :returns:
+            A pair of arrays: the sorted indices of the non-zero items and
+            their values.
+        """
+        if not self.indices:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0)
+        if len(self.indices) == 1:
+            return sum_by_index(self.indices[0], self.values[0])
+        self._combine()
+        return self.indices[0], self.values[0]
+
+
+class DisaggBins(object):
+    """
+    The bins of the disaggregation matrices of a calculation.
+
+    The matrix of all of the sites has the dimensions:
+
+    * site
+    * level (an IML of an IMT, see :attr:`levels`)
+    * magnitude
+    * distance
+    * longitude
+    * latitude
+    * epsilon
+
+    (The tectonic region type is kept separate.) Magnitudes and distances are
+    binned from 0; coordinates are binned from the site coordinates minus the
+    `maximum_distance`. Values out of range are put in the first or last
+    bins.
+
+    :param hc:
+        :class:`openquake.db.models.HazardCalculation` object.
+    """
+
+    def __init__(self, hc):
+        points = hc.points_to_compute()
+        self.lons = points.lons
+        self.lats = points.lats
+
+        self.mag_width = hc.mag_bin_width
+        self.dist_width = hc.distance_bin_width
+        self.coord_width = hc.coordinate_bin_width
+        self.eps_edges = numpy.linspace(
+            -hc.truncation_level, hc.truncation_level,
+            hc.num_epsilon_bins + 1)
+        self.truncation_level = hc.truncation_level
+
+        # (imt, iml) pairs
+        self.levels = []
+        # (nhlib imt, logarithms of the IMLs) pairs, in the same order
+        self.imts = []
+        for imt in sorted(hc.intensity_measure_types_and_levels):
+            imls = hc.intensity_measure_types_and_levels[imt]
+            self.imts.append(
+                (haz_general.imt_to_nhlib(imt), numpy.log(imls)))
+            self.levels.extend((imt, iml) for iml in imls)
+
+        self.lat_delta = hc.maximum_distance / KM_PER_DEGREE
+        self.lon_deltas = numpy.minimum(
+            self.lat_delta / numpy.cos(numpy.radians(self.lats)), 180.0)
+
+        self.site_shape = (
+            len(self.levels),
+            int(numpy.ceil(MAX_MAG / self.mag_width)),
+            int(numpy.ceil(hc.maximum_distance / self.dist_width)),
+            int(numpy.ceil(2 * self.lon_deltas.max() / self.coord_width)),
+            int(numpy.ceil(2 * self.lat_delta / self.coord_width)),
+            hc.num_epsilon_bins)
+        self.shape = (len(self.lons),) + self.site_shape
+
+    def rupture_indices(self, rupture, mesh, site_indices):
+        """
+        Compute the flat indices of the bins of a rupture.
+
+        :param rupture:
+            :class:`nhlib.source.rupture.ProbabilisticRupture` object.
+        :param mesh:
+            :class:`nhlib.geo.mesh.Mesh` of the sites affected by the
+            rupture.
+        :param site_indices:
+            1d array with the indices of the sites in `mesh` among all of
+            the sites of the calculation.
+        :returns:
+            3d array (sites x levels x epsilons) of flat indices in the
+            matrix of :attr:`shape`.
+        """
+        rjb = rupture.surface.get_joyner_boore_distance(mesh)
+        closest = rupture.surface.get_closest_points(mesh)
+
+        lons = self.lons[site_indices]
+        lon_offsets = ((closest.lons - lons + 180) % 360 - 180
+                       + self.lon_deltas[site_indices])
+        lat_offsets = closest.lats - self.lats[site_indices] + self.lat_delta
+
+        def column(values):
+            "Bin indices of a per site quantity, as a column vector"
+            return numpy.floor(values).astype(int)[:, None, None]
+
+        index_arrays = numpy.broadcast_arrays(
+            site_indices[:, None, None],
+            numpy.arange(len(self.levels))[None, :, None],
+            numpy.array(int(rupture.mag // self.mag_width)),
+            column(rjb / self.dist_width),
+            column(lon_offsets / self.coord_width),
+            column(lat_offsets / self.coord_width),
+            numpy.arange(len(self.eps_edges) - 1)[None, None, :])
+        return numpy.ravel_multi_index(index_arrays, self.shape, mode='clip')
+
+    def poes(self, gsim, sctx, rctx, dctx):
+        """
+        Compute the probability that each IML is exceeded with the epsilon
+        of each bin.
+
+        :returns:
+            3d array (sites x levels x epsilons) of probabilities. The sum
+            over the epsilons is the probability of exceedance of the IML.
+        """
+        lower_edges = self.eps_edges[:-1]
+        upper_edges = self.eps_edges[1:]
+        norm = ndtr(self.truncation_level) - ndtr(-self.truncation_level)
+
+        poes = []
+        for imt, log_imls in self.imts:
+            mean, [stddev] = gsim.get_mean_and_stddevs(
+                sctx, rctx, dctx, imt, [const.StdDev.TOTAL])
+            epsilons = (log_imls[None, :] - mean[:, None]) / stddev[:, None]
+            # the part of each bin above the epsilon of the IML
+            lower = numpy.minimum(
+                numpy.maximum(epsilons[:, :, None], lower_edges),
+                upper_edges)
+            poes.append((ndtr(upper_edges) - ndtr(lower)) / norm)
+        return numpy.concatenate(poes, axis=1)
+
+    def edges(self, site, lower, upper):
+        """
+        Compute the bin edges of the magnitude, distance, longitude and
+        latitude dimensions of a site.
 
+        :param int site:
+            The index of the site.
+        :param lower:
+            The indices of the first bin of each dimension.
+        :param upper:
+            The indices of the last bin of each dimension.
+        :returns:
+            A list of 4 arrays of bin edges.
+        """
+        mag, dist, lon, lat = [numpy.arange(lo, hi + 2)
+                               for lo, hi in zip(lower, upper)]
+        lon_origin = self.lons[site] - self.lon_deltas[site]
+        lat_origin = self.lats[site] - self.lat_delta
+        return [mag * self.mag_width,
+                dist * self.dist_width,
+                lon_origin + lon * self.coord_width,
+                lat_origin + lat * self.coord_width]
+
+
+@utils_tasks.oqtask
+@stats.count_progress('h')
+def disagg_task(job_id, src_ids, lt_rlz_ids):
+    """
+    A celery task wrapper function around :func:`compute_disagg`.
+    See :func:`compute_disagg` for parameter definitions.
+    """
+    logs.LOG.debug('> starting task: job_id=%s, lt_realization_ids=%s'
+                   % (job_id, lt_rlz_ids))
+
+    compute_disagg(job_id, src_ids, lt_rlz_ids)
+    # Last thing, signal back the control node to indicate the completion of
+    # task. The control node needs this to manage the task distribution and
+    # keep track of progress.
+    logs.LOG.debug('< task complete, signalling completion')
+    haz_general.signal_task_complete(job_id, len(src_ids) * len(lt_rlz_ids))
+
+
+# Silencing 'Too many local variables'
+# pylint: disable=R0914
+def compute_disagg(job_id, src_ids, lt_rlz_ids):
+    """
+    Compute the partial disaggregation matrices of a set of sources for a
+    set of realizations, and store them in `htemp.disagg_partial` (see
+    :class:`openquake.db.models.DisaggPartial`), once per GSIM logic tree
+    path for all of the realizations sharing the path.
+
+    As in the classical calculator (see
+    :func:`openquake.calculators.hazard.classical.core.\
+compute_hazard_curves`), all of the given realizations must share the same
+    source model logic tree path, and the progress of the realizations is
+    updated in the same transaction which stores the results.
+
+    :param int job_id:
+        ID of the currently running job.
+    :param src_ids:
+        List of ids of parsed source models to take into account.
+    :param lt_rlz_ids:
+        List of ids of the logic tree realization models to calculate for.
+    """
+    hc = models.HazardCalculation.objects.get(oqjob=job_id)
+
+    lt_rlzs = models.LtRealization.objects.filter(
+        id__in=lt_rlz_ids).order_by('id')
+    ltp = logictree.LogicTreeProcessor(hc.id)
+
+    apply_uncertainties = ltp.parse_source_model_logictree_path(
+            lt_rlzs[0].sm_lt_path)
+
+    rlzs_by_gsim_path = {}
+    for lt_rlz in lt_rlzs:
+        rlzs_by_gsim_path.setdefault(
+            tuple(lt_rlz.gsim_lt_path), []).append(lt_rlz)
+    gsim_paths = sorted(rlzs_by_gsim_path)
+    gsims_list = [ltp.parse_gmpe_logictree_path(list(path))
+                  for path in gsim_paths]
+
+    sources = haz_general.gen_sources(
+        src_ids, apply_uncertainties, hc.rupture_mesh_spacing,
+        hc.width_of_mfd_bin, hc.area_source_discretization)
+
+    site_coll = haz_general.get_site_collection(hc)
+
+    dist = hc.maximum_distance
+    logs.LOG.debug('> computing disaggregation matrices')
+    matrices_list = disagg_poissonian_multi(
+        sources, site_coll, DisaggBins(hc), hc.investigation_time,
+        gsims_list,
+        nhlib.calc.filters.source_site_distance_filter(dist),
+        nhlib.calc.filters.rupture_site_distance_filter(dist))
+    logs.LOG.debug('< done computing disaggregation matrices')
+
+    with transaction.commit_on_success(using='reslt_writer'):
+        for gsim_path, matrices in zip(gsim_paths, matrices_list):
+            path_rlz_ids = [
+                lt_rlz.id for lt_rlz in rlzs_by_gsim_path[gsim_path]]
+            for trt, matrix in matrices.iteritems():
+                models.DisaggPartial.objects.create(
+                    hazard_calculation=hc, lt_realization_ids=path_rlz_ids,
+                    trt=trt, result_matrix=matrix)
+
+        classical.mark_sources_complete(src_ids, lt_rlz_ids)
+
+
+def disagg_poissonian_multi(sources, sites, bins, time_span, gsims_list,
+                            source_site_filter, rupture_site_filter):
+    """
+    Compute the disaggregation matrices of a set of sources, for several GSIM
+    logic tree paths at once, in a single pass over the ruptures.
+
+    The bins of each rupture are computed once, and the probabilities of
+    exceedance are computed once for each distinct GSIM which applies to the
+    tectonic region of the rupture (as in :func:`openquake.calculators.\
+hazard.classical.core.hazard_curves_poissonian_multi`).
+
+    :param sources:
+        An iterator of nhlib seismic sources.
+    :param sites:
+        :class:`nhlib.site.SiteCollection` of all of the sites of the
+        calculation.
+    :param bins:
+        :class:`DisaggBins` of the calculation.
+    :param float time_span:
+        The investigation time.
+    :param gsims_list:
+        List of dictionaries mapping tectonic region types to
+        :class:`nhlib.gsim.base.GMPE` objects (one per GSIM logic tree path).
+    :param source_site_filter:
+        See :mod:`nhlib.calc.filters`.
+    :param rupture_site_filter:
+        See :mod:`nhlib.calc.filters`.
+    :returns:
+        A list (one item per GSIM logic tree path, in the same order as
+        `gsims_list`) of dictionaries mapping tectonic region types to
+        sparse matrices (see :meth:`SparseSum.result`) with the sums of the
+        logarithms of the probabilities of no exceedance of each bin.
+    """
+    sums_list = [{} for _ in gsims_list]
+    tom = nhlib.tom.PoissonTOM(time_span)
+    total_sites = len(sites)
+
+    sources_sites = ((source, sites) for source in sources)
+    for source, s_sites in source_site_filter(sources_sites):
+        ruptures_sites = ((rupture, s_sites)
+                          for rupture in source.iter_ruptures(tom))
+        for rupture, r_sites in rupture_site_filter(ruptures_sites):
+            log_no_occurrence = numpy.log(1 - rupture.get_probability())
+            trt = rupture.tectonic_region_type
+
+            # indices of the affected sites among all of the sites
+            positions = r_sites.expand(
+                numpy.arange(len(r_sites)), total_sites, placeholder=-1)
+            site_indices = numpy.nonzero(positions >= 0)[0]
+            indices = bins.rupture_indices(
+                rupture, r_sites.mesh, site_indices)
+
+            # contributions to the bins, per GSIM class
+            contributions = {}
+            for gsims, sums in zip(gsims_list, sums_list):
+                gsim = gsims[trt]
+                key = gsim.__class__
+                if not key in contributions:
+                    sctx, rctx, dctx = gsim.make_contexts(r_sites, rupture)
+                    poes = bins.poes(gsim, sctx, rctx, dctx)
+                    nonzero = poes > 0
+                    contributions[key] = (
+                        indices[nonzero], poes[nonzero] * log_no_occurrence)
+                if not trt in sums:
+                    sums[trt] = SparseSum()
+                sums[trt].add(*contributions[key])
+
+    return [dict((trt, sums[trt].result()) for trt in sums)
+            for sums in sums_list]
+
+
+def _read_partials(lt_rlz):
+    """
+    Combine the partial disaggregation matrices of a realization.
 
-class DisaggHazardCalculator(haz_general.BaseHazardCalculatorNext):
+    :returns:
+        A dictionary mapping tectonic region types to sparse matrices (see
+        :meth:`SparseSum.result`).
+    """
+    partials = models.DisaggPartial.objects.filter(
+        hazard_calculation=lt_rlz.hazard_calculation_id).extra(
+            where=['lt_realization_ids @> ARRAY[%s]'], params=[lt_rlz.id])
+    trts = partials.values_list('trt', flat=True).distinct()
+
+    matrices = {}
+    for trt in trts:
+        total = SparseSum()
+        for partial in partials.filter(trt=trt).order_by('id').iterator():
+            total.add(*partial.result_matrix)
+        matrices[trt] = total.result()
+    return matrices
+
+
+# Silencing 'Too many local variables'
+# pylint: disable=R0914
+def save_disagg_results(job, lt_rlz, bins):
+    """
+    Combine the partial disaggregation matrices of a realization and save
+    the final matrices in `hzrdr.disagg_result`, one for each site and level
+    (IMT and IML). The matrices of a site span the non-empty bins of the
+    site.
+
+    :param job:
+        :class:`openquake.db.models.OqJob` object.
+    :param lt_rlz:
+        :class:`openquake.db.models.LtRealization` object.
+    :param bins:
+        :class:`DisaggBins` of the calculation.
+    """
+    hc = job.hazard_calculation
+    matrices = _read_partials(lt_rlz)
+    trts = sorted(matrices)
+    site_size = numpy.prod(bins.site_shape)
+
+    # level -> Output
+    outputs = {}
+    inserter = BulkInserter(models.DisaggResult)
+
+    for site in xrange(len(bins.lons)):
+        # the non-empty bins of the site for each tectonic region type: a
+        # tuple of bin index arrays (one per dimension) and the values
+        site_bins = []
+        for trt in trts:
+            indices, values = matrices[trt]
+            start, stop = numpy.searchsorted(
+                indices, [site * site_size, (site + 1) * site_size])
+            site_bins.append((
+                numpy.unravel_index(
+                    indices[start:stop] - site * site_size, bins.site_shape),
+                values[start:stop]))
+        if not any(len(values) for _, values in site_bins):
+            continue
+
+        # magnitude, distance, longitude and latitude bins spanned by the
+        # site matrices
+        lower, upper = [], []
+        for dim in xrange(1, 5):
+            dim_indices = numpy.concatenate(
+                [index[dim] for index, _ in site_bins])
+            lower.append(dim_indices.min())
+            upper.append(dim_indices.max())
+        shape = tuple(hi - lo + 1 for lo, hi in zip(lower, upper)) + (
+            bins.site_shape[-1], len(trts))
+        mag_edges, dist_edges, lon_edges, lat_edges = bins.edges(
+            site, lower, upper)
+
+        for level, (imt, iml) in enumerate(bins.levels):
+            log_pne = numpy.zeros(shape)
+            for i, (index, values) in enumerate(site_bins):
+                sel = index[0] == level
+                log_pne[index[1][sel] - lower[0], index[2][sel] - lower[1],
+                        index[3][sel] - lower[2], index[4][sel] - lower[3],
+                        index[5][sel], i] = values[sel]
+
+            if not level in outputs:
+                outputs[level] = models.Output.objects.create(
+                    owner=hc.owner,
+                    oq_job=job,
+                    display_name='disagg-rlz-%s-%s-%s' % (
+                        lt_rlz.id, imt, iml),
+                    output_type='disagg_matrix')
+            im_type, sa_period, sa_damping = models.parse_imt(imt)
+            inserter.add_entry(
+                output_id=outputs[level].id,
+                lt_realization_id=lt_rlz.id,
+                investigation_time=hc.investigation_time,
+                imt=im_type,
+                iml=iml,
+                poe=1 - numpy.exp(log_pne.sum()),
+                sa_period=sa_period,
+                sa_damping=sa_damping,
+                mag_bin_edges=mag_edges,
+                dist_bin_edges=dist_edges,
+                lon_bin_edges=lon_edges,
+                lat_bin_edges=lat_edges,
+                eps_bin_edges=bins.eps_edges,
+                trts=trts,
+                location='POINT(%s %s)' % (bins.lons[site], bins.lats[site]),
+                matrix=1 - numpy.exp(log_pne))
+        inserter.flush()
+
+
+class DisaggHazardCalculator(classical.ClassicalHazardCalculator):
+    """
+    Disaggregation hazard calculator. Computes the disaggregation matrices
+    for each site, realization, IMT and IML.
+
+    The sources are distributed to the tasks, and the realizations are
+    grouped, as in the classical calculator.
+    """
+
+    core_calc_task = disagg_task
+
+    def pre_execute(self):
+        """
+        Parse and initialize sources and the site model (if there is one),
+        and generate the logic tree realizations.
+        """
+        self.initialize_sources()
+        self.initialize_site_model()
+        self.initialize_realizations()
+        self.initialize_source_weights()
+        self.initialize_pr_data()
+
+        self.record_init_stats()
+
+    def reduce_completed_realizations(self):
+        """
+        There are no partial hazard curves to combine: the partial
+        disaggregation matrices are combined in :meth:`post_execute`.
+        """
+
+    def post_execute(self):
+        """
+        Combine the partial matrices computed by the tasks and save the
+        disaggregation results (see :func:`save_disagg_results`).
+        """
+        bins = DisaggBins(self.hc)
+        realizations = models.LtRealization.objects.filter(
+            hazard_calculation=self.hc.id).order_by('id')
+        for lt_rlz in realizations:
+            with transaction.commit_on_success(using='reslt_writer'):
+                save_disagg_results(self.job, lt_rlz, bins)
+
+    def post_process(self):
+        """
+        There is no post processing of disaggregation results.
+        """
 
-    def execute(self):
+    def clean_up(self):
         """
-        Fake temporary execution method.
+        Delete temporary database records (see
+        :meth:`openquake.calculators.hazard.classical.core.\
+ClassicalHazardCalculator.clean_up`), including the partial disaggregation
+        matrices.
         """
-        print "Fake execute(). Implement me!"
+        models.DisaggPartial.objects.filter(
+            hazard_calculation=self.hc.id).delete()
+        super(DisaggHazardCalculator, self).clean_up()
@@ -103,16 +103,15 @@ curve post-processing options are available as well: `mean_hazard_curves`,
 
 Hazard curves are computed from GMFs as follows:
 
-* For each logic tree realization, IMT, and location, there exist a number of
-  hzrdr.gmf records exactly equal to the `ses_per_logic_tree_path` parameter.
-  Each record contains an array with a number of ground motion values; this
-  number is determined by the number of ruptures in a given stochastic event
-  (which is random--see the section "SESs" above). All of these lists GMVs are
-  flattened into a single list of GMVs (the size of which is unknown, due the
-  random element mentioned above).
-* With this list of GMVs, a list of IMLs (Intensity Measure Levels) for the
-  given IMT (defined in the configuration file as
-  `intensity_measure_types_and_levels`), `investigation_time`, and "duration"
+* While computing the GMFs, each task counts, for each IMT and location, the
+  number of ground motion values exceeding each of the IMLs (Intensity
+  Measure Levels) defined for the IMT in the configuration file
+  (`intensity_measure_types_and_levels`). The counts are saved in the
+  htemp.gmf_exceedance_partial table at the end of the task: the ground
+  motion values themselves are not needed, so the GMFs are saved only if
+  `ground_motion_fields = true` as well.
+* When all of the tasks are done, the counts of each logic tree realization
+  and IMT are summed. With these counts, `investigation_time`, and "duration"
   (computed as `investigation_time` * `ses_per_logic_tree_path`), we compute
   the PoEs (Probabilities of Exceedance). See
   :func:`openquake.calculators.hazard.event_based.post_processing.gmvs_to_haz_curve`
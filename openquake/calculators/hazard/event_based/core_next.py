@@ -31,7 +31,10 @@ For more information on computing ground motion fields, see
 :mod:`nhlib.calc.gmf`.
 """
 
+import functools
 import random
+import re
+import tempfile
 
 import nhlib.imt
 import nhlib.source
@@ -41,7 +44,7 @@ from django.db import transaction
 from nhlib import correlation
 from nhlib.calc import filters
 from nhlib.calc import gmf as gmf_calc
-from nhlib.calc import stochastic
+from nhlib.tom import PoissonTOM
 
 from openquake import logs
 from openquake import writer
@@ -54,8 +57,12 @@ from openquake.db.aggregate_result_writer import MeanCurveWriter
 from openquake.db.aggregate_result_writer import QuantileCurveWriter
 from openquake.input import logictree
 from openquake.job.validation import MAX_SINT_32
+from openquake.utils import config
 from openquake.utils import stats
 from openquake.utils import tasks as utils_tasks
+from openquake.utils.general import block_splitter
+from openquake.utils.general import LRUCache
+from openquake.utils.general import str2bool
 
 
 #: Ground motion correlation model map
@@ -67,6 +74,50 @@ GM_CORRELATION_MODEL_MAP = {
 #: hazard calculator.
 DEFAULT_GMF_REALIZATIONS = 1
 
+#: Default memory budget (in MB) of the GMF buffers of a task, if
+#: `gmf_buffer_size` is not set in the [hazard] section of openquake.cfg.
+DEFAULT_GMF_BUFFER_SIZE = 512
+
+#: Initial number of columns (ruptures) of a :class:`GmfBuffer`.
+GMF_BUFFER_INITIAL_CAPACITY = 64
+
+#: Maximum number of ground motion values converted to lists and buffered
+#: by :func:`_save_gmfs` before they are saved to the database.
+GMF_SAVE_BLOCK_SIZE = 10 ** 5
+
+#: Maximum number of rupture occurrence counts (ruptures x stochastic event
+#: sets) sampled at once. See :func:`_sample_ses_ruptures`.
+OCCURRENCE_SAMPLE_SIZE = 10 ** 6
+
+#: Maximum size (in bytes) of the site masks kept by a
+#: :class:`CachedRuptureSiteFilter`.
+RUPTURE_SITE_CACHE_SIZE = 64 * 1024 * 1024
+
+#: Default size (in MB) of the per-process cache of correlation matrix
+#: factors, if `correlation_cache_size` is not set in the [hazard] section of
+#: openquake.cfg.
+DEFAULT_CORRELATION_CACHE_SIZE = 1024
+
+#: File name format of the correlation matrix factors saved in the temporary
+#: directory of a node. See :class:`CachedCorrelationModel`.
+CORRELATION_FILE_FMT = (
+    haz_general.NODE_FILE_PREFIX_FMT + 'correlation-%(imt)s.npy')
+
+#: Per-process cache of the correlation matrix factors, created on demand.
+#: See :func:`_get_correlation_cache`.
+_CORRELATION_CACHE = None
+
+
+def multi_ses_sampling():
+    """
+    Returns `True` if the occurrences of the ruptures in all of the
+    stochastic event sets are sampled at once (see
+    :func:`_sample_ses_ruptures`), `False` if they are sampled one
+    stochastic event set at a time. This is given by the
+    `multi_ses_sampling` parameter in the [hazard] section of openquake.cfg.
+    """
+    return str2bool(config.get('hazard', 'multi_ses_sampling') or 'false')
+
 
 # Disabling pylint for 'Too many local variables'
 # pylint: disable=R0914
@@ -85,6 +136,13 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
     `ground_motion_fields` parameter), GMFs can be computed from each rupture
     in each stochastic event set. GMFs are also saved to the database.
 
+    If `hazard_curves_from_gmfs` is set, the GMFs are computed as well, and
+    the number of ground motion values exceeding each IML is counted while
+    computing them. The counts are saved at the end of the task, as partial
+    results for the hazard curves (see
+    :class:`openquake.calculators.hazard.event_based.post_processing.\
+ExceedanceCounter`).
+
     Once all of this work is complete, a signal will be sent via AMQP to let
     the control noe know that the work is complete. (If there is any work left
     to be dispatched, this signal will indicate to the control node that more
@@ -111,24 +169,28 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
 
     hc = models.HazardCalculation.objects.get(oqjob=job_id)
 
-    cmplt_lt_ses = None
-    if hc.complete_logic_tree_ses:
-        cmplt_lt_ses = models.SES.objects.get(
-            ses_collection__output__oq_job=job_id,
-            complete_logic_tree_ses=True)
-
-    if hc.ground_motion_fields:
+    compute_gmfs = hc.ground_motion_fields or hc.hazard_curves_from_gmfs
+    if compute_gmfs:
         # For ground motion field calculation, we need the points of interest
         # for the calculation.
         points_to_compute = hc.points_to_compute()
 
+        # The fields of all of the IMTs are computed even if they are only
+        # used for the hazard curves, so that the random numbers drawn (and
+        # then the curves) don't depend on `ground_motion_fields`.
         imts = [haz_general.imt_to_nhlib(x)
                 for x in hc.intensity_measure_types]
+        imt_names = dict(zip(imts, hc.intensity_measure_types))
 
         correl_model = None
         if hc.ground_motion_correlation_model is not None:
             correl_model = _get_correl_model(hc)
 
+    exceedance_counter = None
+    if hc.hazard_curves_from_gmfs:
+        exceedance_counter = post_processing.ExceedanceCounter(
+            len(points_to_compute), hc.intensity_measure_types_and_levels)
+
     lt_rlz = models.LtRealization.objects.get(id=lt_rlz_id)
     ltp = logictree.LogicTreeProcessor(hc.id)
 
@@ -144,6 +206,24 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
     site_coll = haz_general.get_site_collection(hc)
     logs.LOG.debug('< done creating site collection')
 
+    # The sources and the sites are the same for all of the stochastic event
+    # sets: filter the sources only once.
+    sources_sites = ((src, site_coll) for src in sources)
+    ssd_filter = filters.source_site_distance_filter(hc.maximum_distance)
+    # Get the filtered sources, ignore the site collection:
+    filtered_sources = [src for src, _ in ssd_filter(sources_sites)]
+    ses_ruptures = None
+    if multi_ses_sampling():
+        # sample the occurrences in all of the stochastic event sets at once
+        ses_ruptures = _sample_ses_ruptures(
+            filtered_sources, hc.investigation_time,
+            hc.ses_per_logic_tree_path)
+    # the ruptures have the same ids in all of the stochastic event sets,
+    # so their site masks are shared
+    rupture_site_filter = CachedRuptureSiteFilter(hc.maximum_distance)
+
+    rupture_writer = SESRuptureWriter()
+
     # Compute stochastic event sets
     # For each rupture generated, we can optionally calculate a GMF
     for ses_rlz_n in xrange(1, hc.ses_per_logic_tree_path + 1):
@@ -156,10 +236,6 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
         ses = models.SES.objects.get(
             ses_collection__lt_realization=lt_rlz, ordinal=ses_rlz_n)
 
-        sources_sites = ((src, site_coll) for src in sources)
-        ssd_filter = filters.source_site_distance_filter(hc.maximum_distance)
-        # Get the filtered sources, ignore the site collection:
-        filtered_sources = (src for src, _ in ssd_filter(sources_sites))
         # Calculate stochastic event sets:
         logs.LOG.debug('> computing stochastic event sets')
         if hc.ground_motion_fields:
@@ -171,25 +247,27 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
             gmf_set = models.GmfSet.objects.get(
                 gmf_collection__lt_realization=lt_rlz, ses_ordinal=ses_rlz_n)
 
-        ses_poissonian = stochastic.stochastic_event_set_poissonian(
-            filtered_sources, hc.investigation_time)
+        if ses_ruptures is not None:
+            ses_poissonian = ses_ruptures[ses_rlz_n - 1]
+        else:
+            # the ruptures are generated again for each stochastic event
+            # set, so that they are not all kept in memory
+            ses_poissonian = _ses_ruptures(
+                filtered_sources, hc.investigation_time)
 
         logs.LOG.debug('> looping over ruptures')
         rupture_ordinal = 0
-        for rupture in ses_poissonian:
+        for rupture_id, rupture in ses_poissonian:
             rupture_ordinal += 1
 
-            # Prepare and save SES ruptures to the db:
-            logs.LOG.debug('> saving SES rupture to DB')
-            _save_ses_rupture(
-                ses, rupture, cmplt_lt_ses, result_grp_ordinal,
-                rupture_ordinal)
-            logs.LOG.debug('> done saving SES rupture to DB')
+            # Buffer the SES rupture; it is saved to the db in bulk
+            rupture_writer.add(
+                ses, rupture, result_grp_ordinal, rupture_ordinal)
 
             # Compute ground motion fields (if requested)
             logs.LOG.debug('compute ground motion fields?  %s'
-                           % hc.ground_motion_fields)
-            if hc.ground_motion_fields:
+                           % compute_gmfs)
+            if compute_gmfs:
                 # Compute and save ground motion fields
 
                 gmf_calc_kwargs = {
@@ -200,20 +278,28 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
                     'truncation_level': hc.truncation_level,
                     'realizations': DEFAULT_GMF_REALIZATIONS,
                     'correlation_model': correl_model,
-                    'rupture_site_filter':
-                        filters.rupture_site_distance_filter(
-                            hc.maximum_distance),
                 }
                 logs.LOG.debug('> computing ground motion fields')
-                gmf_dict = gmf_calc.ground_motion_fields(**gmf_calc_kwargs)
+                gmf_dict = _ground_motion_fields(
+                    rupture_site_filter.bind(rupture_id), **gmf_calc_kwargs)
                 logs.LOG.debug('< done computing ground motion fields')
 
                 # update the gmf cache:
-                for k, v in gmf_dict.iteritems():
-                    gmf_cache[k] = numpy.append(
-                        gmf_cache[k], v, axis=1)
+                if hc.ground_motion_fields:
+                    for k, v in gmf_dict.iteritems():
+                        gmf_cache[k].append(v)
+
+                # count the exceedances for the hazard curves:
+                if exceedance_counter is not None:
+                    for k, v in gmf_dict.iteritems():
+                        imt = imt_names[k]
+                        if imt in exceedance_counter.imls:
+                            exceedance_counter.add(imt, v)
 
         logs.LOG.debug('< Done looping over ruptures')
+        logs.LOG.debug('> saving SES ruptures to DB')
+        rupture_writer.flush()
+        logs.LOG.debug('< done saving SES ruptures to DB')
         logs.LOG.debug('%s ruptures computed for SES realization %s of %s'
                        % (rupture_ordinal, ses_rlz_n,
                           hc.ses_per_logic_tree_path))
@@ -226,28 +312,271 @@ def ses_and_gmfs(job_id, src_ids, lt_rlz_id, task_seed, result_grp_ordinal):
             _save_gmfs(
                 gmf_set, gmf_cache, points_to_compute, result_grp_ordinal)
             logs.LOG.debug('< done saving GMF results to DB')
+            for gmf_buffer in gmf_cache.itervalues():
+                gmf_buffer.close()
+
+    if exceedance_counter is not None:
+        logs.LOG.debug('> saving GMF exceedance counts to DB')
+        exceedance_counter.save(lt_rlz_id)
+        logs.LOG.debug('< done saving GMF exceedance counts to DB')
 
     logs.LOG.debug('< task complete, signalling completion')
     haz_general.signal_task_complete(job_id, len(src_ids))
 
 
+class GmfBuffer(object):
+    """
+    Growable (sites x ruptures) matrix of ground motion values, filled one
+    rupture (i.e. one or more columns) at a time.
+
+    The capacity is doubled when the matrix is full, so that the cost of
+    appending columns is amortized constant. When the size of the matrix
+    would exceed `max_bytes`, the data are moved to a memory-mapped
+    temporary file, so that the memory usage stays bounded.
+
+    :param int n_sites:
+        The number of rows of the matrix.
+    :param int max_bytes:
+        The maximum size (in bytes) of the matrix kept in memory.
+    :param int capacity:
+        The initial number of columns of the matrix.
+    """
+
+    def __init__(self, n_sites, max_bytes,
+                 capacity=GMF_BUFFER_INITIAL_CAPACITY):
+        self.n_sites = n_sites
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._file = None
+        self._data = self._allocate(capacity)
+
+    @property
+    def capacity(self):
+        """
+        The number of columns which can be stored without growing.
+        """
+        return self._data.shape[1]
+
+    @property
+    def is_memmap(self):
+        """
+        True if the data are stored in a memory-mapped temporary file.
+        """
+        return self._file is not None
+
+    @property
+    def array(self):
+        """
+        A (n_sites, size) view of the values appended so far.
+        """
+        return self._data[:, :self.size]
+
+    def _allocate(self, capacity):
+        """
+        Allocate a (n_sites, capacity) matrix, in memory or in a new
+        memory-mapped temporary file depending on its size.
+        """
+        nbytes = self.n_sites * capacity * numpy.dtype(float).itemsize
+        if nbytes <= self.max_bytes or nbytes == 0:
+            return numpy.empty((self.n_sites, capacity))
+
+        self._file = tempfile.TemporaryFile(prefix='oq-gmf-')
+        return numpy.memmap(self._file, dtype=float, mode='w+',
+                            shape=(self.n_sites, capacity))
+
+    def append(self, values):
+        """
+        Append the ground motion values of one or more ruptures.
+
+        :param values:
+            A (n_sites, n) matrix-like object (e.g., the values of a dict
+            returned by :func:`nhlib.calc.gmf.ground_motion_fields`).
+        """
+        values = numpy.asarray(values)
+        n = values.shape[1]
+        if self.size + n > self.capacity:
+            old_data, old_file = self._data, self._file
+            self._data = self._allocate(max(2 * self.capacity, self.size + n))
+            self._data[:, :self.size] = old_data[:, :self.size]
+            if old_file is not None and old_file is not self._file:
+                del old_data
+                old_file.close()
+        self._data[:, self.size:self.size + n] = values
+        self.size += n
+
+    def close(self):
+        """
+        Release the data, removing the temporary file (if any).
+        """
+        self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _iter_ruptures(sources, tom):
+    """
+    Generate the ruptures of the given sources, with their ids.
+
+    The id of a rupture is the pair `(source index, rupture index in the
+    source)`: the ruptures of a source are always generated in the same
+    order, so the same id is given to the same rupture each time the
+    ruptures are generated.
+
+    :param sources:
+        A sequence of nhlib seismic sources.
+    :param tom:
+        A :class:`nhlib.tom.PoissonTOM`.
+    :returns:
+        An iterator of pairs `(rupture_id, rupture)`.
+    """
+    for src_idx, src in enumerate(sources):
+        for rup_idx, rupture in enumerate(src.iter_ruptures(tom)):
+            yield (src_idx, rup_idx), rupture
+
+
+def _ses_ruptures(sources, investigation_time):
+    """
+    Generate the ruptures of a stochastic event set, like
+    :func:`nhlib.calc.stochastic.stochastic_event_set_poissonian`, with
+    their ids (see :func:`_iter_ruptures`).
+
+    :param sources:
+        A sequence of nhlib seismic sources.
+    :param float investigation_time:
+        The time span of the stochastic event set, in years.
+    :returns:
+        An iterator of pairs `(rupture_id, rupture)`, each rupture
+        repeated as many times as it occurs.
+    """
+    tom = PoissonTOM(investigation_time)
+    for rupture_id, rupture in _iter_ruptures(sources, tom):
+        for _ in xrange(rupture.sample_number_of_occurrences()):
+            yield rupture_id, rupture
+
+
+def _sample_ses_ruptures(sources, investigation_time, num_ses):
+    """
+    Generate the ruptures of the given sources (only once) and sample their
+    occurrences in `num_ses` stochastic event sets.
+
+    The number of occurrences of a block of ruptures in all of the stochastic
+    event sets is drawn with a single Poisson sample; only the ruptures which
+    occur at least once are kept in memory.
+
+    :param sources:
+        A sequence of nhlib seismic sources.
+    :param float investigation_time:
+        The time span of each stochastic event set, in years.
+    :param int num_ses:
+        The number of stochastic event sets.
+    :returns:
+        A list of `num_ses` lists: each one contains the pairs
+        `(rupture_id, rupture)` of a stochastic event set (see
+        :func:`_ses_ruptures`), in the order of generation, each rupture
+        repeated as many times as it occurs.
+    """
+    tom = PoissonTOM(investigation_time)
+    ruptures = _iter_ruptures(sources, tom)
+    # limit the size of the matrix of occurrences of a block
+    block_size = max(1, OCCURRENCE_SAMPLE_SIZE // num_ses)
+
+    ses_ruptures = [[] for _ in xrange(num_ses)]
+    for block in block_splitter(ruptures, block_size):
+        rates = numpy.array(
+            [rupture.occurrence_rate for _, rupture in block])
+        # ruptures x stochastic event sets
+        occurrences = numpy.random.poisson(
+            rates[:, None] * investigation_time, (len(block), num_ses))
+
+        # `nonzero` is ordered by rupture, so the order of generation is
+        # preserved in each stochastic event set
+        for i, j in zip(*numpy.nonzero(occurrences)):
+            ses_ruptures[j].extend([block[i]] * occurrences[i, j])
+
+    return ses_ruptures
+
+
+class CachedRuptureSiteFilter(object):
+    """
+    Rupture-site distance filter (see
+    :func:`nhlib.calc.filters.rupture_site_distance_filter`) which keeps the
+    mask of the sites of each rupture, so that the distances are computed
+    only once for the ruptures occurring many times (in the same stochastic
+    event set or in different ones).
+
+    The masks are kept in a :class:`openquake.utils.general.LRUCache` of
+    :data:`RUPTURE_SITE_CACHE_SIZE` bytes, keyed by rupture id (see
+    :func:`_iter_ruptures`): the ruptures are generated again for each
+    stochastic event set, unless :func:`multi_ses_sampling` is on, but they
+    keep their ids. The filter must always be used with the same sources
+    and site collection.
+
+    :param float integration_distance:
+        Threshold distance in km.
+    """
+
+    def __init__(self, integration_distance):
+        self.integration_distance = integration_distance
+        self.cache = LRUCache(RUPTURE_SITE_CACHE_SIZE)
+
+    def bind(self, rupture_id):
+        """
+        Return a rupture-site filter (see
+        :func:`nhlib.calc.filters.rupture_site_distance_filter`) for the
+        rupture with the given id, which uses the cached mask.
+        """
+        return functools.partial(self.filter, rupture_id)
+
+    def filter(self, rupture_id, ruptures_sites):
+        """
+        Filter the sites of the rupture with the given id, yielding pairs
+        `(rupture, filtered_sites)` if at least one site is within the
+        integration distance.
+
+        :param rupture_id:
+            The id of the rupture (see :func:`_iter_ruptures`).
+        :param ruptures_sites:
+            An iterator of pairs `(rupture, sites)`, all for the same
+            rupture.
+        """
+        for rupture, sites in ruptures_sites:
+            mask = self.cache.get(rupture_id)
+            if mask is None:
+                jb_dist = rupture.surface.get_joyner_boore_distance(
+                    sites.mesh)
+                mask = jb_dist <= self.integration_distance
+                self.cache.put(rupture_id, mask, mask.nbytes)
+
+            # `filter` returns None if no site is in the mask
+            rupture_sites = sites.filter(mask)
+            if rupture_sites is not None:
+                yield rupture, rupture_sites
+
+
 def _create_gmf_cache(n_sites, imts):
     """
     Create a `dict` to cache GMF data during the course of a computation.
 
     The `dict` is keyed by IMTs (which are IMT objects from :mod:`nhlib.imt`).
-    Each value is initialized to a numpy array with a shape of (n, 0), where n
-    is `n_sites`.
+    Each value is an empty :class:`GmfBuffer` with `n_sites` rows. The
+    memory budget of the buffers (in MB) is given by the `gmf_buffer_size`
+    parameter in the [hazard] section of openquake.cfg, and it is shared
+    among the IMTs.
 
     :param int n_sites:
         The number of sites in the calculation.
     :param imts:
         A `list` or other sequence of :mod:`nhlib.imt` IMT objects.
     """
+    size = config.get('hazard', 'gmf_buffer_size')
+    size = int(size) if size else DEFAULT_GMF_BUFFER_SIZE
+    max_bytes = size * 1024 * 1024 // max(len(imts), 1)
+
     cache = dict()
 
     for imt in imts:
-        cache[imt] = numpy.empty((n_sites, 0))
+        cache[imt] = GmfBuffer(n_sites, max_bytes)
 
     return cache
 
@@ -260,7 +589,8 @@ def _get_correl_model(hc):
         A :class:`openquake.db.models.HazardCalculation` instance.
 
     :returns:
-        A correlation object. See :mod:`nhlib.correlation` for more info.
+        A :class:`CachedCorrelationModel` wrapping the correlation object.
+        See :mod:`nhlib.correlation` for more info.
     """
     correl_model_cls = getattr(
         correlation,
@@ -270,30 +600,192 @@ def _get_correl_model(hc):
         # There's no correlation model for this calculation.
         return None
 
-    return correl_model_cls(**hc.ground_motion_correlation_params)
+    return CachedCorrelationModel(
+        correl_model_cls(**hc.ground_motion_correlation_params), hc.id)
 
 
-def _save_ses_rupture(ses, rupture, complete_logic_tree_ses,
-                      result_grp_ordinal, rupture_ordinal):
+def _get_correlation_cache():
+    """
+    Get the per-process cache of correlation matrix factors, creating it if
+    needed. The size of the cache is given (in MB) by the
+    `correlation_cache_size` parameter in the [hazard] section of
+    openquake.cfg.
+
+    :returns:
+        A :class:`openquake.utils.general.LRUCache`.
     """
-    Helper function for saving stochastic event set ruptures to the database.
+    global _CORRELATION_CACHE
+    if _CORRELATION_CACHE is None:
+        size = config.get('hazard', 'correlation_cache_size')
+        size = int(size) if size else DEFAULT_CORRELATION_CACHE_SIZE
+        _CORRELATION_CACHE = LRUCache(size * 1024 * 1024)
+    return _CORRELATION_CACHE
+
+
+class CachedCorrelationModel(object):
+    """
+    Wrapper of an nhlib correlation model, which computes the lower
+    triangle (Cholesky) factor of the correlation matrix of the complete site
+    collection of a calculation only once per IMT, and reuses it for every
+    rupture.
+
+    The factors are kept in a per-process LRU cache (see
+    :func:`_get_correlation_cache`). If `correlation_factor_storage` is set
+    to `file` in the [hazard] section of openquake.cfg, they are also saved
+    in the temporary directory of the node and memory-mapped, so that all of
+    the worker processes on a node share a single copy (see
+    :func:`clear_correlation_cache`).
+
+    The factors for subsets of the sites (e.g., the sites close to a
+    rupture) are computed by the wrapped model and not cached. See
+    :meth:`can_cache`.
+
+    :param correl_model:
+        An nhlib correlation model object.
+    :param int hc_id:
+        ID of the :class:`openquake.db.models.HazardCalculation`.
+    """
+
+    def __init__(self, correl_model, hc_id):
+        self.correl_model = correl_model
+        self.hc_id = hc_id
+
+    def can_cache(self, sites, imts):
+        """
+        Returns `True` if the factors of the complete site collection for
+        all of the given IMTs are saved in the node-local files, or if they
+        all fit in the per-process cache. Otherwise, each of them would be
+        computed again for every rupture.
+
+        :param sites:
+            The :class:`nhlib.site.SiteCollection` of the calculation.
+        :param imts:
+            A sequence of nhlib IMT objects.
+        """
+        if config.get('hazard', 'correlation_factor_storage') == 'file':
+            return True
+
+        num_sites = len(sites.vs30)
+        factors_size = (len(imts) * num_sites ** 2
+                        * numpy.dtype(float).itemsize)
+        return factors_size <= _get_correlation_cache().max_size
+
+    def _compute_factor(self, sites, imt):
+        """
+        Compute the factor, or load it from the node-local file.
+        """
+        def compute():
+            return self.correl_model.get_lower_triangle_correlation_matrix(
+                sites, imt)
+
+        if config.get('hazard', 'correlation_factor_storage') != 'file':
+            return compute()
+
+        file_name = CORRELATION_FILE_FMT % dict(
+            hc_id=self.hc_id, imt=re.sub(r'\W+', '_', str(imt)))
+        return haz_general.load_node_array(self.hc_id, file_name, compute)
+
+    def get_lower_triangle_correlation_matrix(self, sites, imt):
+        """
+        Get the lower triangle factor of the correlation matrix of the
+        given sites for the given IMT.
+
+        :param sites:
+            An :class:`nhlib.site.SiteCollection` instance.
+        :param imt:
+            An nhlib IMT object.
+        """
+        if getattr(sites, 'indices', None) is not None:
+            # a subset of the sites of the calculation
+            return self.correl_model.get_lower_triangle_correlation_matrix(
+                sites, imt)
+
+        cache = _get_correlation_cache()
+        key = (self.hc_id, str(imt))
+        factor = cache.get(key)
+        if factor is None:
+            factor = self._compute_factor(sites, imt)
+            cache.put(key, factor, factor.nbytes)
+        return factor
+
+
+def clear_correlation_cache(hc_id):
+    """
+    Drop the cached correlation matrix factors and remove the files of the
+    given calculation from the temporary directory of this node.
+
+    :param int hc_id:
+        ID of a :class:`~openquake.db.models.HazardCalculation`.
+    """
+    if _CORRELATION_CACHE is not None:
+        _CORRELATION_CACHE.clear()
+
+    haz_general.remove_node_files(
+        CORRELATION_FILE_FMT % dict(hc_id=hc_id, imt='*'))
+
+
+def _ground_motion_fields(rupture_site_filter, **kwargs):
+    """
+    Compute the ground motion fields of a rupture (see
+    :func:`nhlib.calc.gmf.ground_motion_fields`), with the given
+    rupture-site filter.
+
+    With a correlation model whose factors can be cached (see
+    :meth:`CachedCorrelationModel.can_cache`), the fields are computed on the
+    complete site collection, so that the cached factor of the correlation
+    matrix can be used; the values for the sites filtered out by
+    `rupture_site_filter` are then set to zero, as nhlib does. The residuals
+    of the sites close to the rupture are drawn from the same (correlated)
+    distribution. Otherwise, the fields are computed by nhlib on the
+    filtered sites only.
+
+    :param rupture_site_filter:
+        A rupture-site filter (see :meth:`CachedRuptureSiteFilter.bind`).
+    :param kwargs:
+        The other arguments of :func:`nhlib.calc.gmf.ground_motion_fields`.
+    :returns:
+        A dict of (sites x realizations) arrays keyed by IMT.
+    """
+    correl_model = kwargs['correlation_model']
+    if (correl_model is None
+            or not correl_model.can_cache(kwargs['sites'], kwargs['imts'])):
+        return gmf_calc.ground_motion_fields(
+            rupture_site_filter=rupture_site_filter, **kwargs)
+
+    sites = kwargs['sites']
+    num_sites = len(sites.vs30)
+    ruptures_sites = list(rupture_site_filter([(kwargs['rupture'], sites)]))
+    if not ruptures_sites:
+        # no site is close enough to the rupture
+        return dict((imt, numpy.zeros((num_sites, kwargs['realizations'])))
+                    for imt in kwargs['imts'])
+    [(_, rupture_sites)] = ruptures_sites
+
+    gmf_dict = gmf_calc.ground_motion_fields(
+        rupture_site_filter=filters.rupture_site_noop_filter, **kwargs)
+
+    if getattr(rupture_sites, 'indices', None) is not None:
+        far = numpy.ones(num_sites, dtype=bool)
+        far[rupture_sites.indices] = False
+        for imt in gmf_dict:
+            gmfs = numpy.array(gmf_dict[imt])
+            gmfs[far] = 0
+            gmf_dict[imt] = gmfs
+    return gmf_dict
+
+
+def _rupture_geometry(rupture):
+    """
+    Extract the geometry of a rupture in the form stored in
+    :class:`openquake.db.models.SESRupture` records.
 
-    :param ses:
-        A :class:`openquake.db.models.SES` instance. This will be DB
-        'container' for the new rupture record.
     :param rupture:
         A :class:`nhlib.source.rupture.Rupture` instance.
-    :param complete_logic_tree_ses:
-        :class:`openquake.db.models.SES` representing the `complete logic tree`
-        stochastic event set.
-        If not None, save a copy of the input `rupture` to this SES.
-    :param int result_grp_ordinal:
-        The result group in which the calculation results will be placed.
-        This ID basically corresponds to the sequence number of the task,
-        in the context of the entire calculation.
-    :param int rupture_ordinal:
-        The ordinal of a rupture with a given result group (inidicated by
-        ``result_grp_ordinal``).
+    :returns:
+        A tuple `(is_from_fault_source, lons, lats, depths)`. For ruptures
+        generated by simple and complex fault sources the coordinates are the
+        2D arrays of the surface mesh; otherwise they are the 4 corners of the
+        planar surface.
     """
     is_from_fault_source = rupture.source_typology in (
         nhlib.source.ComplexFaultSource,
@@ -325,25 +817,54 @@ def _save_ses_rupture(ses, rupture, complete_logic_tree_ses,
             lats[i] = corner.latitude
             depths[i] = corner.depth
 
-    # TODO: Possible future optimiztion:
-    # Refactor this to do bulk insertion of ruptures
-    models.SESRupture.objects.create(
-        ses=ses,
-        magnitude=rupture.mag,
-        strike=rupture.surface.get_strike(),
-        dip=rupture.surface.get_dip(),
-        rake=rupture.rake,
-        tectonic_region_type=rupture.tectonic_region_type,
-        is_from_fault_source=is_from_fault_source,
-        lons=lons,
-        lats=lats,
-        depths=depths,
-        result_grp_ordinal=result_grp_ordinal,
-        rupture_ordinal=rupture_ordinal,
-    )
-    if complete_logic_tree_ses is not None:
-        models.SESRupture.objects.create(
-            ses=complete_logic_tree_ses,
+    return is_from_fault_source, lons, lats, depths
+
+
+class SESRuptureWriter(object):
+    """
+    Buffer stochastic event set ruptures and save them to the database in
+    bulk, using a :class:`openquake.writer.BulkInserter` (`COPY`).
+
+    The buffer is flushed when its estimated size exceeds `max_bytes`; the
+    task also flushes it at the end of each stochastic event set.
+
+    Ruptures are saved only once, in the SES of their logic tree
+    realization: the `complete logic tree` SES references them (see
+    :meth:`openquake.db.models.SES.get_ruptures`).
+
+    :param int max_bytes:
+        Estimated size of the buffered data (in bytes) triggering a flush.
+    """
+
+    #: Estimated size (in bytes) of the scalar columns of a rupture
+    ROW_OVERHEAD = 256
+
+    def __init__(self, max_bytes=writer.COPY_CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self.inserter = writer.BulkInserter(models.SESRupture)
+        self.nbytes = 0
+
+    def add(self, ses, rupture, result_grp_ordinal, rupture_ordinal):
+        """
+        Buffer a rupture, flushing the buffer if it is full.
+
+        :param ses:
+            A :class:`openquake.db.models.SES` instance. This will be DB
+            'container' for the new rupture record.
+        :param rupture:
+            A :class:`nhlib.source.rupture.Rupture` instance.
+        :param int result_grp_ordinal:
+            The result group in which the calculation results will be placed.
+            This ID basically corresponds to the sequence number of the task,
+            in the context of the entire calculation.
+        :param int rupture_ordinal:
+            The ordinal of a rupture with a given result group (inidicated by
+            ``result_grp_ordinal``).
+        """
+        is_from_fault_source, lons, lats, depths = _rupture_geometry(rupture)
+
+        self.inserter.add_entry(
+            ses_id=ses.id,
             magnitude=rupture.mag,
             strike=rupture.surface.get_strike(),
             dip=rupture.surface.get_dip(),
@@ -356,6 +877,20 @@ def _save_ses_rupture(ses, rupture, complete_logic_tree_ses,
             result_grp_ordinal=result_grp_ordinal,
             rupture_ordinal=rupture_ordinal,
         )
+        # the pickled arrays are sent hex-encoded
+        self.nbytes += (2 * (lons.nbytes + lats.nbytes + depths.nbytes)
+                        + self.ROW_OVERHEAD)
+
+        if self.nbytes >= self.max_bytes:
+            self.flush()
+
+    @transaction.commit_on_success(using='reslt_writer')
+    def flush(self):
+        """
+        Save the buffered ruptures to the database.
+        """
+        self.inserter.flush()
+        self.nbytes = 0
 
 
 @transaction.commit_on_success(using='reslt_writer')
@@ -377,15 +912,16 @@ def _save_gmfs(gmf_set, gmf_dict, points_to_compute, result_grp_ordinal):
 
         A calculation consists of N tasks, so this tells us which task computed
         the data.
+
+    The records are saved a block of sites at a time (of about
+    :data:`GMF_SAVE_BLOCK_SIZE` ground motion values), so that only a block
+    of the GMFs is converted to lists at any time.
     """
     inserter = writer.BulkInserter(models.Gmf)
 
-    for imt, gmfs in gmf_dict.iteritems():
-
-        # ``gmfs`` comes in as a numpy.matrix
-        # we want it is an array; it handles subscripting
-        # in the way that we want
-        gmfs = numpy.array(gmfs)
+    for imt, gmf_buffer in gmf_dict.iteritems():
+        gmfs = gmf_buffer.array
+        block_size = max(1, GMF_SAVE_BLOCK_SIZE // max(gmfs.shape[1], 1))
 
         sa_period = None
         sa_damping = None
@@ -404,6 +940,8 @@ def _save_gmfs(gmf_set, gmf_dict, points_to_compute, result_grp_ordinal):
                 gmvs=gmfs[i].tolist(),
                 result_grp_ordinal=result_grp_ordinal,
             )
+            if inserter.count >= block_size:
+                inserter.flush()
 
     inserter.flush()
 
@@ -441,6 +979,9 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
 
     core_calc_task = ses_and_gmfs
 
+    # See :meth:`resume`.
+    resumable = False
+
     def task_arg_gen(self, block_size):
         """
         Loop through realizations and sources to generate a sequence of
@@ -451,8 +992,10 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
         numpy for temporal occurence sampling.)
 
         :param int block_size:
-            The (max) number of work items for each task. In this case,
-            sources.
+            The average number of work items for each task. In this case,
+            sources. Sources are packed into tasks according to their weight;
+            see :meth:`~openquake.calculators.hazard.general.\
+BaseHazardCalculatorNext.source_blocks`.
         """
         rnd = random.Random()
         rnd.seed(self.hc.random_seed)
@@ -462,20 +1005,17 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
 
         result_grp_ordinal = 1
         for lt_rlz in realizations:
-            source_progress = models.SourceProgress.objects.filter(
-                    is_complete=False, lt_realization=lt_rlz).order_by('id')
-            source_ids = source_progress.values_list('parsed_source_id',
-                                                     flat=True)
-            self.progress['total'] += len(source_ids)
+            blocks = self.source_blocks(lt_rlz, block_size)
+            self.progress['total'] += sum(len(block) for block in blocks)
 
-            for offset in xrange(0, len(source_ids), block_size):
+            for source_ids in blocks:
                 # Since this seed will used for numpy random seeding, it needs
                 # to be positive (since numpy will convert it to a unsigned
                 # long).
                 task_seed = rnd.randint(0, MAX_SINT_32)
                 task_args = (
                     self.job.id,
-                    source_ids[offset:offset + block_size],
+                    source_ids,
                     lt_rlz.id,
                     task_seed,
                     result_grp_ordinal
@@ -515,9 +1055,9 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
         stochastic event set (containing all ruptures from all realizations),
         initialize DB records for those results here.
 
-        Throughout the course of the calculation, computed ruptures will be
-        copied into this collection. See :func:`_save_ses_rupture` for more
-        info.
+        No rupture is copied into this collection: the `complete logic tree`
+        SES references the ruptures of all of the other SESs. See
+        :meth:`openquake.db.models.SES.get_ruptures` for more info.
         """
         # `complete logic tree` SES
         clt_ses_output = models.Output.objects.create(
@@ -647,10 +1187,24 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
         if self.job.hazard_calculation.complete_logic_tree_gmf:
             self.initialize_complete_lt_gmf_db_records()
 
+        # Estimate the cost of each source, so that the work can be evenly
+        # distributed among the tasks.
+        self.initialize_source_weights()
+
         self.initialize_pr_data()
 
         self.record_init_stats()
 
+    def resume(self):
+        """
+        Event-based calculations cannot be resumed: the random seeds and the
+        result group ordinals of the tasks are drawn in sequence for the
+        whole calculation, so skipping the work completed by a previous run
+        would change them.
+        """
+        raise NotImplementedError(
+            'Event-based calculations cannot be resumed')
+
     def post_process(self):
         """
         If requested, perform additional processing of GMFs to produce hazard
@@ -677,3 +1231,14 @@ class EventBasedHazardCalculator(haz_general.BaseHazardCalculatorNext):
                         tf_args=dict(job_id=self.job.id))
 
         logs.LOG.debug('< done with post processing')
+
+    def clean_up(self):
+        """
+        Remove the factors of the ground motion correlation matrices saved in
+        the temporary directory of this node (see
+        :class:`CachedCorrelationModel`), and the site data of the
+        calculation (see :meth:`openquake.calculators.hazard.general.\
+BaseHazardCalculatorNext.clean_up`).
+        """
+        clear_correlation_cache(self.hc.id)
+        super(EventBasedHazardCalculator, self).clean_up()
@@ -16,36 +16,32 @@
 """
 GMFs to Hazard Curves
 
-For each IMT, logic tree path, and point of interest, the number of GMF records
-will be equal to the `ses_per_logic_tree_path`. The data contained in these
-records can include ground motion values from many ruptures, stored in
-variable length arrays; the quantity is random.
-
-For post-processing, we will need to perform P * R * M queries to the database,
-where P is the number of points in a given calculation, R is the total number
-of tree paths, and M is the number of intensity measure levels defined for the
-hazard curve processing. Each of these queries will give us all of the data we
-need to compute a single hazard curve.
-
-Typical values for P can go from 1 to a few 100,000s. *
-Typical values for R can from 1 few 1,000s. *
-Typical values for M are about 10.
-
-* Considering maximum for both P and R is an extreme case.
-
-P * R * M = 100,000 * 1,000 * 10 = 1 Billion queries, in the extreme case
-
-This could be the target for future optimizations.
+The hazard curve of a site, for a logic tree realization and an IMT, only
+depends on the number of ground motion values exceeding each IML (see
+:func:`gmvs_to_haz_curve`).
+
+The ground motion values are then not read back from the database: each
+event-based task counts the exceedances while computing the GMFs (see
+:class:`ExceedanceCounter`) and saves them as partial results, one
+:class:`openquake.db.models.GmfExceedancePartial` record (a sites x IMLs
+matrix of integers) per IMT. When the core calculation is done, the partial
+counts of each realization and IMT are summed and converted to hazard curves
+by a task (see :func:`do_post_process`).
+
+The memory and the storage needed are proportional to the number of sites and
+IMLs, whatever the number of ruptures: the GMFs themselves are saved only if
+`ground_motion_fields` is set.
 """
 
-import itertools
 import math
 
 import numpy
 
 from celery.task.sets import TaskSet
+from django.db import transaction
 
 from openquake import logs
+from openquake import writer
 from openquake.db import models
 from openquake.utils import config
 from openquake.utils import tasks as utils_tasks
@@ -55,6 +51,82 @@ from openquake.utils.general import block_splitter
 HAZ_CURVE_DISP_NAME_FMT = 'hazard-curve-rlz-%(rlz)s-%(imt)s'
 
 
+class ExceedanceCounter(object):
+    """
+    Count, for each site and IMT, the number of ground motion values
+    exceeding each IML, one ground motion field at a time.
+
+    :param int n_sites:
+        The number of sites of the calculation.
+    :param imts_and_levels:
+        A dict of lists of IMLs keyed by IMT strings, like
+        `intensity_measure_types_and_levels`.
+    """
+
+    def __init__(self, n_sites, imts_and_levels):
+        self.imls = {}
+        self.num_exceeding = {}
+        for imt, imls in imts_and_levels.iteritems():
+            self.imls[imt] = numpy.array(imls, dtype=float)
+            self.num_exceeding[imt] = numpy.zeros(
+                (n_sites, len(imls)), dtype=int)
+
+    def add(self, imt, gmfs):
+        """
+        Count the exceedances of ground motion fields.
+
+        :param str imt:
+            An IMT string (for instance 'PGA' or 'SA(0.1)').
+        :param gmfs:
+            A 2D array (sites x realizations) of ground motion values.
+        """
+        gmfs = numpy.asarray(gmfs)
+        num_exceeding = self.num_exceeding[imt]
+        for j, iml in enumerate(self.imls[imt]):
+            num_exceeding[:, j] += (gmfs >= iml).sum(axis=1)
+
+    @transaction.commit_on_success(using='reslt_writer')
+    def save(self, lt_rlz_id):
+        """
+        Save the counts of all of the IMTs, as
+        :class:`openquake.db.models.GmfExceedancePartial` records.
+
+        :param int lt_rlz_id:
+            ID of the :class:`openquake.db.models.LtRealization` of the
+            ground motion fields.
+        """
+        for imt, num_exceeding in self.num_exceeding.iteritems():
+            models.GmfExceedancePartial.objects.create(
+                lt_realization_id=lt_rlz_id, imt=imt,
+                num_exceeding=num_exceeding)
+
+
+def sum_exceedances(lt_rlz_id, imt, n_sites, n_imls):
+    """
+    Sum the partial exceedance counts saved by the tasks for a given
+    realization and IMT. The partial matrices are loaded one at a time.
+
+    :param int lt_rlz_id:
+        ID of a :class:`openquake.db.models.LtRealization`.
+    :param str imt:
+        An IMT string (for instance 'PGA' or 'SA(0.1)').
+    :param int n_sites:
+        The number of sites of the calculation.
+    :param int n_imls:
+        The number of IMLs of `imt`.
+    :returns:
+        2D numpy array (sites x IMLs) of integers.
+    """
+    num_exceeding = numpy.zeros((n_sites, n_imls), dtype=int)
+
+    partials = models.GmfExceedancePartial.objects.filter(
+        lt_realization=lt_rlz_id, imt=imt)
+    for partial in partials.iterator():
+        num_exceeding += partial.num_exceeding
+
+    return num_exceeding
+
+
 def gmf_post_process_arg_gen(job):
     """
     Generate a sequence of args for the GMF to hazard curve post-processing job
@@ -63,15 +135,12 @@ def gmf_post_process_arg_gen(job):
     Yielded arguments are as follows:
 
     * job ID
-    * point geometry
     * logic tree realization ID
-    * IMT
+    * IMT string
     * IMLs
     * hazard curve "collection" ID
     * investigation time
     * duration
-    * SA period
-    * SA damping
 
     See :func:`gmf_to_hazard_curve_task` for more information about these
     arguments.
@@ -83,7 +152,6 @@ def gmf_post_process_arg_gen(job):
         :class:`openquake.db.models.OqJob` instance.
     """
     hc = job.hazard_calculation
-    points = hc.points_to_compute()
 
     lt_realizations = models.LtRealization.objects.filter(
         hazard_calculation=hc.id)
@@ -110,77 +178,59 @@ def gmf_post_process_arg_gen(job):
                 sa_period=sa_period,
                 sa_damping=sa_damping)
 
-            for point in points:
-                yield (job.id, point, lt_rlz.id, imt, imls, hc_coll.id,
-                       invest_time, duration, sa_period, sa_damping)
+            yield (job.id, lt_rlz.id, raw_imt, imls, hc_coll.id,
+                   invest_time, duration)
 
 
-# Disabling "Unused argument 'job_id'" (this parameter is required by @oqtask):
-# pylint: disable=W0613
 @utils_tasks.oqtask
-def gmf_to_hazard_curve_task(job_id, point, lt_rlz_id, imt, imls, hc_coll_id,
-                             invest_time, duration, sa_period=None,
-                             sa_damping=None):
+def gmf_to_hazard_curve_task(job_id, lt_rlz_id, raw_imt, imls, hc_coll_id,
+                             invest_time, duration):
     """
-    For a given job, point, realization, and IMT, compute a hazard curve and
-    save it to the database. The hazard curve will be computed from all
-    available ground motion data for the specified point and realization.
+    For a given job, realization, and IMT, compute the hazard curves of all
+    of the sites from the partial exceedance counts (see
+    :func:`sum_exceedances`) and save them to the database.
 
     :param int job_id:
         ID of a currently running :class:`openquake.db.models.OqJob`.
-    :param point:
-        A :class:`nhlib.geo.point.Point` instance.
     :param int lt_rlz_id:
         ID of a :class:`openquake.db.models.LtRealization` for the current
         calculation.
-    :param str imt:
-        Intensity Measure Type (PGA, SA, PGV, etc.)
+    :param str raw_imt:
+        An IMT string (for instance 'PGA' or 'SA(0.1)').
     :param imls:
         List of Intensity Measure Levels. These will serve as the abscissae for
-        the computed hazard curve.
+        the computed hazard curves.
     :param int hc_coll_id:
         ID of a :class:`openquake.db.models.HazardCurve`, which will be the
-        'container' for the computed hazard curve.
+        'container' for the computed hazard curves.
     :param float invest_time:
-        Investigation time, in years. It is with this time span that we compute
-        probabilities of exceedance.
-
-        Another way to put it is the following. When computing a hazard curve,
-        we want to answer the question: What is the probability of ground
-        motion meeting or exceeding the specified levels (``imls``) in a given
-        time span (``invest_time``).
+        Investigation time, in years. See :func:`gmvs_to_haz_curve`.
     :param float duration:
-        Time window during which GMFs occur. Another was to say it is, the
-        period of time over which we simulate ground motion occurrences.
-
-        NOTE: Duration is computed as the calculation investigation time
-        multiplied by the number of stochastic event sets.
-    :param float sa_period:
-        Spectral Acceleration period. Used only with ``imt`` of 'SA'.
-    :param float sa_damping:
-        Spectral Acceleration damping. Used only with ``imt`` of 'SA'.
+        Time window during which GMFs occur. See :func:`gmvs_to_haz_curve`.
     """
-    gmfs = models.Gmf.objects.filter(
-        gmf_set__gmf_collection__lt_realization=lt_rlz_id,
-        imt=imt,
-        sa_period=sa_period,
-        sa_damping=sa_damping,
-        location=point.wkt2d)
-
-    # Collect all of the ground motion values:
-    gmvs = list(itertools.chain(*(g.gmvs for g in gmfs)))
-    # Compute the hazard curve PoEs:
-    hc_poes = gmvs_to_haz_curve(gmvs, imls, invest_time, duration)
+    hc = models.HazardCalculation.objects.get(oqjob=job_id)
+    points = hc.points_to_compute()
+
+    num_exceeding = sum_exceedances(lt_rlz_id, raw_imt, len(points), len(imls))
+    poes = exceedances_to_poes(num_exceeding, invest_time, duration)
+
+    inserter = writer.BulkInserter(models.HazardCurveData)
+    for point, hc_poes in zip(points, poes):
+        inserter.add_entry(hazard_curve_id=hc_coll_id, poes=hc_poes.tolist(),
+                           location=point.wkt2d)
 
     # Save:
-    models.HazardCurveData.objects.create(
-        hazard_curve_id=hc_coll_id, poes=hc_poes, location=point.wkt2d)
+    with transaction.commit_on_success(using='reslt_writer'):
+        inserter.flush()
 gmf_to_hazard_curve_task.ignore_result = False
 
 
 def do_post_process(job):
     """
-    Run the GMF to hazard curve post-processing tasks for the given ``job``.
+    Run the GMF to hazard curve post-processing tasks for the given ``job``:
+    one task per realization and IMT (see :func:`gmf_to_hazard_curve_task`).
+    The partial exceedance counts saved by the event-based tasks (see
+    :class:`ExceedanceCounter`) are deleted at the end.
 
     :param job:
         A :class:`openquake.db.models.OqJob` instance.
@@ -193,10 +243,8 @@ def do_post_process(job):
 
     # Stats for debug logging:
     n_imts = len(hc.intensity_measure_types_and_levels)
-    n_sites = len(hc.points_to_compute())
     n_rlzs = models.LtRealization.objects.filter(hazard_calculation=hc).count()
-    total_blocks = int(math.ceil(
-        (n_imts * n_sites * n_rlzs) / float(block_size)))
+    total_blocks = int(math.ceil((n_imts * n_rlzs) / float(block_size)))
 
     for i, block in enumerate(block_gen):
         logs.LOG.debug('> GMF post-processing block, %s of %s'
@@ -213,6 +261,9 @@ def do_post_process(job):
 
         logs.LOG.debug('< Done GMF post-processing block, %s of %s'
                        % (i + 1, total_blocks))
+
+    models.GmfExceedancePartial.objects.filter(
+        lt_realization__hazard_calculation=hc.id).delete()
     logs.LOG.debug('< Done post-processing - GMFs to Hazard Curves')
 
 
@@ -250,6 +301,24 @@ def gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
 
     num_exceeding = numpy.sum(gmvs >= imls, axis=1)
 
-    poes = 1 - numpy.exp(- (invest_time / duration) * num_exceeding)
+    return exceedances_to_poes(num_exceeding, invest_time, duration)
+
+
+def exceedances_to_poes(num_exceeding, invest_time, duration):
+    """
+    Convert the number of ground motion values exceeding some IMLs, in the
+    time window `duration`, to probabilities of exceedance in the
+    investigation time.
 
-    return poes
+    :param num_exceeding:
+        A numpy array of numbers of exceedances, of any shape.
+    :param float invest_time:
+        Investigation time, in years. See :func:`gmvs_to_haz_curve`.
+    :param float duration:
+        Time window during which GMFs occur. See :func:`gmvs_to_haz_curve`.
+
+    :returns:
+        Numpy array of PoEs (probabilities of exceedence), with the same shape
+        as `num_exceeding`.
+    """
+    return 1 - numpy.exp(- (invest_time / duration) * num_exceeding)
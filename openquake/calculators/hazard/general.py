@@ -18,11 +18,15 @@
 
 """Common code for the hazard calculators."""
 
+import copy
+import glob
 import math
 import os
 import random
 import re
 import StringIO
+import tempfile
+import time
 
 import kombu
 import nhlib
@@ -49,6 +53,7 @@ from openquake.job.validation import MAX_SINT_32
 from openquake.job.validation import MIN_SINT_32
 from openquake import logs
 from openquake.utils import config
+from openquake.utils import general as general_utils
 from openquake.utils import stats
 
 
@@ -59,6 +64,53 @@ POES_PARAM_NAME = "POES"
 # node.
 ROUTING_KEY_FMT = 'oq.job.%(job_id)s.htasks'
 
+#: Number of logic tree samples in each wave, when the logic trees are sampled
+#: until the mean hazard curves converge and the calculation does not specify
+#: `logic_tree_samples_per_wave`.
+DEFAULT_LT_SAMPLES_PER_WAVE = 10
+
+#: Name prefix of the node-local files of a calculation, which are saved in
+#: the temporary directory of each node. See :func:`load_node_array`.
+NODE_FILE_PREFIX_FMT = 'oq-hc-%(hc_id)s-'
+
+#: Node-local files of other calculations which were not used for longer than
+#: this (in seconds) are removed. See :func:`purge_node_files`.
+NODE_FILE_MAX_AGE = 24 * 60 * 60
+
+#: File name format for the node-local, memory-mapped copy of the site data of
+#: a calculation. See :func:`get_site_collection`.
+SITE_DATA_FILE_FMT = NODE_FILE_PREFIX_FMT + 'site-data-%(site_data_id)s.npy'
+
+#: Per-process cache of :class:`nhlib.site.SiteCollection` objects, keyed by
+#: hazard calculation id. See :func:`get_site_collection`.
+_SITE_COLL_CACHE = {}
+
+#: Per-process LRU cache of nhlib sources converted from NRML. Created lazily
+#: by :func:`_get_source_cache`.
+_SOURCE_CACHE = None
+
+#: Relative cost of computing hazard for a single rupture of a given source
+#: type. Fault sources have bigger rupture surfaces, which are more expensive
+#: to generate and to compute distances from. See :func:`source_weight`.
+SOURCE_TYPE_COST = {
+    'point': 1.0,
+    'area': 1.0,
+    'simple': 2.0,
+    'complex': 4.0,
+}
+
+#: Number of sources whose weight is updated with a single query. See
+#: :meth:`BaseHazardCalculatorNext.initialize_source_weights`.
+SOURCE_WEIGHT_BLOCK_SIZE = 1000
+
+#: Weight of the `source_progress` records which have not been estimated yet
+#: (the default of the `weight` column).
+DEFAULT_SOURCE_WEIGHT = 1.0
+
+#: Default size (in MB) of the source cache, if `source_cache_size` is not
+#: set in the [hazard] section of openquake.cfg.
+DEFAULT_SOURCE_CACHE_SIZE = 256
+
 
 def store_source_model(job_id, seed, params, calc):
     """Generate source model from the source model logic tree and store it in
@@ -297,6 +349,43 @@ def store_site_data(hc_id, site_model_inp, mesh):
     return site_data
 
 
+def store_reference_site_data(hc):
+    """
+    Store the calculation points of interest, together with the reference
+    site parameters defined in the calculation, as a single record in the
+    `htemp.site_data` table.
+
+    This is the counterpart of :func:`store_site_data` for calculations which
+    do not specify a site model. Storing the site parameters up front means
+    that workers never need to discretize the calculation geometry again.
+
+    :param hc:
+        A :class:`~openquake.db.models.HazardCalculation` instance.
+    :returns:
+        The :class:`openquake.db.models.SiteData` object that was created.
+    """
+    mesh = hc.points_to_compute()
+    n_sites = len(mesh)
+
+    site_data = models.SiteData(hazard_calculation_id=hc.id)
+    site_data.lons = numpy.array(mesh.lons, dtype=float).reshape(n_sites)
+    site_data.lats = numpy.array(mesh.lats, dtype=float).reshape(n_sites)
+    site_data.vs30s = numpy.empty(n_sites)
+    site_data.vs30s.fill(hc.reference_vs30_value)
+    site_data.vs30_measured = numpy.empty(n_sites, dtype=bool)
+    site_data.vs30_measured.fill(hc.reference_vs30_type == 'measured')
+    # NOTE: The order of the depth parameters matches what
+    # :func:`get_site_collection` has always passed to `nhlib.site.Site`
+    # for calculations without a site model.
+    site_data.z1pt0s = numpy.empty(n_sites)
+    site_data.z1pt0s.fill(hc.reference_depth_to_2pt5km_per_sec)
+    site_data.z2pt5s = numpy.empty(n_sites)
+    site_data.z2pt5s.fill(hc.reference_depth_to_1pt0km_per_sec)
+    site_data.save()
+
+    return site_data
+
+
 def exchange_and_conn_args():
     """
     Helper method to setup an exchange for task communication and the args
@@ -317,12 +406,38 @@ def exchange_and_conn_args():
     return exchange, conn_args
 
 
+def _get_source_cache():
+    """
+    Get the per-process cache of converted nhlib sources, creating it if
+    needed. The size of the cache is given (in MB) by the `source_cache_size`
+    parameter in the [hazard] section of openquake.cfg.
+
+    :returns:
+        A :class:`openquake.utils.general.LRUCache`.
+    """
+    global _SOURCE_CACHE
+    if _SOURCE_CACHE is None:
+        size = config.get('hazard', 'source_cache_size')
+        size = int(size) if size else DEFAULT_SOURCE_CACHE_SIZE
+        _SOURCE_CACHE = general_utils.LRUCache(size * 1024 * 1024)
+    return _SOURCE_CACHE
+
+
 def gen_sources(src_ids, apply_uncertainties, rupture_mesh_spacing,
                 width_of_mfd_bin, area_source_discretization):
     """
     Nhlib source objects generator for a given set of sources.
 
-    Performs lazy loading, converting and processing of sources.
+    All of the sources which are not already cached by the current worker
+    process are loaded with a single query. Converted sources are kept in a
+    per-process LRU cache, so that the same source is not converted again
+    for each logic tree realization; the size of a converted source is
+    estimated from the size of its serialized NRML.
+
+    The uncertainties only ever modify the MFD of a source (see
+    :meth:`openquake.input.logictree.BranchSet.apply_uncertainty`), so they
+    are applied to a shallow copy of the cached source, with a copy of its
+    MFD: the geometry is shared with the cached source.
 
     :param src_ids:
         A list of IDs for :class:`openquake.db.models.ParsedSource` records.
@@ -334,22 +449,123 @@ parse_source_model_logictree_path`
     For information about the other parameters, see
     :func:`openquake.input.source.nrml_to_nhlib`.
     """
+    cache = _get_source_cache()
+    conv_params = (rupture_mesh_spacing, width_of_mfd_bin,
+                   area_source_discretization)
+
+    # Keep a reference to the sources cached now: converting the missing
+    # ones can evict them from the cache.
+    cached = {}
+    for src_id in src_ids:
+        base_source = cache.get((src_id,) + conv_params)
+        if base_source is not None:
+            cached[src_id] = base_source
+
+    missing = [src_id for src_id in src_ids if not src_id in cached]
+    parsed_sources = dict(
+        (parsed.id, parsed) for parsed in models.ParsedSource.objects.filter(
+            id__in=missing).extra(select={'nrml_size': 'octet_length(nrml)'}))
+
     for src_id in src_ids:
-        parsed_source = models.ParsedSource.objects.get(id=src_id)
+        base_source = cached.get(src_id)
 
-        nhlib_source = source.nrml_to_nhlib(
-            parsed_source.nrml, rupture_mesh_spacing, width_of_mfd_bin,
-            area_source_discretization)
+        if base_source is None:
+            parsed = parsed_sources[src_id]
+            base_source = source.nrml_to_nhlib(
+                parsed.nrml, rupture_mesh_spacing, width_of_mfd_bin,
+                area_source_discretization)
+            cache.put((src_id,) + conv_params, base_source, parsed.nrml_size)
 
+        nhlib_source = copy.copy(base_source)
+        nhlib_source.mfd = copy.deepcopy(base_source.mfd)
         apply_uncertainties(nhlib_source)
         yield nhlib_source
 
 
+def estimate_num_ruptures(nhlib_src, source_type):
+    """
+    Estimate the number of ruptures generated by a seismic source, without
+    generating them.
+
+    For point and area sources, the estimate is exact: there is a rupture for
+    each magnitude, nodal plane, hypocenter depth and (for area sources)
+    point of the discretized polygon. For fault sources, it is the number of
+    magnitudes times the number of points of the mesh of the fault surface,
+    which is an upper bound of the number of positions of the ruptures of a
+    given magnitude.
+
+    :param nhlib_src:
+        :class:`nhlib.source.base.SeismicSource` object.
+    :param str source_type:
+        The `source_type` of the :class:`openquake.db.models.ParsedSource`.
+    """
+    num_mags = len(nhlib_src.mfd.get_annual_occurrence_rates())
+
+    if source_type in ('point', 'area'):
+        num_ruptures = (num_mags
+                        * len(nhlib_src.nodal_plane_distribution.data)
+                        * len(nhlib_src.hypocenter_distribution.data))
+        if source_type == 'area':
+            num_ruptures *= len(nhlib_src.polygon.discretize(
+                nhlib_src.area_discretization))
+        return num_ruptures
+
+    if source_type == 'simple':
+        surface = nhlib_geo.SimpleFaultSurface.from_fault_data(
+            nhlib_src.fault_trace, nhlib_src.upper_seismogenic_depth,
+            nhlib_src.lower_seismogenic_depth, nhlib_src.dip,
+            nhlib_src.rupture_mesh_spacing)
+    else:
+        surface = nhlib_geo.ComplexFaultSurface.from_fault_data(
+            nhlib_src.edges, nhlib_src.rupture_mesh_spacing)
+    return num_mags * surface.get_mesh().lons.size
+
+
+def source_weight(nhlib_src, source_type, sites, maximum_distance):
+    """
+    Estimate the computational cost of a seismic source, as the number of
+    ruptures it generates (see :func:`estimate_num_ruptures`) times the number
+    of sites affected by the source times a factor depending on the source
+    type (see :data:`SOURCE_TYPE_COST`).
+
+    :param nhlib_src:
+        :class:`nhlib.source.base.SeismicSource` object.
+    :param str source_type:
+        The `source_type` of the :class:`openquake.db.models.ParsedSource`.
+    :param sites:
+        :class:`nhlib.geo.mesh.Mesh` of the sites of the calculation.
+    :param maximum_distance:
+        Integration distance, in km. If `None`, all of the sites are
+        considered affected by the source.
+    :returns:
+        The weight of the source, as a float greater than 0.
+    """
+    num_ruptures = estimate_num_ruptures(nhlib_src, source_type)
+
+    if maximum_distance:
+        polygon = nhlib_src.get_rupture_enclosing_polygon(maximum_distance)
+        num_sites = polygon.intersects(sites).sum()
+    else:
+        num_sites = len(sites)
+
+    weight = (num_ruptures * max(num_sites, 1)
+              * SOURCE_TYPE_COST.get(source_type, 1.0))
+    return float(max(weight, 1))
+
+
 def get_site_collection(hc):
     """
     Create a `SiteCollection`, which is needed by nhlib to perform various
     calculation tasks (such computing hazard curves and GMFs).
 
+    The site collection is built only once per worker process and
+    calculation; subsequent calls for the same calculation return the cached
+    object, whose arrays are read-only. If the site parameters were
+    pre-computed (see
+    :meth:`BaseHazardCalculatorNext.initialize_site_model`), they are loaded
+    through a node-local memory-mapped file, so that they are read from the
+    database only once per node.
+
     :param hc:
         Instance of a :class:`~openquake.db.models.HazardCalculation`. We need
         this in order to get the points of interest for a calculation as well
@@ -358,15 +574,16 @@ def get_site_collection(hc):
     :returns:
         :class:`nhlib.site.SiteCollection` instance.
     """
-    site_data = models.SiteData.objects.filter(hazard_calculation=hc.id)
-    if len(site_data) > 0:
-        site_data = site_data[0]
-        sites = zip(site_data.lons, site_data.lats, site_data.vs30s,
-                    site_data.vs30_measured, site_data.z1pt0s,
-                    site_data.z2pt5s)
-        sites = [nhlib.site.Site(
-            nhlib.geo.Point(lon, lat), vs30, vs30m, z1pt0, z2pt5)
-            for lon, lat, vs30, vs30m, z1pt0, z2pt5 in sites]
+    site_coll = _SITE_COLL_CACHE.get(hc.id)
+    if site_coll is not None:
+        return site_coll
+
+    site_data_ids = list(models.SiteData.objects.filter(
+        hazard_calculation=hc.id).values_list('id', flat=True)[:1])
+
+    if len(site_data_ids) > 0:
+        site_coll = _site_collection_from_arrays(
+            *_load_site_arrays(hc.id, site_data_ids[0]))
     else:
         # Use the calculation reference parameters to make a site collection.
         points = hc.points_to_compute()
@@ -376,10 +593,170 @@ def get_site_collection(hc):
                             hc.reference_depth_to_2pt5km_per_sec,
                             hc.reference_depth_to_1pt0km_per_sec)
             for pt in points]
+        site_coll = nhlib.site.SiteCollection(sites)
+
+    # The cached collection is shared by all of the tasks run by this
+    # process: make sure that none of them can change it.
+    for array in (site_coll.vs30, site_coll.vs30measured, site_coll.z1pt0,
+                  site_coll.z2pt5, site_coll.mesh.lons, site_coll.mesh.lats):
+        array.flags.writeable = False
+
+    # Workers only ever deal with one calculation at a time, so there is no
+    # need to keep more than one site collection around.
+    _SITE_COLL_CACHE.clear()
+    _SITE_COLL_CACHE[hc.id] = site_coll
+
+    return site_coll
+
+
+def _load_site_arrays(hc_id, site_data_id):
+    """
+    Load the pre-computed site parameters for a calculation as a single 2D
+    array of floats, with one row per parameter (in the order lons, lats,
+    vs30s, vs30_measured, z1pt0s, z2pt5s) and one column per site.
+
+    The first process on a node to ask for the data reads it from the
+    `htemp.site_data` table; the other processes on the node load it from
+    a file (see :func:`load_node_array`).
+
+    :param int hc_id:
+        ID of a :class:`~openquake.db.models.HazardCalculation`.
+    :param int site_data_id:
+        ID of the :class:`~openquake.db.models.SiteData` for the calculation.
+        This is included in the file name to avoid picking up stale files.
+    """
+    def read_site_data():
+        site_data = models.SiteData.objects.get(id=site_data_id)
+        return numpy.array(
+            [site_data.lons, site_data.lats, site_data.vs30s,
+             site_data.vs30_measured, site_data.z1pt0s, site_data.z2pt5s],
+            dtype=float)
+
+    return load_node_array(
+        hc_id,
+        SITE_DATA_FILE_FMT % dict(hc_id=hc_id, site_data_id=site_data_id),
+        read_site_data)
+
+
+def load_node_array(hc_id, file_name, compute):
+    """
+    Load a numpy array from a file in the temporary directory of this node.
+    The file is memory-mapped (read-only), so each process on the node
+    shares the same physical pages.
+
+    The first process on a node to ask for the array computes it and saves
+    it; the stale files left on the node by other calculations are removed
+    at that point (see :func:`purge_node_files`).
+
+    :param int hc_id:
+        ID of the :class:`~openquake.db.models.HazardCalculation` the array
+        belongs to.
+    :param str file_name:
+        The name of the file, starting with :data:`NODE_FILE_PREFIX_FMT`.
+    :param compute:
+        A function without arguments returning the array.
+    """
+    path = os.path.join(tempfile.gettempdir(), file_name)
+
+    if os.path.exists(path):
+        try:
+            # mark the file as still in use (see `purge_node_files`)
+            os.utime(path, None)
+        except OSError:
+            pass
+    else:
+        purge_node_files(hc_id)
+        array = compute()
 
+        # Write to a private file first and then rename it; the rename is
+        # atomic, so concurrent readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fh:
+            numpy.save(fh, array)
+        os.rename(tmp_path, path)
+
+    return numpy.load(path, mmap_mode='r')
+
+
+def remove_node_files(file_name_pattern):
+    """
+    Remove the files matching a glob pattern from the temporary directory of
+    this node. The processes which memory-mapped them are not affected.
+
+    :param str file_name_pattern:
+        A glob pattern, like `SITE_DATA_FILE_FMT % dict(hc_id=1,
+        site_data_id='*')`.
+    """
+    pattern = os.path.join(tempfile.gettempdir(), file_name_pattern)
+    for path in glob.glob(pattern):
+        try:
+            os.remove(path)
+        except OSError:
+            # already removed by another process
+            pass
+
+
+def purge_node_files(hc_id, max_age=NODE_FILE_MAX_AGE):
+    """
+    Remove from the temporary directory of this node the files of the other
+    calculations which were not used in the last `max_age` seconds.
+
+    A calculation only removes its own files from the control node when it
+    is done (see :meth:`BaseHazardCalculatorNext.clean_up`): this is how the
+    files on the worker nodes are removed, by the next calculation using
+    the node.
+
+    :param int hc_id:
+        ID of the current :class:`~openquake.db.models.HazardCalculation`,
+        whose files are kept.
+    :param float max_age:
+        Age in seconds since the last use of a file.
+    """
+    tmp_dir = tempfile.gettempdir()
+    own_prefix = os.path.join(
+        tmp_dir, NODE_FILE_PREFIX_FMT % dict(hc_id=hc_id))
+    pattern = os.path.join(tmp_dir, NODE_FILE_PREFIX_FMT % dict(hc_id='*'))
+    now = time.time()
+
+    for path in glob.glob(pattern + '*.npy'):
+        if path.startswith(own_prefix):
+            continue
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            # already removed by another process
+            pass
+
+
+def _site_collection_from_arrays(lons, lats, vs30s, vs30_measured, z1pt0s,
+                                 z2pt5s):
+    """
+    Create a :class:`nhlib.site.SiteCollection` from arrays of site
+    parameters (see :func:`_load_site_arrays`).
+    """
+    sites = [nhlib.site.Site(nhlib_geo.Point(lon, lat), vs30, bool(vs30m),
+                             z1pt0, z2pt5)
+             for lon, lat, vs30, vs30m, z1pt0, z2pt5
+             in zip(lons, lats, vs30s, vs30_measured, z1pt0s, z2pt5s)]
     return nhlib.site.SiteCollection(sites)
 
 
+def clear_site_collection_cache(hc_id):
+    """
+    Drop the cached site collection for the given calculation (if any) and
+    remove the memory-mapped site data files for the calculation from the
+    temporary directory of this node.
+
+    :param int hc_id:
+        ID of a :class:`~openquake.db.models.HazardCalculation`.
+    """
+    _SITE_COLL_CACHE.pop(hc_id, None)
+
+    remove_node_files(
+        SITE_DATA_FILE_FMT % dict(hc_id=hc_id, site_data_id='*'))
+
+
 def im_dict_to_nhlib(im_dict):
     """
     Given the dict of intensity measure types and levels, convert them to a
@@ -456,10 +833,18 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
     #: In subclasses, this would be a reference to the task function
     core_calc_task = None
 
+    resumable = True
+
     def __init__(self, *args, **kwargs):
         super(BaseHazardCalculatorNext, self).__init__(*args, **kwargs)
 
         self.progress = dict(total=0, computed=0)
+        # The number of (realization, source) pairs discarded because the
+        # source is too far from the sites; see `initialize_source_progress`.
+        self.num_pruned_sources = 0
+        # The estimated weights of the sources, keyed by `ParsedSource` id;
+        # see `initialize_source_weights`.
+        self.source_weights = {}
 
     @property
     def hc(self):
@@ -537,6 +922,9 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         is what we store in `htemp.site_data`. (Computing this once prior to
         starting the calculation is optimal, since each task will need to
         consider all sites.)
+
+        If there is no site model, the reference site parameters defined in
+        the calculation are stored in `htemp.site_data` instead.
         """
         logs.log_progress("initializing site model", 2)
 
@@ -559,6 +947,11 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
             validate_site_model(site_model_data, mesh)
 
             store_site_data(self.hc.id, site_model_inp, mesh)
+        else:
+            # No site model; store the reference site parameters for all of
+            # the points of interest, so that tasks don't need to recompute
+            # the calculation geometry.
+            store_reference_site_data(self.hc)
 
     # Silencing 'Too many local variables'
     # pylint: disable=R0914
@@ -578,6 +971,11 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         in the source model chosen for each realization,
         see :meth:`initialize_source_progress`.
 
+        If the logic trees are sampled until the mean hazard curves converge
+        (see :meth:`openquake.db.models.HazardCalculation.\
+is_adaptive_sampling`), only the first wave of samples is created here;
+        the following waves are created by :meth:`sample_realizations`.
+
         :param rlz_callbacks:
             Optionally, you can specify a list of callbacks for each
             realization.  In the case of the classical hazard calculator, for
@@ -590,13 +988,42 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         logs.log_progress("initializing realizations", 2)
         if self.job.hazard_calculation.number_of_logic_tree_samples > 0:
             # random sampling of paths
+            num_samples = None
+            if self.hc.is_adaptive_sampling():
+                num_samples = min(self.lt_samples_per_wave(),
+                                  self.hc.number_of_logic_tree_samples)
             self._initialize_realizations_montecarlo(
-                rlz_callbacks=rlz_callbacks)
+                rlz_callbacks=rlz_callbacks, num_samples=num_samples)
         else:
             # full paths enumeration
             self._initialize_realizations_enumeration(
                 rlz_callbacks=rlz_callbacks)
 
+    @transaction.commit_on_success(using='reslt_writer')
+    def sample_realizations(self, num_samples, rlz_callbacks=None):
+        """
+        Sample more logic tree realizations, continuing the sequence of
+        random samples started by :meth:`initialize_realizations`. The
+        realizations are the same that would have been sampled up front if
+        the number of samples had been known in advance.
+
+        :param int num_samples:
+            The number of realizations to sample.
+        :param rlz_callbacks:
+            See :meth:`initialize_realizations` for more info.
+        """
+        logs.log_progress("sampling %s more realizations" % num_samples, 2)
+        self._initialize_realizations_montecarlo(
+            rlz_callbacks=rlz_callbacks, num_samples=num_samples)
+
+    def lt_samples_per_wave(self):
+        """
+        The number of logic tree samples in each wave, when the logic trees
+        are sampled until the mean hazard curves converge.
+        """
+        return (self.hc.logic_tree_samples_per_wave
+                or DEFAULT_LT_SAMPLES_PER_WAVE)
+
     def initialize_pr_data(self):
         """Record the total/completed number of work items.
 
@@ -611,6 +1038,18 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         if done > 0:
             stats.pk_set(self.job.id, "nhzrd_done", done.values().pop())
 
+    def resume(self):
+        """
+        Prepare the resumption of an interrupted calculation.
+
+        All of the data created in the `pre_executing` phase (sources, site
+        data, realizations and their progress records) is in the database
+        already, and the work which is not complete yet is selected by
+        :meth:`task_arg_gen`, so only the progress counters need to be
+        initialized again.
+        """
+        self.initialize_pr_data()
+
     def _initialize_realizations_enumeration(self, rlz_callbacks=None):
         """
         Perform full paths enumeration of logic trees and populate
@@ -648,7 +1087,8 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
                 hzrd_src = hzrd_src_cache[sm_name]
 
             # Create source_progress objects
-            self.initialize_source_progress(lt_rlz, hzrd_src)
+            self.num_pruned_sources += self.initialize_source_progress(
+                lt_rlz, hzrd_src)
 
             # Run realization callback (if any) to do additional initialization
             # for each realization:
@@ -656,20 +1096,43 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
                 for cb in rlz_callbacks:
                     cb(lt_rlz)
 
-    def _initialize_realizations_montecarlo(self, rlz_callbacks=None):
+    def _initialize_realizations_montecarlo(self, rlz_callbacks=None,
+                                            num_samples=None):
         """
         Perform random sampling of both logic trees and populate lt_realization
         table.
 
+        If some realizations have been sampled already, the sequence of
+        samples is continued from the last one.
+
         :param rlz_callbacks:
             See :meth:`initialize_realizations` for more info.
+        :param int num_samples:
+            The number of realizations to sample. By default, all of the
+            `number_of_logic_tree_samples` of the calculation which have not
+            been sampled yet.
         """
         # Each realization will have two seeds:
         # One for source model logic tree, one for GSIM logic tree.
         rnd = random.Random()
         seed = self.hc.random_seed
+
+        start = models.LtRealization.objects.filter(
+            hazard_calculation=self.hc).count()
+        if start > 0:
+            # Replay the draws made for the last realization to get the seed
+            # of the next one.
+            last = models.LtRealization.objects.get(
+                hazard_calculation=self.hc, ordinal=start - 1)
+            rnd.seed(last.seed)
+            rnd.randint(MIN_SINT_32, MAX_SINT_32)
+            rnd.randint(MIN_SINT_32, MAX_SINT_32)
+            seed = rnd.randint(MIN_SINT_32, MAX_SINT_32)
         rnd.seed(seed)
 
+        if num_samples is None:
+            num_samples = self.hc.number_of_logic_tree_samples - start
+
         [smlt] = models.inputs4hcalc(self.hc.id, input_type='lt_source')
 
         ltp = logictree.LogicTreeProcessor(self.hc.id)
@@ -677,7 +1140,7 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         hzrd_src_cache = {}
 
         # The first realization gets the seed we specified in the config file.
-        for i in xrange(self.hc.number_of_logic_tree_samples):
+        for i in xrange(start, start + num_samples):
             # Sample source model logic tree branch paths:
             sm_name, sm_lt_path = ltp.sample_source_model_logictree(
                     rnd.randint(MIN_SINT_32, MAX_SINT_32))
@@ -708,7 +1171,8 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
                 hzrd_src = hzrd_src_cache[sm_name]
 
             # Create source_progress objects
-            self.initialize_source_progress(lt_rlz, hzrd_src)
+            self.num_pruned_sources += self.initialize_source_progress(
+                lt_rlz, hzrd_src)
 
             # Run realization callback (if any) to do additional initialization
             # for each realization:
@@ -724,7 +1188,12 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
     def initialize_source_progress(lt_rlz, hzrd_src):
         """
         Create ``source_progress`` models for given logic tree realization
-        and set total sources of realization.
+        and set total sources of realization. A realization without sources
+        is marked as complete.
+
+        Only the sources whose rupture enclosing polygon is within the
+        `maximum_distance` of the sites of the calculation are considered;
+        the other sources would not contribute to the hazard anyway.
 
         :param lt_rlz:
             :class:`openquake.db.models.LtRealization` object to initialize
@@ -732,25 +1201,150 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
         :param hztd_src:
             :class:`openquake.db.models.Input` object that needed parsed
             sources are referencing.
+        :returns:
+            The number of sources which were discarded because they are too
+            far from the sites.
         """
         cursor = connections['reslt_writer'].cursor()
         src_progress_tbl = models.SourceProgress._meta.db_table
         parsed_src_tbl = models.ParsedSource._meta.db_table
         lt_rlz_tbl = models.LtRealization._meta.db_table
+        hc_tbl = models.HazardCalculation._meta.db_table
+        hc = lt_rlz.hazard_calculation
+
+        if hc.maximum_distance:
+            # The sites of interest are either a list of `sites` or all of the
+            # points in the `region`. In the latter case, the distance to the
+            # region polygon is a lower bound for the distance to the points.
+            cursor.execute("""
+                INSERT INTO "%s" (lt_realization_id, parsed_source_id,
+                                  is_complete)
+                SELECT %%s, ps.id, FALSE
+                FROM "%s" AS ps, "%s" AS hc
+                WHERE ps.input_id = %%s
+                AND hc.id = %%s
+                AND ST_DWithin(ps.polygon::geography,
+                               COALESCE(hc.sites, hc.region)::geography,
+                               %%s)
+                ORDER BY ps.id
+                """ % (src_progress_tbl, parsed_src_tbl, hc_tbl),
+                [lt_rlz.id, hzrd_src.id, hc.id,
+                 hc.maximum_distance * 1000.0])
+        else:
+            cursor.execute("""
+                INSERT INTO "%s" (lt_realization_id, parsed_source_id,
+                                  is_complete)
+                SELECT %%s, id, FALSE
+                FROM "%s" WHERE input_id = %%s
+                ORDER BY id
+                """ % (src_progress_tbl, parsed_src_tbl),
+                [lt_rlz.id, hzrd_src.id])
+        # A realization without sources is complete already: no task will
+        # ever mark it as such.
         cursor.execute("""
-            INSERT INTO "%s" (lt_realization_id, parsed_source_id, is_complete)
-            SELECT %%s, id, FALSE
-            FROM "%s" WHERE input_id = %%s
-            ORDER BY id
-            """ % (src_progress_tbl, parsed_src_tbl),
-            [lt_rlz.id, hzrd_src.id])
-        cursor.execute("""
-            UPDATE "%s" SET total_sources = (
-                SELECT count(1) FROM "%s" WHERE lt_realization_id = %%s
-            )""" % (lt_rlz_tbl, src_progress_tbl),
-            [lt_rlz.id])
+            UPDATE "%s" SET total_sources = src.total,
+                            is_complete = (src.total = 0)
+            FROM (
+                SELECT count(1) AS total FROM "%s"
+                WHERE lt_realization_id = %%s
+            ) AS src
+            WHERE id = %%s""" % (lt_rlz_tbl, src_progress_tbl),
+            [lt_rlz.id, lt_rlz.id])
         transaction.commit_unless_managed()
 
+        cursor.execute("""
+            SELECT
+                (SELECT count(1) FROM "%s" WHERE input_id = %%s)
+                - (SELECT count(1) FROM "%s" WHERE lt_realization_id = %%s)
+            """ % (parsed_src_tbl, src_progress_tbl),
+            [hzrd_src.id, lt_rlz.id])
+        [num_pruned] = cursor.fetchone()
+        return num_pruned
+
+    def initialize_source_weights(self):
+        """
+        Estimate the computational cost of each source considered in the
+        calculation (see :func:`source_weight`) and store it in the
+        `source_progress` records, so that :meth:`source_blocks` can pack
+        the sources into tasks of roughly equal cost.
+
+        This has to be run after the realizations have been initialized, and
+        again after more realizations are sampled (see
+        :meth:`sample_realizations`): only the records which still have the
+        default weight are updated, and each source is estimated only once
+        (see :attr:`source_weights`).
+        """
+        logs.log_progress("estimating source weights", 2)
+
+        src_progress = models.SourceProgress.objects.filter(
+            lt_realization__hazard_calculation=self.hc.id,
+            weight=DEFAULT_SOURCE_WEIGHT)
+        src_ids = set(
+            src_progress.values_list('parsed_source_id', flat=True))
+
+        missing = src_ids.difference(self.source_weights)
+        if missing:
+            sites = self.hc.points_to_compute()
+            parsed_sources = models.ParsedSource.objects.filter(
+                id__in=missing)
+            for parsed_src in parsed_sources.iterator():
+                nhlib_src = source.nrml_to_nhlib(
+                    parsed_src.nrml, self.hc.rupture_mesh_spacing,
+                    self.hc.width_of_mfd_bin,
+                    self.hc.area_source_discretization)
+                self.source_weights[parsed_src.id] = source_weight(
+                    nhlib_src, parsed_src.source_type, sites,
+                    self.hc.maximum_distance)
+
+        weights = [(src_id, self.source_weights[src_id])
+                   for src_id in sorted(src_ids)]
+
+        # Update the `source_progress` records of all of the realizations,
+        # a block of sources at a time:
+        cursor = connections['reslt_writer'].cursor()
+        for block in general_utils.block_splitter(
+                weights, SOURCE_WEIGHT_BLOCK_SIZE):
+            cursor.execute("""
+                UPDATE "%s" AS sp SET weight = w.weight
+                FROM (VALUES %s) AS w (parsed_source_id, weight), "%s" AS lt
+                WHERE sp.parsed_source_id = w.parsed_source_id
+                AND sp.weight = %%s
+                AND sp.lt_realization_id = lt.id
+                AND lt.hazard_calculation_id = %%s
+                """ % (models.SourceProgress._meta.db_table,
+                       ', '.join(['(%s, %s)'] * len(block)),
+                       models.LtRealization._meta.db_table),
+                [x for src_weight in block for x in src_weight]
+                + [DEFAULT_SOURCE_WEIGHT, self.hc.id])
+        transaction.commit_unless_managed(using='reslt_writer')
+
+    def source_blocks(self, lt_rlz, block_size):
+        """
+        Get the blocks of sources to be computed, for a given realization.
+
+        The number of blocks is the number of sources left to compute divided
+        by `block_size`, but the sources are distributed among the blocks
+        so that each block has about the same total weight (see
+        :meth:`initialize_source_weights`). Blocks are returned from the
+        heaviest to the lightest, so that the most expensive tasks are
+        started first.
+
+        :param lt_rlz:
+            :class:`openquake.db.models.LtRealization` object.
+        :param int block_size:
+            The number of sources per task, on average.
+        :returns:
+            A list of lists of :class:`openquake.db.models.ParsedSource` ids.
+        """
+        source_progress = models.SourceProgress.objects.filter(
+            is_complete=False, lt_realization=lt_rlz).order_by('id')
+        weights = source_progress.values_list('parsed_source_id', 'weight')
+        num_blocks = int(math.ceil(float(len(weights)) / block_size))
+
+        if num_blocks == 0:
+            return []
+        return general_utils.weighted_block_splitter(weights, num_blocks)
+
     def initialize_hazard_curve_progress(self, lt_rlz):
         """
         As a calculation progresses, workers will periodically update the
@@ -913,6 +1507,15 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
 
         return exported_files
 
+    def clean_up(self):
+        """
+        Delete the pre-computed site data of the calculation, and its
+        memory-mapped copy on this node. The copies on the worker nodes are
+        removed later (see :func:`purge_node_files`).
+        """
+        models.SiteData.objects.filter(hazard_calculation=self.hc.id).delete()
+        clear_site_collection_cache(self.hc.id)
+
     def record_init_stats(self):
         """
         Record some basic job stats, including the number of sites,
@@ -927,18 +1530,17 @@ class BaseHazardCalculatorNext(base.CalculatorNext):
             hazard_calculation=self.hc.id)
         num_rlzs = realizations.count()
 
-        # Compute the number of tasks.
+        # Compute the number of tasks. The way the work is split into tasks
+        # depends on the calculator (realizations may choose different source
+        # models, and may or may not be computed together), so we just count
+        # the tasks the calculator would generate.
         block_size = int(config.get('hazard', 'block_size'))
-        num_tasks = 0
-        for lt_rlz in realizations:
-            # Each realization has the potential to choose a random source
-            # model, and thus there may be a variable number of tasks for each
-            # realization (depending on the number of the sources in the model
-            # which was chosen for the realization).
-            num_sources = models.SourceProgress.objects.filter(
-                lt_realization=lt_rlz).count()
-            num_tasks += math.ceil(float(num_sources) / block_size)
+        progress = self.progress
+        self.progress = dict(total=0, computed=0)
+        num_tasks = sum(1 for _ in self.task_arg_gen(block_size))
+        self.progress = progress
 
         models.JobStats.objects.filter(oq_job=self.job.id).update(
             num_sites=num_sites, num_tasks=num_tasks,
-            num_realizations=num_rlzs)
+            num_realizations=num_rlzs,
+            num_pruned_sources=self.num_pruned_sources)
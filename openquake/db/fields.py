@@ -25,12 +25,17 @@ try:
 except ImportError:
     import pickle
 
+import numpy
+
 from django.contrib.gis import forms
 from django.contrib.gis.db import models as djm
 
 #: regex for splitting string lists on whitespace and/or commas
 ARRAY_RE = re.compile('[\s,]+')
 
+#: numpy dtype of the values stored by :class:`BinaryFloatArrayField`
+BINARY_FLOAT_DTYPE = numpy.dtype('<f8')
+
 # Disable pylint for 'Too many public methods'
 # pylint: disable=R0904
 
@@ -138,6 +143,29 @@ class FloatArrayField(djm.Field):
         return super(FloatArrayField, self).formfield(**defaults)
 
 
+class IntArrayField(djm.Field):
+    """This field models a postgres `int` array."""
+
+    def db_type(self, _connection):
+        return 'int[]'
+
+    def get_prep_value(self, value):
+        """Return data in a format that has been prepared for use as a
+        parameter in a query.
+
+        :param value: sequence of integers to be saved in an int[] field
+        :type value: list or tuple
+
+        >>> iaf = IntArrayField()
+        >>> iaf.get_prep_value([3, 10, 42])
+        '{3, 10, 42}'
+        """
+        if value is None:
+            return None
+
+        return '{' + ', '.join(str(int(v)) for v in value) + '}'
+
+
 class CharArrayField(djm.Field):
     """This field models a postgres `varchar` array."""
 
@@ -217,6 +245,46 @@ class PickleField(djm.Field):
         return super(PickleField, self).formfield(**defaults)
 
 
+class BinaryFloatArrayField(djm.Field):
+    """
+    Field for numpy arrays of floats, stored in a `bytea` column as raw
+    little-endian float64 values (see :data:`BINARY_FLOAT_DTYPE`).
+
+    Unlike :class:`PickleField`, the layout of the data is known, so that
+    a slice of the array can be read from the database without loading the
+    whole array. The shape of the array is not stored: arrays are always
+    loaded as 1D arrays.
+    """
+
+    __metaclass__ = djm.SubfieldBase
+
+    def db_type(self, connection):
+        """Return "bytea" as postgres' column type."""
+        return 'bytea'
+
+    def to_python(self, value):
+        """Load the array of floats."""
+        if isinstance(value, (buffer, str, bytearray)):
+            return numpy.fromstring(str(value), dtype=BINARY_FLOAT_DTYPE)
+        else:
+            return value
+
+    def get_prep_value(self, value):
+        """Dump the array of floats."""
+        if value is None:
+            return None
+        return bytearray(
+            numpy.asarray(value, dtype=BINARY_FLOAT_DTYPE).tostring())
+
+    def formfield(self, **kwargs):
+        """Specify a custom form field type so forms don't treat this as a
+        default type (such as a string).
+        """
+        defaults = {'form_class': PickleFormField}
+        defaults.update(kwargs)
+        return super(BinaryFloatArrayField, self).formfield(**defaults)
+
+
 class DictField(PickleField):
     """Field for storing Python `dict` objects (or a JSON text representation.
     """
@@ -28,6 +28,7 @@ Model representations of the OpenQuake DB tables.
 import itertools
 import os
 import re
+import threading
 
 from collections import namedtuple
 from datetime import datetime
@@ -36,10 +37,14 @@ import numpy
 
 from django.contrib.gis.db import models as djm
 from django.contrib.gis.geos.geometry import GEOSGeometry
+from django.contrib.gis.geos.point import Point
+from django.db import connections
+from django.db import router
 from nhlib import geo as nhlib_geo
 from shapely import wkt
 
 from openquake.db import fields
+from openquake.utils.general import block_splitter
 
 #: Default Spectral Acceleration damping. At the moment, this is not
 #: configurable.
@@ -552,6 +557,12 @@ class JobStats(djm.Model):
     # The number of logic tree samples
     # (for hazard jobs of all types except scenario)
     num_realizations = djm.IntegerField(null=True)
+    # The number of sources (summed over all realizations) discarded before
+    # the computation because they are too far from the sites of interest
+    num_pruned_sources = djm.IntegerField(null=True)
+    # The change of the mean hazard curves caused by the last wave of logic
+    # tree samples (adaptive logic tree sampling only)
+    lt_convergence = djm.FloatField(null=True)
 
     class Meta:
         db_table = 'uiapi\".\"job_stats'
@@ -648,6 +659,18 @@ class HazardCalculation(djm.Model):
     ########################
     random_seed = djm.IntegerField()
     number_of_logic_tree_samples = djm.IntegerField()
+    logic_tree_convergence_tolerance = djm.FloatField(
+        help_text=('Stop sampling the logic trees when the mean hazard curves '
+                   'change less than this after a wave of samples'),
+        null=True,
+        blank=True,
+    )
+    logic_tree_samples_per_wave = djm.IntegerField(
+        help_text=('Number of logic tree samples in a wave (adaptive logic '
+                   'tree sampling only)'),
+        null=True,
+        blank=True,
+    )
 
     ###############################################
     # ERF (Earthquake Rupture Forecast) parameters:
@@ -859,6 +882,14 @@ class HazardCalculation(djm.Model):
         return (self.quantile_hazard_curves is not None
                 and len(self.quantile_hazard_curves) > 0)
 
+    def is_adaptive_sampling(self):
+        """
+        Return True if the logic trees are sampled in waves, until the mean
+        hazard curves converge (see `logic_tree_convergence_tolerance`)
+        """
+        return (self.number_of_logic_tree_samples > 0
+                and self.logic_tree_convergence_tolerance is not None)
+
     def should_consider_weights_in_aggregates(self):
         """
         Return True if the calculation of aggregate result should
@@ -1423,74 +1454,219 @@ class HazardCurveDataManager(djm.Manager):
         """
         return self.individual_curves(job, imt).count()
 
-    def individual_curves_chunk(self, job, imt, offset, block_size):
+    def individual_curves_chunk(self, job, imt, first_id, last_id,
+                                lt_realization_ids=None):
         """
-        Get a chunk of individual curves related to `job` with `imt`
-        at offset `offset`. The size of the returned chunk is
-        `block_size`. The results are augmented with the wkb
-        representation of the location and the weight of the
-        individual curve
+        Get a chunk of individual curves related to `job` with `imt`, for
+        the locations from the location of the curve with id `first_id` to
+        the location of the curve with id `last_id` (included). The chunk
+        is ordered by location and then by realization. If
+        `lt_realization_ids` is given, only the curves of those
+        realizations are returned.
+
+        The results are augmented with the wkb representation of the
+        location and the weight of the individual curve
+
+        Chunks are selected by the range of their locations (which is
+        consistent with ordering by location), so that reading a chunk
+        does not require scanning the curves of all of the previous chunks.
         """
-        base_queryset = self.individual_curves_ordered(job, imt)
-        base_queryset = base_queryset.extra({
-            'wkb': 'asBinary(location)',
-            })
-        values = base_queryset.values(
+        table = '"%s"' % self.model._meta.db_table
+        location_of = '(SELECT location FROM %s WHERE id = %%s)' % table
+        base_queryset = self.individual_curves(job, imt).extra(
+            select={'wkb': 'asBinary(%s.location)' % table},
+            where=['%s.location BETWEEN %s AND %s'
+                   % (table, location_of, location_of)],
+            params=[first_id, last_id])
+        if lt_realization_ids is not None:
+            base_queryset = base_queryset.filter(
+                hazard_curve__lt_realization__in=lt_realization_ids)
+        base_queryset = base_queryset.order_by(
+            'location', 'hazard_curve__lt_realization')
+        return base_queryset.values(
             'poes', 'wkb', 'hazard_curve__lt_realization__weight')
 
-        return values[offset: block_size + offset]
-
     def individual_curves_chunks(self, job, imt=None, location_block_size=1):
         """
-        Return a list of chunk of individual curves. A chunk is a
-        tuple with all the ingredients needed to get a chunk of
-        individual curves, i.e. a curve finder, the current job, the
-        imt of the curves, a block size and an offset
+        Return a list of chunk of individual curves, each one covering
+        (at most) `location_block_size` locations. See
+        :class:`IndividualHazardCurveChunk`.
+
+        The boundaries of the chunks are given by the (ordered) locations
+        of the curves of a single realization, which are read with a
+        single query.
         """
-        curve_nr = self.individual_curves_nr(job, imt)
         calc = job.hazard_calculation
         curves_per_location = calc.individual_curves_per_location()
-        block_size = location_block_size * curves_per_location
-        ranges = xrange(0, curve_nr, block_size)
 
-        return [IndividualHazardCurveChunk(
-                job, imt, curves_per_location, offset, block_size)
-                for offset in ranges]
+        ref_curve = self.individual_curves(job, imt).order_by(
+            'hazard_curve').values_list('hazard_curve', flat=True)[:1]
+        if not ref_curve:
+            return []
+        ids = list(self.filter(hazard_curve=ref_curve[0]).order_by(
+            'location').values_list('id', flat=True))
+
+        chunks = []
+        for start in xrange(0, len(ids), location_block_size):
+            chunk_ids = ids[start:start + location_block_size]
+            bounds = [
+                (page[0], page[-1]) for page in block_splitter(
+                    chunk_ids, IndividualHazardCurveChunk.PAGE_SIZE)]
+            chunks.append(IndividualHazardCurveChunk(
+                job, imt, curves_per_location, bounds))
+        return chunks
 
 
 class IndividualHazardCurveChunk(object):
     """
     A class that model a chunk of individual curves that might cover
     different locations
+
+    The curves are read with a single query the first time one of `poes`,
+    `weights` or `locations` is accessed, and are kept in memory
+    afterwards (but they are not pickled with the chunk).
+
+    A chunk is split in pages of :attr:`PAGE_SIZE` locations, which can be
+    processed one at a time (see :meth:`pages`).
+
+    :param bounds:
+        List of pairs (first_id, last_id), one per page: the ids of the
+        :class:`HazardCurveData` (of a single realization) with the first
+        and the last location of the page.
+    :param lt_realization_ids:
+        If given, the chunk only holds the curves of these realizations.
     """
 
-    def __init__(self, job, imt, curves_per_location, offset, block_size):
+    #: Number of locations in a page of a chunk
+    PAGE_SIZE = 100
+
+    def __init__(self, job, imt, curves_per_location, bounds,
+                 lt_realization_ids=None):
         self.job = job
         self.imt = imt
-        self.offset = offset
         self.curves_per_location = curves_per_location
-        self.block_size = block_size
-        self._raw_data = None
+        self.bounds = bounds
+        self.lt_realization_ids = lt_realization_ids
+        self._data = None
+        self._prefetch_thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_prefetch_thread'] = None
+        return state
+
+    def _fetch(self):
+        """
+        Read the curves of the chunk.
 
-    @property
-    def raw_data(self):
-        return HazardCurveData.objects.individual_curves_chunk(
-            self.job, self.imt, self.offset, self.block_size)
+        :returns:
+            A triple (poes, weights, locations): poes is a 2D array (curves
+            x levels), ordered by location and then by realization; weights
+            is a 1D array with the weight of the curves of a location;
+            locations is a list of locations, in wkb format.
+        """
+        first_id = self.bounds[0][0]
+        last_id = self.bounds[-1][1]
+        rows = list(HazardCurveData.objects.individual_curves_chunk(
+            self.job, self.imt, first_id, last_id, self.lt_realization_ids))
+        if not rows:
+            return numpy.empty((0, 0)), numpy.empty(0), []
+
+        poes = numpy.array([r['poes'] for r in rows], dtype=numpy.float64)
+        weights = numpy.array(
+            [r['hazard_curve__lt_realization__weight']
+             for r in rows[0:self.curves_per_location]])
+        locations = [r['wkb'] for r in rows[0::self.curves_per_location]]
+        return poes, weights, locations
+
+    def _fetch_in_background(self):
+        """
+        Read the curves of the chunk, in a background thread (which has its
+        own database connection).
+        """
+        try:
+            self._data = self._fetch()
+        # pylint: disable=W0703
+        except Exception:
+            # the curves will be read again (and the error raised) in the
+            # main thread
+            pass
+        finally:
+            connections[router.db_for_read(HazardCurveData)].close()
+
+    def prefetch(self):
+        """
+        Start reading the curves of the chunk in a background thread.
+        """
+        if self._data is None and self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(
+                target=self._fetch_in_background)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+
+    def _get_data(self):
+        """
+        Get the curves of the chunk, reading them if needed.
+        """
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+        if self._data is None:
+            self._data = self._fetch()
+        return self._data
+
+    def pages(self):
+        """
+        Iterate over the pages of the chunk, as chunks of
+        :attr:`PAGE_SIZE` locations. The curves of the next page are read
+        in background while the current page is processed.
+        """
+        pages = [IndividualHazardCurveChunk(
+                 self.job, self.imt, self.curves_per_location, [bound],
+                 self.lt_realization_ids)
+                 for bound in self.bounds]
+        return self._prefetched(pages)
+
+    def realization_batches(self, batch_size):
+        """
+        Iterate over the curves of the chunk, as chunks with the curves of
+        (at most) `batch_size` realizations each. The curves of the next
+        batch are read in background while the current batch is processed.
+        """
+        rlz_ids = self.lt_realization_ids
+        if rlz_ids is None:
+            rlz_ids = LtRealization.objects.filter(
+                hazard_calculation=self.job.hazard_calculation).order_by(
+                    'id').values_list('id', flat=True)
+        batches = [IndividualHazardCurveChunk(
+                   self.job, self.imt, len(batch), self.bounds, batch)
+                   for batch in block_splitter(rlz_ids, batch_size)]
+        return self._prefetched(batches)
+
+    @staticmethod
+    def _prefetched(chunks):
+        """
+        Iterate over `chunks`, prefetching the next one.
+        """
+        for i, chunk in enumerate(chunks):
+            if i + 1 < len(chunks):
+                chunks[i + 1].prefetch()
+            yield chunk
+            # release the memory
+            chunk._data = None
 
     @property
     def poes(self):
-        return [r['poes'] for r in self.raw_data]
+        return self._get_data()[0]
 
     @property
     def weights(self):
-        weights = [r['hazard_curve__lt_realization__weight']
-                   for r in self.raw_data]
-        return weights[0:self.curves_per_location]
+        return self._get_data()[1]
 
     @property
     def locations(self):
-        locations = [r['wkb'] for r in self.raw_data]
-        return locations[0::self.curves_per_location]
+        return self._get_data()[2]
 
 
 class HazardCurveData(djm.Model):
@@ -1510,6 +1686,220 @@ class HazardCurveData(djm.Model):
         db_table = 'hzrdr\".\"hazard_curve_data'
 
 
+def _read_float_slice(model, column, pk, start, count):
+    """
+    Read a slice of a :class:`openquake.db.fields.BinaryFloatArrayField`,
+    without loading the whole array.
+
+    :param model:
+        Django model class.
+    :param str column:
+        Name of the column.
+    :param int pk:
+        Id of the record to read from.
+    :param int start:
+        Index of the first value to read.
+    :param int count:
+        Number of values to read.
+    :returns:
+        1D numpy array of floats.
+    """
+    itemsize = fields.BINARY_FLOAT_DTYPE.itemsize
+    cursor = connections[router.db_for_read(model)].cursor()
+    cursor.execute(
+        'SELECT substring(%s FROM %%s FOR %%s) FROM "%s" WHERE id = %%s'
+        % (column, model._meta.db_table),
+        [start * itemsize + 1, count * itemsize, pk])
+    [data] = cursor.fetchone()
+    return numpy.fromstring(str(data), dtype=fields.BINARY_FLOAT_DTYPE)
+
+
+class SiteMesh(djm.Model):
+    """
+    The sites of interest of a hazard calculation, stored once per
+    calculation. Results stored as matrices (see :class:`HazardCurveMatrix`)
+    refer to the sites by their index in the `lons` and `lats` arrays.
+    """
+    hazard_calculation = djm.OneToOneField('HazardCalculation')
+    num_sites = djm.IntegerField()
+    lons = fields.BinaryFloatArrayField()
+    lats = fields.BinaryFloatArrayField()
+
+    class Meta:
+        db_table = 'hzrdr\".\"site_mesh'
+
+    def get_coords(self, start=0, stop=None):
+        """
+        Get the coordinates of a slice of the sites.
+
+        :param int start:
+            Index of the first site.
+        :param int stop:
+            Index of the site after the last one. Defaults to the number of
+            sites.
+        :returns:
+            A pair of 1D numpy arrays: (lons, lats).
+        """
+        if stop is None:
+            stop = self.num_sites
+        return (_read_float_slice(SiteMesh, 'lons', self.id, start,
+                                  stop - start),
+                _read_float_slice(SiteMesh, 'lats', self.id, start,
+                                  stop - start))
+
+
+class HazardCurveMatrixManager(djm.Manager):
+    """
+    Manager class to filter :class:`HazardCurveMatrix` objects. The `poes`
+    matrices are never loaded by the querysets: use
+    :meth:`HazardCurveMatrix.get_poes` to read them.
+
+    This implements the same interface of :class:`HazardCurveDataManager`
+    used by the post-processing of hazard curves.
+    """
+
+    def individual_matrices(self, job, imt=None):
+        """
+        Returns the matrices of all of the individual hazard curves (one per
+        realization and IMT), ordered by realization. If `imt` is given, the
+        results are filtered by intensity measure type (in the long
+        format).
+        """
+        query_args = {'hazard_curve__statistics__isnull': True,
+                      'hazard_curve__output__oq_job': job,
+                      'hazard_curve__output__output_type': "hazard_curve"}
+        if imt:
+            hc_im_type, sa_period, sa_damping = parse_imt(imt)
+            query_args['hazard_curve__imt'] = hc_im_type
+            query_args['hazard_curve__sa_period'] = sa_period
+            query_args['hazard_curve__sa_damping'] = sa_damping
+
+        return self.filter(**query_args).defer('poes').order_by(
+            'hazard_curve__lt_realization')
+
+    def individual_curves_chunks(self, job, imt=None, location_block_size=1):
+        """
+        Return a list of chunks of individual curves, each one covering
+        `location_block_size` sites (and all of the realizations).
+        """
+        matrices = self.individual_matrices(job, imt).select_related(
+            'hazard_curve__lt_realization')
+        if not matrices:
+            return []
+
+        matrix_ids = [m.id for m in matrices]
+        weights = [m.hazard_curve.lt_realization.weight for m in matrices]
+        site_mesh = SiteMesh.objects.defer('lons', 'lats').get(
+            id=matrices[0].site_mesh_id)
+
+        return [HazardCurveMatrixChunk(
+                matrix_ids, weights, site_mesh.id, start,
+                min(start + location_block_size, site_mesh.num_sites))
+                for start in xrange(0, site_mesh.num_sites,
+                                    location_block_size)]
+
+
+class HazardCurveMatrixChunk(object):
+    """
+    A chunk of individual curves, stored as :class:`HazardCurveMatrix`
+    records, for the sites with index from `start` to `stop` (excluded).
+
+    It has the same interface of :class:`IndividualHazardCurveChunk`.
+    """
+
+    def __init__(self, matrix_ids, weights, site_mesh_id, start, stop):
+        self.matrix_ids = matrix_ids
+        self.weights = weights
+        self.site_mesh_id = site_mesh_id
+        self.start = start
+        self.stop = stop
+        self.curves_per_location = len(matrix_ids)
+
+    @property
+    def poes(self):
+        """
+        The curves of the chunk, as a 2D array ordered by site, then by
+        realization.
+        """
+        matrices = HazardCurveMatrix.objects.defer('poes').in_bulk(
+            self.matrix_ids)
+        poes = numpy.array([matrices[mid].get_poes(self.start, self.stop)
+                            for mid in self.matrix_ids])
+        # realizations x sites x IMLs -> sites x realizations x IMLs
+        poes = poes.transpose(1, 0, 2)
+        return poes.reshape((-1, poes.shape[2]))
+
+    @property
+    def locations(self):
+        """The WKB representation of the sites of the chunk."""
+        site_mesh = SiteMesh.objects.defer('lons', 'lats').get(
+            id=self.site_mesh_id)
+        lons, lats = site_mesh.get_coords(self.start, self.stop)
+        return [Point(lon, lat).wkb for lon, lat in zip(lons, lats)]
+
+
+class HazardCurveMatrix(djm.Model):
+    """
+    The hazard curves of a :class:`HazardCurve` (that is, of a realization
+    for an IMT) stored as a single sites x IMLs matrix: row i holds the PoEs
+    for the i-th site of the :class:`SiteMesh`.
+
+    This is an alternative layout to one :class:`HazardCurveData` record per
+    site.
+    """
+    hazard_curve = djm.OneToOneField('HazardCurve')
+    site_mesh = djm.ForeignKey('SiteMesh')
+    num_imls = djm.IntegerField()
+    # flattened sites x IMLs matrix
+    poes = fields.BinaryFloatArrayField()
+
+    objects = HazardCurveMatrixManager()
+
+    class Meta:
+        db_table = 'hzrdr\".\"hazard_curve_matrix'
+
+    def get_poes(self, start=0, stop=None):
+        """
+        Get the hazard curves for a slice of the sites.
+
+        :param int start:
+            Index of the first site.
+        :param int stop:
+            Index of the site after the last one. Defaults to the number of
+            sites.
+        :returns:
+            2D numpy array (sites x IMLs).
+        """
+        if stop is None:
+            stop = self.site_mesh.num_sites
+        poes = _read_float_slice(
+            HazardCurveMatrix, 'poes', self.id, start * self.num_imls,
+            (stop - start) * self.num_imls)
+        return poes.reshape((stop - start, self.num_imls))
+
+    def __iter__(self):
+        """
+        Iterate over the curves of all of the sites, as objects with the
+        same `location` and `poes` attributes of :class:`HazardCurveData`
+        (this is what the exporters need). Curves are read in blocks of
+        :data:`CURVE_MATRIX_BLOCK_SIZE` sites.
+        """
+        num_sites = self.site_mesh.num_sites
+        for start in xrange(0, num_sites, CURVE_MATRIX_BLOCK_SIZE):
+            stop = min(start + CURVE_MATRIX_BLOCK_SIZE, num_sites)
+            lons, lats = self.site_mesh.get_coords(start, stop)
+            poes = self.get_poes(start, stop)
+            for i in xrange(stop - start):
+                yield _HazardCurveItem(Point(lons[i], lats[i]), poes[i])
+
+
+#: Number of sites read at once when iterating over a
+#: :class:`HazardCurveMatrix`.
+CURVE_MATRIX_BLOCK_SIZE = 10000
+
+_HazardCurveItem = namedtuple('_HazardCurveItem', 'location poes')
+
+
 class SESCollection(djm.Model):
     """
     Stochastic Event Set Collection: A container for 1 or more Stochastic Event
@@ -1557,11 +1947,25 @@ class SES(djm.Model):
     class Meta:
         db_table = 'hzrdr\".\"ses'
 
+    def get_ruptures(self):
+        """
+        Query set of the :class:`SESRupture` objects of this SES.
+
+        A `complete logic tree` SES does not hold any rupture record: it
+        references the ruptures of all of the other SESs of the same job.
+        """
+        if self.complete_logic_tree_ses:
+            return SESRupture.objects.filter(
+                ses__ses_collection__output__oq_job=(
+                    self.ses_collection.output.oq_job),
+                ses__complete_logic_tree_ses=False)
+        return SESRupture.objects.filter(ses=self.id)
+
     def __iter__(self):
         """
         Iterator for walking through all child :class:`SESRupture` objects.
         """
-        return SESRupture.objects.filter(ses=self.id).iterator()
+        return self.get_ruptures().iterator()
 
 
 class SESRupture(djm.Model):
@@ -1689,11 +2093,17 @@ class GmfSet(djm.Model):
     class Meta:
         db_table = 'hzrdr\".\"gmf_set'
 
-    # Disabling pylint for 'Too many local variables'
-    # pylint: disable=R0914
     def __iter__(self):
         """
-        Iterator for walking through all child :class:`Gmf` objects.
+        Iterator for walking through all of the ground motion fields of this
+        set (one per rupture and IMT).
+
+        For each IMT, the :class:`Gmf` records of each result group (that is,
+        of each task) are read with a single query, and their ground motion
+        values are loaded in a sites x ruptures matrix, which is transposed
+        in bulk: each ground motion field is a view over a row of the
+        transposed matrix (see :class:`_GroundMotionField`). Only the records
+        of a result group are held in memory at any time.
         """
         job = self.gmf_collection.output.oq_job
         hc = job.hazard_calculation
@@ -1708,62 +2118,72 @@ class GmfSet(djm.Model):
             for gmf in itertools.chain(*lt_gmf_sets):
                 yield gmf
         else:
-            num_tasks = JobStats.objects.get(oq_job=job.id).num_tasks
-
             imts = [parse_imt(x) for x in hc.intensity_measure_types]
+            grp_ordinals = list(Gmf.objects
+                                .filter(gmf_set=self.id)
+                                .order_by('result_grp_ordinal')
+                                .values_list('result_grp_ordinal', flat=True)
+                                .distinct())
 
             for imt, sa_period, sa_damping in imts:
-
-                for result_grp_ordinal in xrange(1, num_tasks + 1):
-                    gmfs = Gmf.objects\
-                        .filter(
-                            gmf_set=self.id,
-                            imt=imt,
-                            sa_period=sa_period,
-                            sa_damping=sa_damping,
-                            result_grp_ordinal=result_grp_ordinal)\
-                        .order_by('location')
-                    if len(gmfs) == 0:
-                        # This task did not contribute to this GmfSet
+                for grp_ordinal in grp_ordinals:
+                    # one record per site, with the ground motion values of
+                    # all of the ruptures computed by the task
+                    grp_gmfs = list(Gmf.objects
+                                    .filter(
+                                        gmf_set=self.id,
+                                        imt=imt,
+                                        sa_period=sa_period,
+                                        sa_damping=sa_damping,
+                                        result_grp_ordinal=grp_ordinal)
+                                    .only('location', 'gmvs')
+                                    .order_by('location'))
+                    if not grp_gmfs:
                         continue
+                    locations = [gmf.location for gmf in grp_gmfs]
+                    # ruptures x sites
+                    gmvs = numpy.array(
+                        [gmf.gmvs for gmf in grp_gmfs], dtype=float).T.copy()
+                    del grp_gmfs
 
-                    # len of each gmfs == number of sites
-                    # need to walk through each columns of gmvs, slicing
-                    # vertically to extract individual ground motion fields
-                    first = gmfs[0]
-                    num_ruptures = len(first.gmvs)
-
-                    for i in xrange(num_ruptures):
-                        gmf_nodes = []
-                        for gmf in gmfs:
-                            assert len(gmf.gmvs) == num_ruptures
-                            # TODO: Rename `iml` to `gmv`,
-                            # in NRML serializer as well
-                            gmf_nodes.append(_GroundMotionFieldNode(
-                                iml=gmf.gmvs[i], location=gmf.location))
+                    for rupture_gmvs in gmvs:
                         yield _GroundMotionField(
-                            imt=first.imt, sa_period=first.sa_period,
-                            sa_damping=first.sa_damping, gmf_nodes=gmf_nodes)
-                        del gmf_nodes
+                            imt=imt, sa_period=sa_period,
+                            sa_damping=sa_damping, gmvs=rupture_gmvs,
+                            locations=locations)
 
 
 class _GroundMotionField(object):
+    """
+    A ground motion field: the ground motion values of a rupture, for an IMT,
+    at a set of locations.
+
+    The nodes of the field (with the attributes expected by the NRML
+    writer) are created only while iterating.
+
+    :param gmvs:
+        1D numpy array of ground motion values.
+    :param locations:
+        Sequence of points (with `x` and `y` attributes) of the same length,
+        usually shared by many fields.
+    """
 
-    def __init__(self, imt, sa_period, sa_damping, gmf_nodes):
+    def __init__(self, imt, sa_period, sa_damping, gmvs, locations):
         self.imt = imt
         self.sa_period = sa_period
         self.sa_damping = sa_damping
-        self.gmf_nodes = gmf_nodes
+        self.gmvs = gmvs
+        self.locations = locations
 
     def __iter__(self):
-        return iter(self.gmf_nodes)
+        return itertools.imap(
+            _GroundMotionFieldNode, self.gmvs, self.locations)
 
 
-class _GroundMotionFieldNode(object):
-
-    def __init__(self, iml, location):
-        self.iml = iml
-        self.location = location  # must have x and y attributes
+# TODO: Rename `iml` to `gmv`, in NRML serializer as well
+#: A node of a :class:`_GroundMotionField`; `location` must have `x` and `y`
+#: attributes.
+_GroundMotionFieldNode = namedtuple('_GroundMotionFieldNode', 'iml location')
 
 
 class Gmf(djm.Model):
@@ -1807,6 +2227,8 @@ class DisaggResult(djm.Model):
     * `lon_bin_edges`
     * `eps_bin_edges`
 
+    The tectonic region types are listed in `trts`.
+
     Additional metadata for the disaggregation histogram is stored, including
     location (POINT geometry), disaggregation PoE (Probability of Exceedance)
     and the corresponding IML (Intensity Measure Level) extracted from the
@@ -1826,6 +2248,7 @@ class DisaggResult(djm.Model):
     lon_bin_edges = fields.FloatArrayField(null=True)
     lat_bin_edges = fields.FloatArrayField(null=True)
     eps_bin_edges = fields.FloatArrayField(null=True)
+    trts = fields.CharArrayField(null=True)
     location = djm.PointField(srid=DEFAULT_SRID)
     matrix = fields.PickleField()
 
@@ -2345,11 +2768,15 @@ class SourceProgress(djm.Model):
 
     Marking progress as we go gives us the ability to resume partially-
     completed logic tree realizations.
+
+    ``weight`` is the estimated computational cost of the source, used to
+    distribute the sources among tasks.
     """
 
     lt_realization = djm.ForeignKey('LtRealization')
     parsed_source = djm.ForeignKey('ParsedSource')
     is_complete = djm.BooleanField(default=False)
+    weight = djm.FloatField(default=1.0)
 
     class Meta:
         db_table = 'htemp\".\"source_progress'
@@ -2373,6 +2800,92 @@ class HazardCurveProgress(djm.Model):
         db_table = 'htemp\".\"hazard_curve_progress'
 
 
+class HazardCurvePartial(djm.Model):
+    """
+    Partial hazard curve results (as a pickled numpy array) computed by a
+    single task over a subset of the sources, for the logic tree
+    realizations of the task which share a GSIM logic tree path (they all
+    have the same results).
+
+    Records are only ever inserted by the tasks, so that the tasks don't
+    have to lock each other out. They are combined in the matching
+    :class:`HazardCurveProgress` record of each of the realizations once
+    they are complete.
+    """
+
+    hazard_calculation = djm.ForeignKey('HazardCalculation')
+    # ids of the `LtRealization`s which have not combined the results yet
+    lt_realization_ids = fields.IntArrayField()
+    imt = djm.TextField()
+    # 2d array: sites x IMLs
+    result_matrix = fields.PickleField()
+
+    class Meta:
+        db_table = 'htemp\".\"hazard_curve_partial'
+
+
+class HazardCurveBlock(djm.Model):
+    """
+    The hazard curves of a completed logic tree realization for a block of
+    sites (as a pickled numpy array). See
+    :class:`openquake.calculators.hazard.classical.post_processing.\
+OnlineCurveStatistics`.
+    """
+
+    lt_realization = djm.ForeignKey('LtRealization')
+    imt = djm.TextField()
+    # index of the first site of the block
+    block_start = djm.IntegerField()
+    # 2d array: sites x IMLs
+    result_matrix = fields.PickleField()
+
+    class Meta:
+        db_table = 'htemp\".\"hazard_curve_block'
+
+
+class DisaggPartial(djm.Model):
+    """
+    Partial disaggregation matrix computed by a single task over a subset of
+    the sources, for a tectonic region type and for the logic tree
+    realizations of the task which share a GSIM logic tree path. See
+    :mod:`openquake.calculators.hazard.disagg.core`.
+
+    Only the non-empty bins are stored, as a pair of numpy arrays (flat bin
+    indices, sums of the logarithms of the probabilities of no exceedance),
+    so that the partial matrices can be combined by summation.
+    """
+
+    hazard_calculation = djm.ForeignKey('HazardCalculation')
+    # ids of the `LtRealization`s the matrix applies to
+    lt_realization_ids = fields.IntArrayField()
+    trt = djm.TextField()
+    result_matrix = fields.PickleField()
+
+    class Meta:
+        db_table = 'htemp\".\"disagg_partial'
+
+
+class GmfExceedancePartial(djm.Model):
+    """
+    Number of ground motion values exceeding each IML, for all of the sites
+    of the calculation (as a pickled numpy array), computed by a single
+    event-based task over a subset of the sources of a logic tree
+    realization.
+
+    Records are only ever inserted by the tasks; they are summed to compute
+    the hazard curves once the core calculation is done. See
+    :mod:`openquake.calculators.hazard.event_based.post_processing`.
+    """
+
+    lt_realization = djm.ForeignKey('LtRealization')
+    imt = djm.TextField()
+    # 2d array of integers: sites x IMLs
+    num_exceeding = fields.PickleField()
+
+    class Meta:
+        db_table = 'htemp\".\"gmf_exceedance_partial'
+
+
 class SiteData(djm.Model):
     """
     Contains pre-computed site parameter matrices. ``lons`` and ``lats``
@@ -2380,8 +2893,8 @@ class SiteData(djm.Model):
     are from the closest point in a site model in relation to each calculation
     point of interest.
 
-    Used only if a calculation defines a site model (otherwise, reference
-    parameters are use for all points of interest).
+    If a calculation does not define a site model, the reference parameters
+    of the calculation are stored for all points of interest.
     """
 
     hazard_calculation = djm.ForeignKey('HazardCalculation')
@@ -93,6 +93,17 @@ COMMENT ON COLUMN hzrdr.hazard_curve_data.hazard_curve_id IS 'The foreign key to
 COMMENT ON COLUMN hzrdr.hazard_curve_data.poes IS 'Probabilities of exceedence.';
 
 
+COMMENT ON TABLE hzrdr.site_mesh IS 'The sites of interest of a hazard calculation, referred to by index by the results stored as matrices';
+COMMENT ON COLUMN hzrdr.site_mesh.lons IS 'Longitudes of the sites, as a little-endian float64 array.';
+COMMENT ON COLUMN hzrdr.site_mesh.lats IS 'Latitudes of the sites, as a little-endian float64 array.';
+
+
+COMMENT ON TABLE hzrdr.hazard_curve_matrix IS 'Holds the POEs of all of the sites of a hazard curve set as a single matrix';
+COMMENT ON COLUMN hzrdr.hazard_curve_matrix.hazard_curve_id IS 'The foreign key to the hazard curve record for this matrix.';
+COMMENT ON COLUMN hzrdr.hazard_curve_matrix.site_mesh_id IS 'The foreign key to the sites the rows of the matrix refer to.';
+COMMENT ON COLUMN hzrdr.hazard_curve_matrix.poes IS 'Probabilities of exceedence, as a little-endian float64 sites x IMLs array in row-major order.';
+
+
 COMMENT ON TABLE hzrdr.gmf_data IS 'Holds data for the ground motion field';
 COMMENT ON COLUMN hzrdr.gmf_data.ground_motion IS 'Ground motion for a specific site';
 COMMENT ON COLUMN hzrdr.gmf_data.location IS 'Site coordinates';
@@ -306,6 +317,8 @@ COMMENT ON COLUMN uiapi.oq_job.duration IS 'The job''s duration in seconds (only
 COMMENT ON TABLE uiapi.job_stats IS 'Tracks various job statistics';
 COMMENT ON COLUMN uiapi.job_stats.num_sites IS 'The number of total sites in the calculation';
 COMMENT ON COLUMN uiapi.job_stats.num_realizations IS 'The number of logic tree samples in the calculation';
+COMMENT ON COLUMN uiapi.job_stats.num_pruned_sources IS 'The number of sources (summed over all realizations) discarded because they are too far from the sites of interest';
+COMMENT ON COLUMN uiapi.job_stats.lt_convergence IS 'The largest change of the mean hazard curves (at the sites checked for convergence) caused by the last wave of logic tree samples. Only set when adaptive logic tree sampling is used';
 
 
 COMMENT ON TABLE uiapi.oq_job_profile IS 'Holds the parameters needed to invoke the OpenQuake engine.';
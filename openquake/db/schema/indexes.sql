@@ -22,6 +22,10 @@ CREATE INDEX eqcat_catalog_time_idx on eqcat.catalog(time);
 CREATE INDEX eqcat_catalog_depth_idx on eqcat.catalog(depth);
 CREATE INDEX eqcat_catalog_point_idx ON eqcat.catalog USING gist(point);
 
+-- hzrdi.parsed_source
+CREATE INDEX hzrdi_parsed_source_input_id_idx ON hzrdi.parsed_source(input_id);
+CREATE INDEX hzrdi_parsed_source_polygon_geog_idx ON hzrdi.parsed_source USING gist((polygon::geography));
+
 -- hzrdi.site_model
 CREATE INDEX hzrdi_site_model_input_id_idx ON hzrdi.site_model(input_id);
 
@@ -48,6 +52,7 @@ CREATE INDEX hzrdr_gmf_collection_output_id_idx on hzrdr.gmf_collection(output_i
 CREATE INDEX hzrdr_gmf_collection_lt_realization_idx on hzrdr.gmf_collection(lt_realization_id);
 CREATE INDEX hzrdr_gmf_set_gmf_collection_idx on hzrdr.gmf_set(gmf_collection_id);
 CREATE INDEX hzrdr_gmf_gmf_set_idx on hzrdr.gmf(gmf_set_id);
+CREATE INDEX hzrdr_gmf_gmf_set_result_grp_ordinal_idx on hzrdr.gmf(gmf_set_id, result_grp_ordinal);
 CREATE INDEX hzrdr_gmf_location_idx on hzrdr.gmf using gist(location);
 -- uhs
 CREATE INDEX hzrdr_uh_spectra_output_id_idx on hzrdr.uh_spectra(output_id);
@@ -75,6 +80,14 @@ CREATE INDEX riskr_bcr_distribution_data_bcr_distribution_id_idx on riskr.bcr_di
 -- oqmif indexes
 CREATE INDEX oqmif_exposure_data_site_idx ON oqmif.exposure_data USING gist(site);
 
+-- htemp indexes
+CREATE INDEX htemp_hazard_curve_partial_hazard_calculation_imt_idx on htemp.hazard_curve_partial(hazard_calculation_id, imt);
+CREATE INDEX htemp_hazard_curve_partial_lt_realization_ids_idx ON htemp.hazard_curve_partial USING gin(lt_realization_ids);
+CREATE INDEX htemp_hazard_curve_block_imt_block_start_idx on htemp.hazard_curve_block(imt, block_start);
+CREATE INDEX htemp_disagg_partial_hazard_calculation_trt_idx on htemp.disagg_partial(hazard_calculation_id, trt);
+CREATE INDEX htemp_disagg_partial_lt_realization_ids_idx ON htemp.disagg_partial USING gin(lt_realization_ids);
+CREATE INDEX htemp_gmf_exceedance_partial_lt_realization_imt_idx on htemp.gmf_exceedance_partial(lt_realization_id, imt);
+
 -- uiapi indexes
 CREATE INDEX uiapi_job2profile_oq_job_profile_id_idx on uiapi.job2profile(oq_job_profile_id);
 CREATE INDEX uiapi_job2profile_job_id_idx on uiapi.job2profile(oq_job_id);
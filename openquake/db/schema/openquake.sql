@@ -274,7 +274,13 @@ CREATE TABLE uiapi.job_stats (
     -- The number of tasks in a job
     num_tasks INTEGER,
     -- The number of logic tree samples
-    num_realizations INTEGER
+    num_realizations INTEGER,
+    -- The number of sources (summed over all realizations) discarded
+    -- because they are too far from the sites of interest
+    num_pruned_sources INTEGER,
+    -- The change of the mean hazard curves caused by the last wave of
+    -- logic tree samples (adaptive logic tree sampling only)
+    lt_convergence float
 ) TABLESPACE uiapi_ts;
 
 
@@ -319,6 +325,9 @@ CREATE TABLE uiapi.hazard_calculation (
     -- logic tree parameters:
     random_seed INTEGER,
     number_of_logic_tree_samples INTEGER,
+    -- adaptive logic tree sampling (classical only):
+    logic_tree_convergence_tolerance float,
+    logic_tree_samples_per_wave INTEGER,
     -- ERF parameters:
     rupture_mesh_spacing float NOT NULL,
     width_of_mfd_bin float NOT NULL,
@@ -1121,6 +1130,32 @@ SELECT AddGeometryColumn('hzrdr', 'hazard_curve_data', 'location', 4326, 'POINT'
 ALTER TABLE hzrdr.hazard_curve_data ALTER COLUMN location SET NOT NULL;
 
 
+-- The sites of interest of a hazard calculation, stored once per calculation.
+-- Results stored as matrices refer to the sites by their index.
+CREATE TABLE hzrdr.site_mesh (
+    id SERIAL PRIMARY KEY,
+    hazard_calculation_id INTEGER NOT NULL UNIQUE,
+    num_sites INTEGER NOT NULL,
+    -- little-endian float64 arrays, one value per site
+    lons BYTEA NOT NULL,
+    lats BYTEA NOT NULL
+) TABLESPACE hzrdr_ts;
+
+
+-- Hazard curves of a logic tree realization for a single IMT, stored as
+-- a single sites x IMLs matrix (as an alternative to one hazard_curve_data
+-- record per site).
+CREATE TABLE hzrdr.hazard_curve_matrix (
+    id SERIAL PRIMARY KEY,
+    hazard_curve_id INTEGER NOT NULL UNIQUE,
+    site_mesh_id INTEGER NOT NULL,
+    num_imls INTEGER NOT NULL,
+    -- little-endian float64 array, in row-major order; row i is the hazard
+    -- curve for the i-th site of the site mesh
+    poes BYTEA NOT NULL
+) TABLESPACE hzrdr_ts;
+
+
 -- Stochastic Event Set Collection
 -- A container for all of the Stochastic Event Sets in a given
 -- logic tree realization.
@@ -1259,6 +1294,8 @@ CREATE TABLE hzrdr.disagg_result (
     lon_bin_edges float[],
     lat_bin_edges float[],
     eps_bin_edges float[],
+    -- tectonic region types (last dimension of the matrix)
+    trts VARCHAR[],
     matrix bytea NOT NULL
 ) TABLESPACE hzrdr_ts;
 SELECT AddGeometryColumn('hzrdr', 'disagg_result', 'location', 4326, 'POINT', 2);
@@ -1717,7 +1754,10 @@ CREATE TABLE htemp.source_progress (
     id SERIAL PRIMARY KEY,
     lt_realization_id INTEGER NOT NULL,
     parsed_source_id INTEGER NOT NULL,
-    is_complete BOOLEAN NOT NULL DEFAULT FALSE
+    is_complete BOOLEAN NOT NULL DEFAULT FALSE,
+    -- estimated computational cost of the source; used to pack sources into
+    -- tasks of roughly equal cost
+    weight float NOT NULL DEFAULT 1.0
 ) TABLESPACE htemp_ts;
 
 CREATE TABLE htemp.hazard_curve_progress (
@@ -1733,6 +1773,64 @@ CREATE TABLE htemp.hazard_curve_progress (
     result_matrix BYTEA NOT NULL
 ) TABLESPACE htemp_ts;
 
+CREATE TABLE htemp.hazard_curve_partial (
+    -- Append-only staging area for the partial hazard curve results computed
+    -- by each task (over a subset of the sources), one per GSIM logic tree
+    -- path and IMT. The tasks never update this table: the partial results
+    -- are combined in htemp.hazard_curve_progress as the realizations are
+    -- completed.
+    id SERIAL PRIMARY KEY,
+    hazard_calculation_id INTEGER NOT NULL,
+    -- the realizations (sharing the GSIM logic tree path) which have not
+    -- combined the partial results yet
+    lt_realization_ids INTEGER[] NOT NULL,
+    imt VARCHAR NOT NULL,
+    -- stores a pickled 2d numpy array (sites x IMLs) of partial PoEs
+    result_matrix BYTEA NOT NULL
+) TABLESPACE htemp_ts;
+
+CREATE TABLE htemp.hazard_curve_block (
+    -- The hazard curves of a completed realization, split in blocks of
+    -- sites. Used to compute the quantile curves one block of sites at a
+    -- time, while the calculation is running.
+    id SERIAL PRIMARY KEY,
+    lt_realization_id INTEGER NOT NULL,
+    imt VARCHAR NOT NULL,
+    -- index of the first site of the block
+    block_start INTEGER NOT NULL,
+    -- stores a pickled 2d numpy array (sites x IMLs) of PoEs
+    result_matrix BYTEA NOT NULL
+) TABLESPACE htemp_ts;
+
+CREATE TABLE htemp.disagg_partial (
+    -- Append-only staging area for the partial disaggregation matrices
+    -- computed by each task (over a subset of the sources), one per GSIM
+    -- logic tree path and tectonic region type. They are combined in
+    -- hzrdr.disagg_result when the core calculation is done.
+    id SERIAL PRIMARY KEY,
+    hazard_calculation_id INTEGER NOT NULL,
+    -- the realizations (sharing the GSIM logic tree path) the matrix
+    -- applies to
+    lt_realization_ids INTEGER[] NOT NULL,
+    trt VARCHAR NOT NULL,
+    -- stores a pickled pair of numpy arrays: the (flat) indices of the
+    -- non-empty bins and the sum of the logarithms of the probabilities of
+    -- no exceedance in each of them
+    result_matrix BYTEA NOT NULL
+) TABLESPACE htemp_ts;
+
+CREATE TABLE htemp.gmf_exceedance_partial (
+    -- Append-only staging area for the number of ground motion values
+    -- exceeding each IML computed by each event-based task (over a subset of
+    -- the sources), one per IMT. They are summed to compute the hazard
+    -- curves when the core calculation is done.
+    id SERIAL PRIMARY KEY,
+    lt_realization_id INTEGER NOT NULL,
+    imt VARCHAR NOT NULL,
+    -- stores a pickled 2d numpy array (sites x IMLs) of integers
+    num_exceeding BYTEA NOT NULL
+) TABLESPACE htemp_ts;
+
 -- pre-computed calculation point of interest to site parameters table
 CREATE TABLE htemp.site_data (
     id SERIAL PRIMARY KEY,
@@ -1897,6 +1995,19 @@ ALTER TABLE hzrdr.hazard_curve_data
 ADD CONSTRAINT hzrdr_hazard_curve_data_hazard_curve_fk
 FOREIGN KEY (hazard_curve_id) REFERENCES hzrdr.hazard_curve(id) ON DELETE CASCADE;
 
+ALTER TABLE hzrdr.site_mesh
+ADD CONSTRAINT hzrdr_site_mesh_hazard_calculation_fk
+FOREIGN KEY (hazard_calculation_id) REFERENCES uiapi.hazard_calculation(id)
+ON DELETE CASCADE;
+
+ALTER TABLE hzrdr.hazard_curve_matrix
+ADD CONSTRAINT hzrdr_hazard_curve_matrix_hazard_curve_fk
+FOREIGN KEY (hazard_curve_id) REFERENCES hzrdr.hazard_curve(id) ON DELETE CASCADE;
+
+ALTER TABLE hzrdr.hazard_curve_matrix
+ADD CONSTRAINT hzrdr_hazard_curve_matrix_site_mesh_fk
+FOREIGN KEY (site_mesh_id) REFERENCES hzrdr.site_mesh(id) ON DELETE CASCADE;
+
 ALTER TABLE hzrdr.gmf_data
 ADD CONSTRAINT hzrdr_gmf_data_output_fk
 FOREIGN KEY (output_id) REFERENCES uiapi.output(id) ON DELETE CASCADE;
@@ -2110,6 +2221,34 @@ FOREIGN KEY (lt_realization_id)
 REFERENCES hzrdr.lt_realization(id)
 ON DELETE CASCADE;
 
+-- htemp.hazard_curve_partial to uiapi.hazard_calculation FK
+ALTER TABLE htemp.hazard_curve_partial
+ADD CONSTRAINT htemp_hazard_curve_partial_hazard_calculation_fk
+FOREIGN KEY (hazard_calculation_id)
+REFERENCES uiapi.hazard_calculation(id)
+ON DELETE CASCADE;
+
+-- htemp.hazard_curve_block to hzrdr.lt_realization FK
+ALTER TABLE htemp.hazard_curve_block
+ADD CONSTRAINT htemp_hazard_curve_block_lt_realization_fk
+FOREIGN KEY (lt_realization_id)
+REFERENCES hzrdr.lt_realization(id)
+ON DELETE CASCADE;
+
+-- htemp.disagg_partial to uiapi.hazard_calculation FK
+ALTER TABLE htemp.disagg_partial
+ADD CONSTRAINT htemp_disagg_partial_hazard_calculation_fk
+FOREIGN KEY (hazard_calculation_id)
+REFERENCES uiapi.hazard_calculation(id)
+ON DELETE CASCADE;
+
+-- htemp.gmf_exceedance_partial to hzrdr.lt_realization FK
+ALTER TABLE htemp.gmf_exceedance_partial
+ADD CONSTRAINT htemp_gmf_exceedance_partial_lt_realization_fk
+FOREIGN KEY (lt_realization_id)
+REFERENCES hzrdr.lt_realization(id)
+ON DELETE CASCADE;
+
 -- htemp.site_data to uiapi.hazard_calculation FK
 ALTER TABLE htemp.site_data
 ADD CONSTRAINT htemp_site_data_hazard_calculation_fk
@@ -41,6 +41,8 @@ GRANT ALL ON SEQUENCE hzrdr.gmf_set_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.gmf_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_curve_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_curve_data_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE hzrdr.site_mesh_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE hzrdr.hazard_curve_matrix_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_map_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.uh_spectra_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.uh_spectrum_id_seq to GROUP openquake;
@@ -99,6 +101,10 @@ GRANT ALL ON SEQUENCE uiapi.job2profile_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE htemp.site_data_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE htemp.source_progress_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE htemp.hazard_curve_progress_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE htemp.hazard_curve_partial_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE htemp.hazard_curve_block_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE htemp.disagg_partial_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE htemp.gmf_exceedance_partial_id_seq to GROUP openquake;
 
 GRANT SELECT ON geography_columns TO GROUP openquake;
 GRANT SELECT ON geometry_columns TO GROUP openquake;
@@ -143,6 +149,14 @@ GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.hazard_curve TO oq_reslt_writer;
 GRANT SELECT ON hzrdr.hazard_curve_data TO GROUP openquake;
 GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.hazard_curve_data TO oq_reslt_writer;
 
+-- hzrdr.site_mesh
+GRANT SELECT ON hzrdr.site_mesh TO GROUP openquake;
+GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.site_mesh TO oq_reslt_writer;
+
+-- hzrdr.hazard_curve_matrix
+GRANT SELECT ON hzrdr.hazard_curve_matrix TO GROUP openquake;
+GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.hazard_curve_matrix TO oq_reslt_writer;
+
 -- hzrdr.gmf_data
 GRANT SELECT ON hzrdr.gmf_data TO GROUP openquake;
 GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.gmf_data TO oq_reslt_writer;
@@ -375,3 +389,19 @@ GRANT SELECT,INSERT,UPDATE,DELETE ON htemp.source_progress TO oq_reslt_writer;
 -- htemp.hazard_curve_progress
 GRANT SELECT ON htemp.hazard_curve_progress TO openquake;
 GRANT SELECT,INSERT,UPDATE,DELETE ON htemp.hazard_curve_progress TO oq_reslt_writer;
+
+-- htemp.hazard_curve_partial
+GRANT SELECT ON htemp.hazard_curve_partial TO openquake;
+GRANT SELECT,INSERT,DELETE ON htemp.hazard_curve_partial TO oq_reslt_writer;
+
+-- htemp.hazard_curve_block
+GRANT SELECT ON htemp.hazard_curve_block TO openquake;
+GRANT SELECT,INSERT,DELETE ON htemp.hazard_curve_block TO oq_reslt_writer;
+
+-- htemp.disagg_partial
+GRANT SELECT ON htemp.disagg_partial TO openquake;
+GRANT SELECT,INSERT,DELETE ON htemp.disagg_partial TO oq_reslt_writer;
+
+-- htemp.gmf_exceedance_partial
+GRANT SELECT ON htemp.gmf_exceedance_partial TO openquake;
+GRANT SELECT,INSERT,DELETE ON htemp.gmf_exceedance_partial TO oq_reslt_writer;
@@ -333,6 +333,63 @@ def run_hazard(job, log_level, log_file, exports):
     return _run_calc(job, log_level, log_file, exports, calc, 'hazard')
 
 
+def resume_hazard(job, log_level, log_file, exports):
+    """
+    Resume a hazard calculation which was interrupted (because of a crash,
+    for example) during the `executing` phase.
+
+    Nothing done in the `pre_executing` phase is repeated: the calculation
+    re-enters the `executing` phase, computes only the work which is not
+    complete yet (according to the
+    :class:`~openquake.db.models.SourceProgress` records of the job), and
+    then carries on with the following phases as usual.
+
+    The job must not be running, and its calculator must support the
+    resumption of calculations (see
+    :attr:`openquake.calculators.base.CalculatorNext.resumable`).
+
+    :param job:
+        :class:`openquake.db.model.OqJob` instance which references a valid
+        :class:`openquake.db.models.HazardCalculation`.
+    :param str log_level:
+        The desired logging level. Valid choices are 'debug', 'info',
+        'progress', 'warn', 'error', and 'critical'.
+    :param str log_file:
+        Complete path (including file name) to file where logs will be written.
+        If `None`, logging will just be printed to standard output.
+    :param list exports:
+        A (potentially empty) list of export targets. Currently only "xml" is
+        supported.
+    :raises:
+        :exc:`RuntimeError` if the job is not a hazard job, if it is running,
+        if it was not interrupted in the `executing` phase or if its
+        calculator does not support resumption.
+    """
+    from openquake.calculators.hazard import CALCULATORS_NEXT
+
+    if job.hazard_calculation is None:
+        raise RuntimeError('Job %s is not a hazard job' % job.id)
+    if job.is_running:
+        raise RuntimeError(
+            'Job %s cannot be resumed: it is still running' % job.id)
+    if job.status != 'executing':
+        raise RuntimeError(
+            'Job %s cannot be resumed: only jobs interrupted in the '
+            '"executing" phase can be resumed (the job status is "%s")'
+            % (job.id, job.status))
+
+    calc_mode = job.hazard_calculation.calculation_mode
+    calc_cls = CALCULATORS_NEXT[calc_mode]
+    if not calc_cls.resumable:
+        raise RuntimeError(
+            'Job %s cannot be resumed: %s calculations cannot be resumed'
+            % (job.id, calc_mode))
+    calc = calc_cls(job)
+
+    return _run_calc(job, log_level, log_file, exports, calc, 'hazard',
+                     resume=True)
+
+
 def run_risk(job, log_level, log_file, exports):
     """
     Run a risk calculation.
@@ -358,7 +415,8 @@ def run_risk(job, log_level, log_file, exports):
     return _run_calc(job, log_level, log_file, exports, calc, 'risk')
 
 
-def _run_calc(job, log_level, log_file, exports, calc, job_type):
+def _run_calc(job, log_level, log_file, exports, calc, job_type,
+              resume=False):
     """
     Run a calculation.
 
@@ -380,6 +438,9 @@ def _run_calc(job, log_level, log_file, exports, calc, job_type):
         :class:`openquake.calculators.base.CalculatorNext`.
     :param str job_type:
         'hazard' or 'risk'
+    :param bool resume:
+        If `True`, resume an interrupted calculation (see
+        :func:`_do_run_calc`).
     """
     # Closing all db connections to make sure they're not shared between
     # supervisor and job executor processes.
@@ -396,7 +457,7 @@ def _run_calc(job, log_level, log_file, exports, calc, job_type):
             job.is_running = True
             job.save()
             kvs.mark_job_as_current(job.id)
-            _do_run_calc(job, exports, calc, job_type)
+            _do_run_calc(job, exports, calc, job_type, resume=resume)
         except Exception, ex:
             logs.LOG.critical("Calculation failed with exception: '%s'"
                               % str(ex))
@@ -454,7 +515,7 @@ def _switch_to_job_phase(job, ctype, status):
             sys.exit(1)
 
 
-def _do_run_calc(job, exports, calc, job_type):
+def _do_run_calc(job, exports, calc, job_type, resume=False):
     """
     Step through all of the phases of a hazard calculation, updating the job
     status at each phase.
@@ -464,12 +525,21 @@ def _do_run_calc(job, exports, calc, job_type):
     :param list exports:
         a (potentially empty) list of export targets, currently only "xml" is
         supported
+    :param bool resume:
+        If `True`, the `pre_executing` phase has already been completed by a
+        previous run of the job: instead of `pre_execute`, the calculator
+        `resume` method is called and the calculation starts again from the
+        `executing` phase.
     :returns:
         The input job object when the calculation completes.
     """
     # - Run the calculation
-    _switch_to_job_phase(job, job_type, "pre_executing")
-    calc.pre_execute()
+    if resume:
+        logs.log_progress("resuming calculation (%s)" % job_type, 1)
+        calc.resume()
+    else:
+        _switch_to_job_phase(job, job_type, "pre_executing")
+        calc.pre_execute()
 
     _switch_to_job_phase(job, job_type, "executing")
     calc.execute()
@@ -105,7 +105,13 @@ def export_hazard_curves(output, target_dir):
         file).
     """
     hc = models.HazardCurve.objects.get(output=output.id)
-    hcd = models.HazardCurveData.objects.filter(hazard_curve=hc.id)
+    matrices = list(models.HazardCurveMatrix.objects.filter(
+        hazard_curve=hc.id).defer('poes'))
+    if matrices:
+        # curves stored as a single matrix: iterate over them in blocks
+        [hcd] = matrices
+    else:
+        hcd = models.HazardCurveData.objects.filter(hazard_curve=hc.id)
 
     filename = HAZARD_CURVES_FILENAME_FMT % dict(hazard_curve_id=hc.id)
     path = os.path.abspath(os.path.join(target_dir, filename))
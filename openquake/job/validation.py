@@ -217,6 +217,8 @@ class ClassicalHazardCalculationForm(BaseOQModelForm):
             'sites',
             'random_seed',
             'number_of_logic_tree_samples',
+            'logic_tree_convergence_tolerance',
+            'logic_tree_samples_per_wave',
             'rupture_mesh_spacing',
             'width_of_mfd_bin',
             'area_source_discretization',
@@ -234,6 +236,35 @@ class ClassicalHazardCalculationForm(BaseOQModelForm):
             'export_dir',
         )
 
+    def is_valid(self):
+        super_valid = super(ClassicalHazardCalculationForm, self).is_valid()
+        all_valid = super_valid
+
+        hc = self.instance
+
+        # contextual validation
+
+        # The logic trees can be sampled in waves only when they are sampled
+        # randomly:
+        if (hc.number_of_logic_tree_samples == 0
+            and hc.logic_tree_convergence_tolerance is not None):
+
+            msg = '`%s` is not available with end branch enumeration'
+            msg %= 'logic_tree_convergence_tolerance'
+            self._add_error('logic_tree_convergence_tolerance', msg)
+            all_valid = False
+
+        if (hc.logic_tree_samples_per_wave is not None
+            and hc.logic_tree_convergence_tolerance is None):
+
+            msg = '`%s` requires `%s`'
+            msg %= ('logic_tree_samples_per_wave',
+                    'logic_tree_convergence_tolerance')
+            self._add_error('logic_tree_samples_per_wave', msg)
+            all_valid = False
+
+        return all_valid
+
 
 class EventBasedHazardCalculationForm(BaseOQModelForm):
 
@@ -449,6 +480,22 @@ def number_of_logic_tree_samples_is_valid(mdl):
     return True, []
 
 
+def logic_tree_convergence_tolerance_is_valid(mdl):
+    tol = mdl.logic_tree_convergence_tolerance
+
+    if tol is not None and not tol > 0:
+        return False, ['Logic tree convergence tolerance must be > 0']
+    return True, []
+
+
+def logic_tree_samples_per_wave_is_valid(mdl):
+    spw = mdl.logic_tree_samples_per_wave
+
+    if spw is not None and not spw > 0:
+        return False, ['Number of logic tree samples per wave must be > 0']
+    return True, []
+
+
 def rupture_mesh_spacing_is_valid(mdl):
     if not mdl.rupture_mesh_spacing > 0:
         return False, ['Rupture mesh spacing must be > 0']
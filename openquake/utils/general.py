@@ -22,6 +22,9 @@ Utility functions of general interest.
 """
 
 import cPickle
+import heapq
+
+from collections import OrderedDict
 
 
 def singleton(cls):
@@ -87,3 +90,106 @@ def block_splitter(data, block_size):
             block_buffer = []
     if len(block_buffer) > 0:
         yield block_buffer
+
+
+def weighted_block_splitter(data, num_blocks):
+    """
+    Split a sequence of weighted items into ``num_blocks`` blocks of roughly
+    equal total weight, using the Longest Processing Time first heuristic:
+    items are considered from the heaviest to the lightest and each is added
+    to the block with the smallest total weight so far.
+
+    Blocks are returned from the heaviest to the lightest. Empty blocks are
+    not returned.
+
+    :param data:
+        Sequence of (item, weight) pairs.
+    :param int num_blocks:
+        Number of blocks to split the data into. Must be greater than 0.
+    :returns:
+        A list of lists of items.
+    :raises:
+        :exc:`ValueError` of the ``num_blocks`` is <= 0.
+    """
+    if num_blocks <= 0:
+        raise ValueError(
+            'Invalid number of blocks: %s. Value must be greater than 0.'
+            % num_blocks)
+
+    # heap of (total weight, block index, block items)
+    heap = [(0, i, []) for i in xrange(num_blocks)]
+    for item, weight in sorted(data, key=lambda x: x[1], reverse=True):
+        total, i, items = heapq.heappop(heap)
+        items.append(item)
+        heapq.heappush(heap, (total + weight, i, items))
+
+    return [items for _, _, items in sorted(heap, reverse=True) if items]
+
+
+class LRUCache(object):
+    """
+    A Least Recently Used cache, bounded by the total size of the values it
+    holds. The size of each value is estimated by the caller (in bytes, for
+    example) and given when the value is added to the cache.
+
+    When adding a value would exceed ``max_size``, the least recently used
+    values are evicted first. A value which is bigger than ``max_size`` on
+    its own is never cached.
+
+    :param max_size:
+        Maximum total size of the cached values.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # key -> (value, size), ordered from least to most recently used
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for ``key`` and mark it as the most recently
+        used one. If ``key`` is not in the cache, return ``default``.
+        """
+        if not key in self._data:
+            return default
+        value, size = self._data.pop(key)
+        self._data[key] = (value, size)
+        return value
+
+    def put(self, key, value, size):
+        """
+        Add ``value`` to the cache, evicting the least recently used values
+        if needed.
+
+        :param key:
+            Any hashable key.
+        :param value:
+            The value to cache.
+        :param size:
+            The estimated size of ``value``.
+        """
+        if key in self._data:
+            _, old_size = self._data.pop(key)
+            self.size -= old_size
+
+        if size > self.max_size:
+            return
+
+        while self.size + size > self.max_size:
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self.size -= evicted_size
+
+        self._data[key] = (value, size)
+        self.size += size
+
+    def clear(self):
+        """Remove all of the values from the cache."""
+        self._data.clear()
+        self.size = 0
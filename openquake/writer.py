@@ -19,7 +19,9 @@
 Base classes for the output methods of the various codecs.
 """
 
+import binascii
 import logging
+import StringIO
 from os.path import basename
 
 from django.db import transaction
@@ -27,6 +29,7 @@ from django.db import connections
 from django.db import router
 from django.contrib.gis.db import models as gis_models
 
+from openquake.db import fields
 from openquake.db import models
 
 LOGGER = logging.getLogger('serializer')
@@ -220,9 +223,88 @@ def compose_writers(writers):
         return CompositeWriter(*writers)
 
 
+#: Maximum size (in bytes) of the data sent with a single `COPY` statement
+#: by :class:`BulkInserter`.
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _copy_escape(text):
+    """
+    Escape a string for the `COPY` text format: backslashes and the
+    characters used as column and row delimiters must be escaped.
+    """
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _array_item(value):
+    """
+    Convert an item of a sequence to its PostgreSQL array literal
+    representation.
+    """
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def copy_value(value, col):
+    """
+    Convert a value to its representation in the `COPY` text format.
+
+    :param value:
+        Python value: `None`, a number, a string, a boolean, a sequence (or
+        numpy array) of such values (for array columns) or a WKT string (or
+        an object with a `wkt` attribute) for geometry columns. For `bytea`
+        columns (:class:`openquake.db.fields.PickleField` and
+        :class:`openquake.db.fields.BinaryFloatArrayField`), any value
+        accepted by the field.
+    :param col:
+        The Django field of the column.
+    :returns:
+        A `str`, already escaped.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(col, gis_models.GeometryField):
+        # PostGIS accepts Extended WKT as input for geometry columns
+        wkt = getattr(value, 'wkt', value)
+        return _copy_escape('SRID=%d;%s' % (col.srid, wkt))
+    if isinstance(col, (fields.PickleField, fields.BinaryFloatArrayField)):
+        # bytea hex format
+        data = str(col.get_prep_value(value))
+        return _copy_escape('\\x' + binascii.hexlify(data))
+    if hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return _copy_escape(
+            '{' + ','.join(_array_item(v) for v in value) + '}')
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _copy_escape(str(value))
+
+
 # pylint: disable=W0212
 class BulkInserter(object):
-    """Handle bulk object insertion"""
+    """
+    Handle bulk object insertion
+
+    Entries are loaded in the database with `COPY ... FROM STDIN`, in chunks
+    of at most :data:`COPY_CHUNK_SIZE` bytes. Values must be of the types
+    supported by :func:`copy_value`.
+    """
 
     def __init__(self, dj_model):
         """
@@ -253,30 +335,40 @@ class BulkInserter(object):
             self.values.append(kwargs[k])
         self.count += 1
 
+    def _copy(self, cursor, data):
+        """Load the `COPY` text format data in the table."""
+        sql = 'COPY "%s" (%s) FROM STDIN' % (
+            self.table._meta.db_table, ", ".join(self.fields))
+        data.seek(0)
+        cursor.copy_expert(sql, data)
+
     def flush(self):
-        """Inserts the entries in the database using a bulk insert query"""
+        """Inserts the entries in the database using `COPY` statements"""
         if not self.values:
             return
 
         alias = router.db_for_write(self.table)
         cursor = connections[alias].cursor()
-        value_args = []
 
         field_map = dict()
         for f in self.table._meta.fields:
             field_map[f.column] = f
-
-        for f in self.fields:
-            col = field_map[f]
-            if isinstance(col, gis_models.GeometryField):
-                value_args.append('GeomFromText(%%s, %d)' % col.srid)
-            else:
-                value_args.append('%s')
-
-        sql = "INSERT INTO \"%s\" (%s) VALUES " % (
-            self.table._meta.db_table, ", ".join(self.fields)) + \
-            ", ".join(["(" + ", ".join(value_args) + ")"] * self.count)
-        cursor.execute(sql, self.values)
+        cols = [field_map[f] for f in self.fields]
+        num_fields = len(self.fields)
+
+        data = StringIO.StringIO()
+        for i in xrange(0, len(self.values), num_fields):
+            row = self.values[i:i + num_fields]
+            data.write('\t'.join(
+                copy_value(value, col) for value, col in zip(row, cols)))
+            data.write('\n')
+
+            if data.tell() >= COPY_CHUNK_SIZE:
+                self._copy(cursor, data)
+                data = StringIO.StringIO()
+
+        if data.tell() > 0:
+            self._copy(cursor, data)
         transaction.set_dirty(using=alias)
 
         self.fields = None
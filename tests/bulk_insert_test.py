@@ -19,11 +19,13 @@
 
 import unittest
 
+import numpy
+
 from django.db import transaction
 
 from openquake import writer
 
-from openquake.db.models import OqUser, GmfData
+from openquake.db.models import OqUser, GmfData, SiteMesh
 from openquake.writer import BulkInserter
 
 
@@ -43,6 +45,12 @@ class DummyConnection(object):
         self.sql = sql
         self.values = values
 
+    def copy_expert(self, sql, data):
+        self.sql = sql
+        if not hasattr(self, 'data'):
+            self.data = []
+        self.data.append(data.read())
+
 
 class BulkInserterTestCase(unittest.TestCase):
     """
@@ -108,18 +116,28 @@ class BulkInserterTestCase(unittest.TestCase):
         fields = inserter.fields
         inserter.flush()
 
-        self.assertEquals('INSERT INTO "admin"."oq_user" (%s) VALUES' \
-                              ' (%%s, %%s)' %
+        self.assertEquals('COPY "admin"."oq_user" (%s) FROM STDIN' %
                           (", ".join(fields)), connection.sql)
+        self.assertEquals(
+            ['\t'.join(dict(user_name='user1', full_name='An user')[f]
+                       for f in fields) + '\n'],
+            connection.data)
 
         inserter.add_entry(user_name='user1', full_name='An user')
         inserter.add_entry(user_name='user2', full_name='Another user')
         fields = inserter.fields
         inserter.flush()
 
-        self.assertEquals('INSERT INTO "admin"."oq_user" (%s) VALUES' \
-                              ' (%%s, %%s), (%%s, %%s)' %
+        self.assertEquals('COPY "admin"."oq_user" (%s) FROM STDIN' %
                           (", ".join(fields)), connection.sql)
+        rows = [dict(user_name='user1', full_name='An user'),
+                dict(user_name='user2', full_name='Another user')]
+        self.assertEquals(
+            ''.join('\t'.join(row[f] for f in fields) + '\n'
+                    for row in rows),
+            connection.data[-1])
+        self.assertEqual(0, inserter.count)
+        self.assertEqual([], inserter.values)
 
     @transaction.commit_on_success('reslt_writer')
     def test_flush_geometry(self):
@@ -131,9 +149,66 @@ class BulkInserterTestCase(unittest.TestCase):
         inserter.flush()
 
         if fields[0] == 'output_id':
-            values = '%s, GeomFromText(%s, 4326)'
+            values = '1\tSRID=4326;POINT(1 1)\n'
         else:
-            values = 'GeomFromText(%s, 4326), %s'
+            values = 'SRID=4326;POINT(1 1)\t1\n'
+
+        self.assertEquals('COPY "hzrdr"."gmf_data" (%s) FROM STDIN' %
+                          ", ".join(fields), connection.sql)
+        self.assertEquals([values], connection.data)
+
+    @transaction.commit_on_success('reslt_writer')
+    def test_flush_in_chunks(self):
+        inserter = BulkInserter(GmfData)
+        connection = writer.connections['reslt_writer']
+
+        orig_chunk_size = writer.COPY_CHUNK_SIZE
+        # each row is 1 char + tab + 20 chars + newline = 23 bytes
+        writer.COPY_CHUNK_SIZE = 40
+        try:
+            for i in xrange(5):
+                inserter.add_entry(output_id=i, location='POINT(1 1)')
+            inserter.flush()
+        finally:
+            writer.COPY_CHUNK_SIZE = orig_chunk_size
+
+        # 2 + 2 + 1 rows
+        self.assertEqual(3, len(connection.data))
+        self.assertEqual(5, sum(d.count('\n') for d in connection.data))
+
+
+class CopyValueTestCase(unittest.TestCase):
+    """
+    Tests for the conversion of values to the `COPY` text format.
+    """
+
+    def test_copy_value(self):
+        field = OqUser._meta.get_field('full_name')
+
+        self.assertEqual('\\N', writer.copy_value(None, field))
+        self.assertEqual('t', writer.copy_value(True, field))
+        self.assertEqual('7', writer.copy_value(7, field))
+        self.assertEqual('0.1', writer.copy_value(0.1, field))
+        self.assertEqual('a\\tb\\\\c', writer.copy_value('a\tb\\c', field))
+
+    def test_copy_value_arrays(self):
+        field = OqUser._meta.get_field('full_name')
+
+        self.assertEqual('{0.1,1e-20,NULL}',
+                         writer.copy_value([0.1, 1e-20, None], field))
+        self.assertEqual('{0.5,1.5}',
+                         writer.copy_value(numpy.array([0.5, 1.5]), field))
+        self.assertEqual('{"a b","c\\\\"d"}',
+                         writer.copy_value(['a b', 'c"d'], field))
+
+    def test_copy_value_geometry(self):
+        field = GmfData._meta.get_field('location')
+
+        self.assertEqual('SRID=4326;POINT(1 1)',
+                         writer.copy_value('POINT(1 1)', field))
+
+    def test_copy_value_bytea(self):
+        field = SiteMesh._meta.get_field('lons')
 
-        self.assertEquals('INSERT INTO "hzrdr"."gmf_data" (%s) VALUES (%s)' %
-                          (", ".join(fields), values), connection.sql)
+        self.assertEqual('\\\\x000000000000f03f',
+                         writer.copy_value([1.0], field))
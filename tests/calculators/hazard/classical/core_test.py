@@ -15,9 +15,11 @@
 
 
 import getpass
+import mock
 import unittest
 
 import kombu
+import nhlib.calc
 import numpy
 
 from nose.plugins.attrib import attr
@@ -25,6 +27,7 @@ from nose.plugins.attrib import attr
 from openquake.calculators.hazard import general
 from openquake.calculators.hazard.classical import core
 from openquake.db import models
+from openquake.input import logictree
 from openquake.utils import stats
 from tests.utils import helpers
 
@@ -55,10 +58,12 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
             '%s.%s' % (base_path, 'initialize_site_model'))
         init_rlz_patch = helpers.patch(
             '%s.%s' % (base_path, 'initialize_realizations'))
+        init_weights_patch = helpers.patch(
+            '%s.%s' % (base_path, 'initialize_source_weights'))
         record_stats_patch = helpers.patch(
             '%s.%s' % (base_path, 'record_init_stats'))
         patches = (init_src_patch, init_sm_patch, init_rlz_patch,
-                   record_stats_patch)
+                   init_weights_patch, record_stats_patch)
 
         mocks = [p.start() for p in patches]
 
@@ -190,6 +195,58 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
             # realization.
             self._check_logic_tree_realization_source_progress(ltr)
 
+    def test_initialize_realizations_in_waves(self):
+        # With adaptive sampling, the realizations are sampled in waves, and
+        # they are the same as the ones sampled up front.
+        self.calc.initialize_sources()
+        hc = self.job.hazard_calculation
+        hc.logic_tree_convergence_tolerance = 0.01
+        hc.logic_tree_samples_per_wave = 1
+
+        self.calc.initialize_realizations(
+            rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+        [ltr1] = models.LtRealization.objects.filter(
+            hazard_calculation=hc.id)
+        self.assertEqual(0, ltr1.ordinal)
+        self.assertEqual(23, ltr1.seed)
+
+        self.calc.sample_realizations(
+            1, rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+        _, ltr2 = models.LtRealization.objects.filter(
+            hazard_calculation=hc.id).order_by("id")
+        self.assertEqual(1, ltr2.ordinal)
+        self.assertEqual(1685488378, ltr2.seed)
+        self._check_logic_tree_realization_source_progress(ltr2)
+
+    def test_initialize_source_weights_in_waves(self):
+        # The sources of the realizations sampled in a later wave get the
+        # same weights as the ones of the first wave, without estimating
+        # them again.
+        self.calc.initialize_sources()
+        hc = self.job.hazard_calculation
+        hc.logic_tree_convergence_tolerance = 0.01
+        hc.logic_tree_samples_per_wave = 1
+
+        self.calc.initialize_realizations(
+            rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+        self.calc.initialize_source_weights()
+        self.calc.sample_realizations(
+            1, rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+
+        with mock.patch('openquake.input.source.nrml_to_nhlib') as to_nhlib:
+            self.calc.initialize_source_weights()
+        self.assertEqual(0, to_nhlib.call_count)
+
+        ltr1, ltr2 = models.LtRealization.objects.filter(
+            hazard_calculation=hc.id).order_by("id")
+        weights1, weights2 = [
+            list(models.SourceProgress.objects.filter(lt_realization=ltr)
+                 .order_by('parsed_source').values_list('weight', flat=True))
+            for ltr in (ltr1, ltr2)]
+        self.assertEqual(weights1, weights2)
+        self.assertTrue(any(w != general.DEFAULT_SOURCE_WEIGHT
+                            for w in weights2))
+
     def test_initialize_pr_data(self):
         # The total/done counters for progress reporting are initialized
         # correctly.
@@ -230,6 +287,100 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
 
         self._check_logic_tree_realization_source_progress(ltr)
 
+    def test_initialize_realizations_prunes_far_sources(self):
+        # With a very small integration distance, most of the sources are
+        # too far from the sites to be considered at all:
+        hc = self.job.hazard_calculation
+        hc.maximum_distance = 1.0
+        hc.save()
+
+        self.calc.initialize_sources()
+        self.calc.initialize_realizations(
+            rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+
+        ltrs = models.LtRealization.objects.filter(hazard_calculation=hc.id)
+        self.assertEqual(2, len(ltrs))
+        for ltr in ltrs:
+            self.assertTrue(ltr.total_sources < 118)
+            self.assertEqual(ltr.total_sources, models.SourceProgress.objects
+                             .filter(lt_realization=ltr.id).count())
+
+        self.assertEqual(sum(118 - ltr.total_sources for ltr in ltrs),
+                         self.calc.num_pruned_sources)
+
+        self.calc.record_init_stats()
+        job_stats = models.JobStats.objects.get(oq_job=self.job.id)
+        self.assertEqual(self.calc.num_pruned_sources,
+                         job_stats.num_pruned_sources)
+
+    def test_task_arg_gen_packs_sources_by_weight(self):
+        self.calc.initialize_sources()
+        self.calc.initialize_realizations(
+            rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+        ltr1, ltr2 = models.LtRealization.objects.filter(
+            hazard_calculation=self.job.hazard_calculation.id).order_by("id")
+
+        # Make the first source of the first realization much heavier than
+        # all of the others together:
+        src_prog = models.SourceProgress.objects.filter(
+            lt_realization=ltr1).order_by('id')
+        heavy = src_prog[0]
+        heavy.weight = 1000.0
+        heavy.save()
+
+        self.calc.progress = dict(total=0, computed=0)
+        task_args = list(self.calc.task_arg_gen(10))
+
+        # 118 sources, 10 per task; both realizations have the same source
+        # model, so they are computed by the same tasks:
+        self.assertEqual(12, len(task_args))
+        for _, _, lt_rlz_ids in task_args:
+            self.assertEqual([ltr1.id, ltr2.id], lt_rlz_ids)
+        # The heavy source gets a task of its own, which is the first one:
+        self.assertEqual([heavy.parsed_source_id], task_args[0][1])
+        self.assertEqual(
+            118, sum(len(src_ids) for _, src_ids, _ in task_args))
+        self.assertEqual(236, self.calc.progress['total'])
+
+    @attr('slow')
+    def test_hazard_curves_poissonian_multi(self):
+        # Computing the curves for several GSIM logic tree paths at once
+        # gives the same results as computing them one path at a time.
+        hc = self.job.hazard_calculation
+        self.calc.initialize_sources()
+        self.calc.initialize_realizations()
+        [ltr1, _] = models.LtRealization.objects.filter(
+            hazard_calculation=hc.id).order_by('id')
+
+        ltp = logictree.LogicTreeProcessor(hc.id)
+        apply_uncertainties = ltp.parse_source_model_logictree_path(
+            ltr1.sm_lt_path)
+        gsims = ltp.parse_gmpe_logictree_path(ltr1.gsim_lt_path)
+        src_ids = models.SourceProgress.objects.filter(
+            lt_realization=ltr1).order_by('id').values_list(
+                'parsed_source_id', flat=True)[:3]
+        sources = list(general.gen_sources(
+            src_ids, apply_uncertainties, hc.rupture_mesh_spacing,
+            hc.width_of_mfd_bin, hc.area_source_discretization))
+
+        calc_kwargs = dict(
+            sources=sources, sites=general.get_site_collection(hc),
+            imts=general.im_dict_to_nhlib(
+                hc.intensity_measure_types_and_levels),
+            time_span=hc.investigation_time,
+            truncation_level=hc.truncation_level)
+
+        expected = nhlib.calc.hazard_curve.hazard_curves_poissonian(
+            gsims=gsims, **calc_kwargs)
+        curves_list = core.hazard_curves_poissonian_multi(
+            gsims_list=[gsims, gsims], **calc_kwargs)
+
+        self.assertEqual(2, len(curves_list))
+        for curves in curves_list:
+            self.assertEqual(sorted(expected), sorted(curves))
+            for imt in expected:
+                numpy.testing.assert_allclose(expected[imt], curves[imt])
+
     @attr('slow')
     def test_complete_calculation_workflow(self):
         # Test the calculation workflow, from pre_execute through clean_up
@@ -240,10 +391,12 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
         self.calc.pre_execute()
         # Test the job stats:
         job_stats = models.JobStats.objects.get(oq_job=self.job.id)
-        # num sources * num lt samples / block size (items per task):
-        self.assertEqual(236, job_stats.num_tasks)
+        # num sources / block size (items per task); the 2 lt samples have
+        # the same source model and are computed together:
+        self.assertEqual(118, job_stats.num_tasks)
         self.assertEqual(120, job_stats.num_sites)
         self.assertEqual(2, job_stats.num_realizations)
+        self.assertEqual(0, job_stats.num_pruned_sources)
 
         # Update job status to move on to the execution phase.
         self.job.is_running = True
@@ -405,7 +558,7 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
             task_signal_queue(conn.channel()).declare()
             with conn.Consumer(task_signal_queue, callbacks=[test_callback]):
                 # call the task as a normal function
-                core.hazard_curves(self.job.id, [src_id], lt_rlz.id)
+                core.hazard_curves(self.job.id, [src_id], [lt_rlz.id])
                 # wait for the completion signal
                 conn.drain_events()
 
@@ -413,9 +566,96 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
         # complete
         src_prog = models.SourceProgress.objects.get(id=src_prog.id)
         self.assertTrue(src_prog.is_complete)
+
+        # The task stores one partial result per IMT, without touching the
+        # hazard curve progress records:
+        partials = models.HazardCurvePartial.objects.filter(
+            hazard_calculation=hc.id)
+        self.assertEqual(2, len(partials))
+        for partial in partials:
+            self.assertEqual([lt_rlz.id], partial.lt_realization_ids)
+            self.assertEqual((120, 19), partial.result_matrix.shape)
+
+        lt_rlz = models.LtRealization.objects.get(id=lt_rlz.id)
+        self.assertEqual(1, lt_rlz.completed_sources)
+        self.assertFalse(lt_rlz.is_complete)
+
+        # Now combine the partial results:
+        core.reduce_hazard_curve_partials([lt_rlz])
+        self.assertEqual(0, models.HazardCurvePartial.objects.filter(
+            hazard_calculation=hc.id).count())
+        for partial in partials:
+            [hc_prog] = models.HazardCurveProgress.objects.filter(
+                lt_realization=lt_rlz.id, imt=partial.imt)
+            numpy.testing.assert_allclose(
+                partial.result_matrix, hc_prog.result_matrix)
         # We'll leave more detail testing of results to a QA test (which will
         # take much more time to execute).
 
+    def test_task_complete_callback_reduces_partials(self):
+        # Without online statistics, the partial results of the completed
+        # realizations are combined as soon as a task is complete.
+        self.calc.initialize_sources()
+        self.calc.initialize_realizations(
+            rlz_callbacks=[self.calc.initialize_hazard_curve_progress])
+        ltr1, _ = models.LtRealization.objects.filter(
+            hazard_calculation=self.job.hazard_calculation.id).order_by('id')
+        ltr1.is_complete = True
+        ltr1.save()
+
+        base_path = ('openquake.calculators.hazard.general'
+                     '.BaseHazardCalculatorNext.get_task_complete_callback')
+        with mock.patch(base_path) as base_callback:
+            callback = self.calc.get_task_complete_callback(iter([]))
+        self.assertIsNone(self.calc.online_stats)
+
+        with mock.patch('openquake.calculators.hazard.classical.core'
+                        '.reduce_hazard_curve_partials') as reduce_mock:
+            callback(dict(job_id=self.job.id, num_sources=1), mock.Mock())
+            callback(dict(job_id=self.job.id, num_sources=1), mock.Mock())
+
+        self.assertEqual(2, base_callback.return_value.call_count)
+        # each realization is reduced only once
+        self.assertEqual([mock.call([ltr1]), mock.call([])],
+                         reduce_mock.call_args_list)
+
+    def test_partials_are_shared_by_gsim_path(self):
+        # The two realizations of the calculation have the same GSIM logic
+        # tree path: a task stores their partial results only once.
+        hc = self.job.hazard_calculation
+        self.calc.pre_execute()
+        ltr1, ltr2 = models.LtRealization.objects.filter(
+            hazard_calculation=hc.id).order_by('id')
+        src_id = models.SourceProgress.objects.filter(
+            lt_realization=ltr1).latest('id').parsed_source_id
+
+        core.compute_hazard_curves(self.job.id, [src_id], [ltr1.id, ltr2.id])
+
+        partials = list(models.HazardCurvePartial.objects.filter(
+            hazard_calculation=hc.id))
+        # one per IMT
+        self.assertEqual(2, len(partials))
+        for partial in partials:
+            self.assertEqual([ltr1.id, ltr2.id], partial.lt_realization_ids)
+
+        # the results are fanned out to each realization when it is reduced
+        core.reduce_hazard_curve_partials([ltr1])
+        for partial in partials:
+            [remaining] = models.HazardCurvePartial.objects.filter(
+                id=partial.id)
+            self.assertEqual([ltr2.id], remaining.lt_realization_ids)
+
+        core.reduce_hazard_curve_partials([ltr2])
+        self.assertEqual(0, models.HazardCurvePartial.objects.filter(
+            hazard_calculation=hc.id).count())
+
+        for partial in partials:
+            for ltr in (ltr1, ltr2):
+                [hc_prog] = models.HazardCurveProgress.objects.filter(
+                    lt_realization=ltr.id, imt=partial.imt)
+                numpy.testing.assert_allclose(
+                    partial.result_matrix, hc_prog.result_matrix)
+
 
 class HelpersTestCase(unittest.TestCase):
     """
@@ -31,6 +31,8 @@ import numpy
 import random
 import unittest
 
+from scipy.stats import mstats
+
 from tests.utils import helpers
 from tests.utils.helpers import random_location_generator
 
@@ -247,6 +249,246 @@ class PostProcessingWithWeight(unittest.TestCase):
         numpy.testing.assert_array_almost_equal(expected_curves, actual_curves)
 
 
+class QuantileCurvesMultiTestCase(unittest.TestCase):
+    """
+    Tests for the computation of several quantiles at once, for blocks of
+    sites.
+    """
+
+    def setUp(self):
+        numpy.random.seed(42)
+        # curves x locations x levels
+        self.poe_matrix = numpy.random.random((7, 11, 3))
+        self.weights = numpy.random.random(7)
+        self.weights /= self.weights.sum()
+        self.quantiles = [0.1, 0.5, 0.85]
+
+    def test_unweighted(self):
+        with mock.patch(MOCK_PREFIX + '.QUANTILE_BLOCK_VALUES', 40):
+            actual = post_processing.quantile_curves_multi(
+                self.poe_matrix, self.quantiles)
+
+        for quantile, actual_curves in zip(self.quantiles, actual):
+            expected_curves = [
+                mstats.mquantiles(curves, quantile, axis=0)[0]
+                for curves in numpy.rollaxis(self.poe_matrix, 1, 0)]
+            aaae(expected_curves, actual_curves)
+
+    def test_weighted(self):
+        with mock.patch(MOCK_PREFIX + '.QUANTILE_BLOCK_VALUES', 40):
+            actual = post_processing.quantile_curves_multi(
+                self.poe_matrix, self.quantiles, self.weights)
+
+        for quantile, actual_curves in zip(self.quantiles, actual):
+            for loc in xrange(self.poe_matrix.shape[1]):
+                for level in xrange(self.poe_matrix.shape[2]):
+                    poes = self.poe_matrix[:, loc, level]
+                    idxs = numpy.argsort(poes)
+                    expected = numpy.interp(
+                        quantile, numpy.cumsum(self.weights[idxs]),
+                        poes[idxs])
+                    self.assertAlmostEqual(
+                        expected, actual_curves[loc, level])
+
+    def test_single_curve(self):
+        actual = post_processing.quantile_curves_multi(
+            self.poe_matrix[:1], self.quantiles)
+
+        for actual_curves in actual:
+            aaae(self.poe_matrix[0], actual_curves)
+
+    def test_quantile_curves_task(self):
+        chunk = object()
+        writers = [mock.Mock(), mock.Mock()]
+
+        with mock.patch(MOCK_PREFIX + '._fetch_curves') as fc:
+            with mock.patch(
+                    MOCK_PREFIX + '._write_aggregate_results') as war:
+                fc.return_value = (self.poe_matrix, self.weights, [])
+
+                post_processing.quantile_curves_task(
+                    chunk, writers, True, [0.1, 0.9])
+
+                self.assertEqual(1, fc.call_count)
+                self.assertEqual(2, war.call_count)
+                self.assertEqual(writers[1], war.call_args[0][0])
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Tests for the mergeable quantile sketches.
+    """
+
+    def setUp(self):
+        numpy.random.seed(42)
+        # 1000 values for each of 6 cells
+        self.values = 10 ** numpy.random.uniform(-8, 0, (1000, 6))
+        self.cells = numpy.tile(numpy.arange(6), 1000)
+
+    def test_quantile_relative_error(self):
+        sketch = post_processing.QuantileSketch(6, 0.01)
+        sketch.add(self.cells, self.values.flatten())
+
+        sorted_values = numpy.sort(self.values, axis=0)
+        for quantile in (0.0, 0.15, 0.5, 0.85, 1.0):
+            # the k-th smallest value
+            k = max(int(math.ceil(quantile * 1000)), 1)
+            expected = sorted_values[k - 1]
+            actual = sketch.quantile(quantile)
+            numpy.testing.assert_array_less(
+                numpy.abs(actual - expected), 0.01 * expected + 1e-15)
+
+    def test_merge_is_exact(self):
+        sketch = post_processing.QuantileSketch(6, 0.05)
+        sketch.add(self.cells, self.values.flatten())
+
+        merged = post_processing.QuantileSketch(6, 0.05)
+        for i in xrange(0, 1000, 300):
+            partial = post_processing.QuantileSketch(6, 0.05)
+            partial.add(self.cells[i * 6:(i + 300) * 6],
+                        self.values[i:i + 300].flatten())
+            merged.merge(partial)
+
+        numpy.testing.assert_array_equal(sketch.counts, merged.counts)
+
+    def test_merge_different_parameters(self):
+        sketch = post_processing.QuantileSketch(6, 0.05)
+        self.assertRaises(ValueError, sketch.merge,
+                          post_processing.QuantileSketch(6, 0.01))
+
+    def test_invalid_rel_error(self):
+        self.assertRaises(ValueError, post_processing.QuantileSketch, 6, 0)
+
+    def test_weights_and_zeros(self):
+        sketch = post_processing.QuantileSketch(1, 0.01)
+        sketch.add([0, 0, 0], [0.0, 0.1, 0.5], [0.6, 0.3, 0.1])
+
+        self.assertEqual(0.0, sketch.quantile(0.5)[0])
+        self.assertAlmostEqual(0.1, sketch.quantile(0.8)[0], delta=0.001)
+        self.assertAlmostEqual(0.5, sketch.quantile(0.95)[0], delta=0.005)
+
+    def test_quantile_curves_sketch(self):
+        # 3 batches of 4 realizations, for 5 locations and 2 levels
+        poe_matrix = numpy.random.random((12, 5, 2))
+        location_db = range(5)
+        batches = []
+        for i in xrange(0, 12, 4):
+            curve_db = [dict(poes=poe_matrix[j, loc], weight=1.0)
+                        for loc in location_db for j in xrange(i, i + 4)]
+            batches.append(curve_chunks_getter(curve_db, location_db, 4))
+
+        results, locations = post_processing.quantile_curves_sketch(
+            batches, [0.5], 0.001, use_weights=False)
+
+        self.assertEqual(location_db, list(locations))
+        sorted_poes = numpy.sort(poe_matrix, axis=0)
+        # the lower median
+        aaae(sorted_poes[5], results[0], decimal=2)
+
+
+class OnlineCurveStatisticsTestCase(unittest.TestCase):
+    """
+    Tests for the computation of the mean curves while the realizations
+    complete.
+    """
+
+    def setUp(self):
+        numpy.random.seed(42)
+        # curves x locations x levels
+        self.poe_matrix = numpy.random.random((3, 5, 2))
+        self.weights = [decimal.Decimal(x) for x in ('0.5', '0.3', '0.2')]
+
+        self.job = mock.Mock()
+        hc = self.job.hazard_calculation
+        hc.number_of_logic_tree_samples = 0
+        hc.points_to_compute.return_value = [
+            mock.Mock(longitude=float(i), latitude=0.0) for i in range(5)]
+        hc.intensity_measure_types_and_levels = {'PGA': [0.1, 0.2]}
+        hc.should_compute_mean_curves.return_value = True
+        hc.should_compute_quantile_curves.return_value = False
+
+    def test_mean(self):
+        online_stats = post_processing.OnlineCurveStatistics(
+            self.job, block_size=2)
+
+        with mock.patch('openquake.db.models.HazardCurveProgress.objects'
+                        '.filter') as hc_prog:
+            for i, weight in enumerate(self.weights):
+                hc_prog.return_value = [
+                    mock.Mock(result_matrix=self.poe_matrix[i])]
+                online_stats.fold(mock.Mock(id=i, weight=weight))
+
+        self.assertEqual(set([0, 1, 2]), online_stats.folded)
+
+        writer = SimpleCurveWriter()
+        with mock.patch('openquake.db.models.LtRealization.objects'
+                        '.filter') as lt_rlz:
+            lt_rlz.return_value.values_list.return_value = [0, 1, 2]
+            online_stats.finalize(
+                dict(mean_curves=mock.Mock(return_value=writer)))
+
+        aaae(mean_curves_weighted(self.poe_matrix, map(float, self.weights)),
+             [curve['poes'] for curve in writer.curves])
+
+    def test_finalize_with_missing_realizations(self):
+        online_stats = post_processing.OnlineCurveStatistics(self.job)
+
+        with mock.patch('openquake.db.models.HazardCurveProgress.objects'
+                        '.filter') as hc_prog:
+            hc_prog.return_value = [
+                mock.Mock(result_matrix=self.poe_matrix[0])]
+            online_stats.fold(mock.Mock(id=0, weight=self.weights[0]))
+
+        with mock.patch('openquake.db.models.LtRealization.objects'
+                        '.filter') as lt_rlz:
+            lt_rlz.return_value.values_list.return_value = [0, 1, 2]
+            self.assertRaises(
+                RuntimeError, online_stats.finalize,
+                dict(mean_curves=mock.Mock(return_value=SimpleCurveWriter())))
+
+
+class MeanCurveConvergenceTestCase(unittest.TestCase):
+    """
+    Tests for the measure of the convergence of the mean curves.
+    """
+
+    def setUp(self):
+        numpy.random.seed(42)
+        # curves x locations x levels
+        self.poe_matrix = numpy.random.random((3, 5, 2))
+
+        self.hc = mock.Mock()
+        self.hc.points_to_compute.return_value = range(5)
+
+    def _update(self, convergence, indices):
+        with mock.patch('openquake.db.models.HazardCurveProgress.objects'
+                        '.filter') as hc_prog:
+            hc_prog.side_effect = lambda lt_realization: [
+                mock.Mock(imt='PGA',
+                          result_matrix=self.poe_matrix[lt_realization])]
+            return convergence.update([mock.Mock(id=i) for i in indices])
+
+    def test_site_subset(self):
+        convergence = post_processing.MeanCurveConvergence(
+            self.hc, num_sites=3)
+        self.assertEqual([0, 2, 4], list(convergence.site_indices))
+
+        self.assertIsNone(self._update(convergence, [0, 1]))
+        aaae(self.poe_matrix[:2, [0, 2, 4]].mean(axis=0),
+             convergence.means['PGA'])
+
+    def test_change(self):
+        convergence = post_processing.MeanCurveConvergence(self.hc)
+
+        self.assertIsNone(self._update(convergence, [0, 1]))
+        change = self._update(convergence, [2])
+
+        self.assertEqual(set([0, 1, 2]), convergence.added)
+        expected = numpy.abs(self.poe_matrix.mean(axis=0)
+                             - self.poe_matrix[:2].mean(axis=0)).max()
+        self.assertAlmostEqual(expected, change)
+
+
 class PostProcessorTestCase(unittest.TestCase):
     """
     Tests that the post processing setup the right number of tasks
@@ -302,7 +544,9 @@ class PostProcessorTestCase(unittest.TestCase):
             self.chunk_size)
 
         # Assert
-        self.assertEqual(30, len(tasks))
+        # 5 chunks for each imt: 1 task for the mean, 1 task for all of the
+        # quantiles
+        self.assertEqual(20, len(tasks))
         self.assertEqual(2, self.writers['mean_curves'].call_count)
         self.assertEqual(4, self.writers['quantile_curves'].call_count)
 
@@ -365,6 +609,13 @@ class SimpleCurveWriter(object):
         self.curves = []
         self.imt = None
 
+    def create_aggregate_result(self):
+        """
+        No action taken. Needed to just implement the aggregate result
+        writer protocol
+        """
+        pass
+
     def __exit__(self, *args, **kwargs):
         """
         No action taken. Needed to just implement the aggregate result
@@ -473,6 +724,38 @@ class HazardMapsTestCase(unittest.TestCase):
         actual = post_processing.compute_hazard_maps(curves, imls, poes)
         aaae(expected, actual)
 
+    def test_compute_hazard_map_log(self):
+        curves = numpy.array([
+            [0.8, 0.5, 0.1],
+            [0.98, 0.15, 0.05],
+            [0.6, 0.5, 0.4],
+            [0.1, 0.01, 0.001],
+        ])
+        imls = [0.005, 0.007, 0.0098]
+        poe = 0.2
+
+        expected = [[0.00847798, 0.00664814, 0.0098, 0.005]]
+
+        actual = post_processing.compute_hazard_maps(
+            curves, imls, poe, log=True)
+        aaae(expected, actual)
+
+    def test_compute_hazard_map_matches_numpy_interp(self):
+        # curves with repeated PoEs and zeros
+        curves = numpy.array([
+            [1.0, 0.5, 0.5, 0.0],
+            [0.9, 0.9, 0.3, 0.3],
+            [0.0, 0.0, 0.0, 0.0],
+        ])
+        imls = [0.1, 0.2, 0.3, 0.4]
+        poes = [0.0, 0.3, 0.4, 0.5, 0.9, 1.0]
+
+        expected = [[numpy.interp(poe, curve[::-1], imls[::-1])
+                     for curve in curves] for poe in poes]
+
+        actual = post_processing.compute_hazard_maps(curves, imls, poes)
+        aaae(expected, actual)
+
 
 class HazardMapTaskFuncTestCase(unittest.TestCase):
 
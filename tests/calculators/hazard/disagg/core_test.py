@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import mock
+import numpy
+import unittest
+
+from numpy.testing import assert_array_almost_equal as aaae
+from scipy import stats
+
+from openquake.calculators.hazard.disagg import core
+
+
+class SparseSumTestCase(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.indices = [numpy.random.randint(0, 20, size=10)
+                        for _ in range(5)]
+        self.values = [numpy.random.random(10) for _ in range(5)]
+
+        self.expected = numpy.zeros(20)
+        for indices, values in zip(self.indices, self.values):
+            for i, value in zip(indices, values):
+                self.expected[i] += value
+
+    def _check(self, sparse_sum):
+        for indices, values in zip(self.indices, self.values):
+            sparse_sum.add(indices, values)
+        indices, values = sparse_sum.result()
+
+        self.assertEqual(sorted(set(numpy.concatenate(self.indices))),
+                         list(indices))
+        aaae(self.expected[indices], values)
+
+    def test_sum(self):
+        self._check(core.SparseSum())
+
+    def test_sum_with_small_buffer(self):
+        # the buffer is combined several times
+        self._check(core.SparseSum(buffer_size=15))
+
+    def test_empty(self):
+        indices, values = core.SparseSum().result()
+        self.assertEqual(0, len(indices))
+        self.assertEqual(0, len(values))
+
+
+class DisaggBinsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hc = mock.Mock()
+        self.hc.points_to_compute.return_value = mock.Mock(
+            lons=numpy.array([0.0, 10.0]), lats=numpy.array([0.0, 60.0]))
+        self.hc.mag_bin_width = 0.5
+        self.hc.distance_bin_width = 10.0
+        self.hc.coordinate_bin_width = 0.1
+        self.hc.truncation_level = 3.0
+        self.hc.num_epsilon_bins = 6
+        self.hc.maximum_distance = 100.0
+        self.hc.intensity_measure_types_and_levels = {
+            'PGA': [0.1, 0.2, 0.4], 'PGV': [10.0]}
+
+        self.bins = core.DisaggBins(self.hc)
+
+    def test_shape(self):
+        self.assertEqual(
+            [('PGA', 0.1), ('PGA', 0.2), ('PGA', 0.4), ('PGV', 10.0)],
+            self.bins.levels)
+        # the longitude range is wider at high latitudes
+        lat_bins = int(numpy.ceil(2 * 100 / core.KM_PER_DEGREE / 0.1))
+        lon_bins = int(numpy.ceil(2 * 100 / core.KM_PER_DEGREE
+                                  / numpy.cos(numpy.radians(60)) / 0.1))
+        self.assertEqual((2, 4, 20, 10, lon_bins, lat_bins, 6),
+                         self.bins.shape)
+
+    def test_poes(self):
+        # the sum of the probabilities of the epsilon bins is the
+        # probability of exceedance of the truncated normal distribution
+        mean = numpy.log([0.1, 0.3])
+        stddev = numpy.array([0.5, 0.7])
+        gsim = mock.Mock()
+        gsim.get_mean_and_stddevs.return_value = (mean, [stddev])
+
+        poes = self.bins.poes(gsim, None, None, None)
+
+        self.assertEqual((2, 4, 6), poes.shape)
+        self.assertTrue((poes >= 0).all())
+        imls = numpy.log([0.1, 0.2, 0.4, 10.0])
+        expected = stats.truncnorm.sf(
+            (imls[None, :] - mean[:, None]) / stddev[:, None], -3, 3)
+        aaae(expected, poes.sum(axis=2))
+
+    def test_rupture_indices(self):
+        rupture = mock.Mock(mag=6.3)
+        rupture.surface.get_joyner_boore_distance.return_value = (
+            numpy.array([25.0]))
+        rupture.surface.get_closest_points.return_value = mock.Mock(
+            lons=numpy.array([10.05]), lats=numpy.array([59.95]))
+
+        indices = self.bins.rupture_indices(
+            rupture, None, numpy.array([1]))
+
+        self.assertEqual((1, 4, 6), indices.shape)
+        site, level, mag, dist, lon, lat, eps = numpy.unravel_index(
+            indices.ravel(), self.bins.shape)
+        self.assertTrue((site == 1).all())
+        self.assertEqual([0] * 6 + [1] * 6 + [2] * 6 + [3] * 6, list(level))
+        self.assertTrue((mag == 12).all())
+        self.assertTrue((dist == 2).all())
+        self.assertEqual(range(6) * 4, list(eps))
+
+        # the coordinates of the closest point are within the bins
+        [lon] = set(lon)
+        [lat] = set(lat)
+        _, _, lon_edges, lat_edges = self.bins.edges(
+            1, [12, 2, lon, lat], [12, 2, lon, lat])
+        self.assertTrue(lon_edges[0] <= 10.05 < lon_edges[1])
+        self.assertTrue(lat_edges[0] <= 59.95 < lat_edges[1])
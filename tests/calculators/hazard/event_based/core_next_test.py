@@ -15,9 +15,15 @@
 
 
 import getpass
+import mock
+import numpy
+import os
+import shutil
+import tempfile
 import unittest
 
 import kombu
+import nhlib.imt
 
 from nose.plugins.attrib import attr
 
@@ -25,6 +31,7 @@ from openquake.db import models
 from openquake.calculators.hazard.event_based import core_next
 from openquake.calculators.hazard import general as haz_general
 from openquake.utils import stats
+from openquake.utils.general import LRUCache
 
 from tests.utils import helpers
 
@@ -275,10 +282,12 @@ class EventBasedHazardCalculatorTestCase(unittest.TestCase):
             ses_collection__output__output_type='complete_lt_ses',
             complete_logic_tree_ses=True)
 
-        clt_ses_ruptures = models.SESRupture.objects.filter(
-            ses=complete_lt_ses.id)
+        # the ruptures are referenced, not copied
+        clt_ses_ruptures = complete_lt_ses.get_ruptures()
 
         self.assertEqual(210, clt_ses_ruptures.count())
+        self.assertEqual(0, models.SESRupture.objects.filter(
+            ses=complete_lt_ses.id).count())
 
         # Test the computed `investigation_time`
         # 2 lt realizations * 5 ses_per_logic_tree_path * 50.0 years
@@ -291,3 +300,351 @@ class EventBasedHazardCalculatorTestCase(unittest.TestCase):
         # of all the GMFs for a calculation.
         # Because GMFs take up a lot of space, we don't store a copy of this
         # as we do with SES.
+
+
+class SESRuptureWriterTestCase(unittest.TestCase):
+
+    def _rupture(self):
+        rupture = mock.Mock(mag=5.5, rake=90.0,
+                            tectonic_region_type='Active Shallow Crust')
+        rupture.surface.get_strike.return_value = 0.0
+        rupture.surface.get_dip.return_value = 45.0
+        return rupture
+
+    def test_flush_at_threshold(self):
+        ses = mock.Mock(id=7)
+        geometry = (False, numpy.zeros(4), numpy.zeros(4), numpy.zeros(4))
+        # 4 float64 * 3 arrays, hex-encoded, plus the row overhead
+        row_size = 2 * 96 + core_next.SESRuptureWriter.ROW_OVERHEAD
+
+        with mock.patch('openquake.writer.BulkInserter') as bi:
+            with mock.patch(
+                    'openquake.calculators.hazard.event_based.core_next.'
+                    '_rupture_geometry', return_value=geometry):
+                rupture_writer = core_next.SESRuptureWriter(
+                    max_bytes=3 * row_size)
+                inserter = bi.return_value
+                for i in xrange(1, 5):
+                    rupture_writer.add(ses, self._rupture(), 1, i)
+
+                    # the buffer is flushed only once it is full
+                    self.assertEqual(i, inserter.add_entry.call_count)
+                    self.assertEqual(int(i >= 3), inserter.flush.call_count)
+
+        self.assertEqual(row_size, rupture_writer.nbytes)
+        _, kwargs = inserter.add_entry.call_args
+        self.assertEqual(7, kwargs['ses_id'])
+        self.assertEqual(4, kwargs['rupture_ordinal'])
+        self.assertFalse(kwargs['is_from_fault_source'])
+
+
+class GmfBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.columns = [numpy.random.random((5, 1)) for _ in xrange(100)]
+        self.expected = numpy.hstack(self.columns)
+
+    def test_append(self):
+        gmf_buffer = core_next.GmfBuffer(5, 1024 * 1024, capacity=2)
+        for column in self.columns:
+            gmf_buffer.append(column)
+
+        self.assertFalse(gmf_buffer.is_memmap)
+        self.assertEqual(100, gmf_buffer.size)
+        self.assertEqual(128, gmf_buffer.capacity)
+        numpy.testing.assert_array_equal(self.expected, gmf_buffer.array)
+
+    def test_append_matrix(self):
+        gmf_buffer = core_next.GmfBuffer(5, 1024 * 1024, capacity=2)
+        gmf_buffer.append(numpy.matrix(self.expected[:, :3]))
+
+        self.assertEqual(3, gmf_buffer.size)
+        numpy.testing.assert_array_equal(
+            self.expected[:, :3], gmf_buffer.array)
+
+    def test_spill_to_memmap(self):
+        # 5 sites * 16 ruptures * 8 bytes fit in memory, 32 ruptures don't
+        gmf_buffer = core_next.GmfBuffer(5, 5 * 16 * 8, capacity=2)
+        for column in self.columns[:16]:
+            gmf_buffer.append(column)
+        self.assertFalse(gmf_buffer.is_memmap)
+
+        for column in self.columns[16:]:
+            gmf_buffer.append(column)
+        self.assertTrue(gmf_buffer.is_memmap)
+        numpy.testing.assert_array_equal(self.expected, gmf_buffer.array)
+
+        gmf_buffer.close()
+        self.assertFalse(gmf_buffer.is_memmap)
+
+
+class SaveGmfsTestCase(unittest.TestCase):
+
+    def test_save_gmfs_in_blocks(self):
+        gmf_buffer = core_next.GmfBuffer(5, 1024 * 1024)
+        gmf_buffer.append(numpy.random.random((5, 4)))
+        points = [mock.Mock(wkt2d='POINT(%s 0)' % i) for i in xrange(5)]
+        flushed = []
+
+        with mock.patch('openquake.writer.BulkInserter') as inserter_cls:
+            inserter = inserter_cls.return_value
+            inserter.count = 0
+
+            def add_entry(**kwargs):
+                inserter.count += 1
+
+            def flush():
+                flushed.append(inserter.count)
+                inserter.count = 0
+
+            inserter.add_entry.side_effect = add_entry
+            inserter.flush.side_effect = flush
+
+            # 2 sites x 4 ruptures per block
+            with mock.patch.object(core_next, 'GMF_SAVE_BLOCK_SIZE', 8):
+                core_next._save_gmfs(mock.Mock(id=1),
+                                     {nhlib.imt.PGA(): gmf_buffer}, points, 1)
+
+        self.assertEqual(5, sum(flushed))
+        self.assertEqual([2, 2, 1], flushed)
+
+
+class SampleSesRupturesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+
+    def _source(self, rates):
+        ruptures = [mock.Mock(occurrence_rate=rate) for rate in rates]
+        source = mock.Mock()
+        source.iter_ruptures.return_value = iter(ruptures)
+        return source, ruptures
+
+    def test_sample(self):
+        src1, (frequent, never) = self._source([100.0, 0.0])
+        src2, (other, ) = self._source([50.0])
+
+        with mock.patch.object(core_next, 'OCCURRENCE_SAMPLE_SIZE', 4):
+            # blocks of 2 ruptures
+            ses_ruptures = core_next._sample_ses_ruptures(
+                [src1, src2], 1.0, 3)
+
+        self.assertEqual(3, len(ses_ruptures))
+        for ses in ses_ruptures:
+            ids = dict((rupture, rupture_id) for rupture_id, rupture in ses)
+            self.assertEqual({frequent: (0, 0), other: (1, 0)}, ids)
+            ruptures = [rupture for _, rupture in ses]
+            self.assertNotIn(never, ruptures)
+            # the ruptures are in the order of generation
+            num_frequent = ruptures.count(frequent)
+            self.assertTrue(num_frequent > 0)
+            self.assertTrue(ruptures.count(other) > 0)
+            self.assertEqual([frequent] * num_frequent,
+                             ruptures[:num_frequent])
+            self.assertEqual(len(ruptures) - num_frequent,
+                             ruptures.count(other))
+
+        # the ruptures are generated only once
+        self.assertEqual(1, src1.iter_ruptures.call_count)
+        self.assertEqual(1, src2.iter_ruptures.call_count)
+
+
+class SesRupturesTestCase(unittest.TestCase):
+
+    def _source(self, occurrences):
+        # new rupture objects each time the ruptures are generated
+        def iter_ruptures(tom):
+            return iter([mock.Mock(**{'sample_number_of_occurrences'
+                                      '.return_value': n})
+                         for n in occurrences])
+        return mock.Mock(**{'iter_ruptures.side_effect': iter_ruptures})
+
+    def test_rupture_ids_are_stable(self):
+        sources = [self._source([2, 0]), self._source([0, 1])]
+
+        for _ in xrange(2):
+            ses = list(core_next._ses_ruptures(sources, 1.0))
+            self.assertEqual([(0, 0), (0, 0), (1, 1)],
+                             [rupture_id for rupture_id, _ in ses])
+            # the occurrences of a rupture are the same object
+            self.assertIs(ses[0][1], ses[1][1])
+
+
+class CachedRuptureSiteFilterTestCase(unittest.TestCase):
+
+    def _rupture(self, distances):
+        rupture = mock.Mock()
+        rupture.surface.get_joyner_boore_distance.return_value = (
+            numpy.array(distances))
+        return rupture
+
+    def _sites(self):
+        sites = mock.Mock()
+        sites.filter.side_effect = (
+            lambda mask: (sites, list(mask)) if mask.any() else None)
+        return sites
+
+    def test_filter_is_cached(self):
+        near = self._rupture([100.0, 300.0])
+        far = self._rupture([300.0, 400.0])
+        sites = self._sites()
+
+        rs_filter = core_next.CachedRuptureSiteFilter(200.0)
+        for _ in xrange(3):
+            self.assertEqual([(near, (sites, [True, False]))],
+                             list(rs_filter.bind((0, 0))([(near, sites)])))
+            self.assertEqual([],
+                             list(rs_filter.bind((0, 1))([(far, sites)])))
+
+        # the distances are computed once per rupture
+        for rupture in (near, far):
+            self.assertEqual(
+                1, rupture.surface.get_joyner_boore_distance.call_count)
+        # only the masks are cached
+        self.assertEqual(4, rs_filter.cache.size)
+
+    def test_filter_is_keyed_by_rupture_id(self):
+        # the same rupture, generated again for another stochastic event set
+        rupture = self._rupture([100.0, 300.0])
+        same_rupture = self._rupture([100.0, 300.0])
+        sites = self._sites()
+
+        rs_filter = core_next.CachedRuptureSiteFilter(200.0)
+        list(rs_filter.bind((3, 7))([(rupture, sites)]))
+        self.assertEqual(
+            [(same_rupture, (sites, [True, False]))],
+            list(rs_filter.bind((3, 7))([(same_rupture, sites)])))
+
+        self.assertEqual(
+            0, same_rupture.surface.get_joyner_boore_distance.call_count)
+        self.assertEqual(1, len(rs_filter.cache))
+
+    def test_cache_is_bounded(self):
+        ruptures = [self._rupture([100.0, 300.0]) for _ in xrange(3)]
+        sites = self._sites()
+
+        # room for the masks of 2 ruptures
+        with mock.patch.object(core_next, 'RUPTURE_SITE_CACHE_SIZE', 4):
+            rs_filter = core_next.CachedRuptureSiteFilter(200.0)
+        for i, rupture in enumerate(ruptures):
+            list(rs_filter.bind((0, i))([(rupture, sites)]))
+
+        self.assertEqual(2, len(rs_filter.cache))
+        self.assertNotIn((0, 0), rs_filter.cache)
+
+
+class CachedCorrelationModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.correl_model = mock.Mock()
+        self.correl_model.get_lower_triangle_correlation_matrix\
+            .side_effect = lambda sites, imt: numpy.eye(3)
+        self.model = core_next.CachedCorrelationModel(self.correl_model, 1)
+
+        patcher = mock.patch.object(
+            core_next, '_CORRELATION_CACHE', LRUCache(1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_factor_is_cached(self):
+        sites = mock.Mock(indices=None)
+
+        for _ in xrange(3):
+            self.model.get_lower_triangle_correlation_matrix(sites, 'PGA')
+            self.model.get_lower_triangle_correlation_matrix(sites, 'PGV')
+
+        self.assertEqual(
+            2, self.correl_model.get_lower_triangle_correlation_matrix
+            .call_count)
+
+    def test_subset_of_sites(self):
+        sites = mock.Mock(indices=numpy.array([0, 2]))
+
+        for _ in xrange(3):
+            self.model.get_lower_triangle_correlation_matrix(sites, 'PGA')
+
+        self.assertEqual(
+            3, self.correl_model.get_lower_triangle_correlation_matrix
+            .call_count)
+
+    def test_can_cache(self):
+        # 8 x 3^2 bytes per factor
+        sites = mock.Mock(vs30=numpy.ones(3))
+
+        with mock.patch('openquake.utils.config.get') as config_get:
+            config_get.return_value = 'memory'
+            self.assertTrue(self.model.can_cache(sites, ['PGA'] * 14))
+            self.assertFalse(self.model.can_cache(sites, ['PGA'] * 15))
+
+            # the factors on file are computed once per node
+            config_get.return_value = 'file'
+            self.assertTrue(self.model.can_cache(sites, ['PGA'] * 15))
+
+    def test_factor_on_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sites = mock.Mock(indices=None)
+        path = os.path.join(tmp_dir, 'oq-hc-1-correlation-PGA.npy')
+
+        with mock.patch('tempfile.gettempdir', lambda: tmp_dir):
+            with mock.patch('openquake.utils.config.get') as config_get:
+                config_get.return_value = 'file'
+                factor = self.model.get_lower_triangle_correlation_matrix(
+                    sites, 'PGA')
+                self.assertTrue(os.path.exists(path))
+
+                core_next.clear_correlation_cache(1)
+                self.assertFalse(os.path.exists(path))
+
+        numpy.testing.assert_array_equal(numpy.eye(3), factor)
+
+
+class GroundMotionFieldsTestCase(unittest.TestCase):
+
+    def test_correlated_fields_are_masked(self):
+        rupture = mock.Mock()
+        sites = mock.Mock(vs30=numpy.ones(3), indices=None)
+        rupture_sites = mock.Mock(indices=numpy.array([0, 2]))
+        rs_filter = mock.Mock(return_value=iter([(rupture, rupture_sites)]))
+        correl_model = mock.Mock(**{'can_cache.return_value': True})
+
+        with mock.patch('nhlib.calc.gmf.ground_motion_fields') as gmf:
+            gmf.return_value = {'PGA': numpy.matrix([[0.1], [0.2], [0.3]])}
+            gmf_dict = core_next._ground_motion_fields(
+                rs_filter, rupture=rupture, sites=sites, imts=['PGA'],
+                realizations=1, correlation_model=correl_model)
+
+        # the fields are computed on all of the sites
+        _, kwargs = gmf.call_args
+        self.assertIs(sites, kwargs['sites'])
+        numpy.testing.assert_array_equal(
+            [[0.1], [0.0], [0.3]], gmf_dict['PGA'])
+
+    def test_correlated_fields_no_sites(self):
+        rs_filter = mock.Mock(return_value=iter([]))
+        sites = mock.Mock(vs30=numpy.ones(3), indices=None)
+        correl_model = mock.Mock(**{'can_cache.return_value': True})
+
+        with mock.patch('nhlib.calc.gmf.ground_motion_fields') as gmf:
+            gmf_dict = core_next._ground_motion_fields(
+                rs_filter, rupture=mock.Mock(), sites=sites, imts=['PGA'],
+                realizations=1, correlation_model=correl_model)
+
+        self.assertEqual(0, gmf.call_count)
+        numpy.testing.assert_array_equal(numpy.zeros((3, 1)), gmf_dict['PGA'])
+
+    def test_correlated_fields_not_cacheable(self):
+        rs_filter = mock.Mock()
+        sites = mock.Mock(vs30=numpy.ones(3), indices=None)
+        correl_model = mock.Mock(**{'can_cache.return_value': False})
+
+        with mock.patch('nhlib.calc.gmf.ground_motion_fields') as gmf:
+            core_next._ground_motion_fields(
+                rs_filter, rupture=mock.Mock(), sites=sites, imts=['PGA'],
+                realizations=1, correlation_model=correl_model)
+
+        # nhlib computes the fields on the filtered sites only
+        _, kwargs = gmf.call_args
+        self.assertIs(rs_filter, kwargs['rupture_site_filter'])
+        self.assertEqual(0, rs_filter.call_count)
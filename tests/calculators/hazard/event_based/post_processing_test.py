@@ -14,11 +14,13 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import mock
 import unittest
 
 import numpy
 
 from openquake.calculators.hazard.event_based import post_processing as pp
+from openquake.db import models
 
 from tests.calculators.hazard.event_based import _pp_test_data as test_data
 
@@ -51,3 +53,58 @@ openquake.calculators.hazard.event_based.post_processing.gmvs_to_haz_curve`.
         actual_poes = pp.gmvs_to_haz_curve(gmvs, imls, invest_time, duration)
         numpy.testing.assert_array_almost_equal(
             expected_poes, actual_poes, decimal=6)
+
+
+class ExceedanceCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # sites x ruptures
+        self.gmfs = numpy.array([test_data.SITE_1_GMVS,
+                                 test_data.SITE_2_GMVS])
+
+        self.counter = pp.ExceedanceCounter(
+            2, {'PGA': [0.01, 0.1, 0.2], 'SA(0.1)': [0.1]})
+
+    def test_add(self):
+        # one rupture at a time
+        for j in xrange(self.gmfs.shape[1]):
+            self.counter.add('PGA', self.gmfs[:, j:j + 1])
+
+        self.assertEqual((2, 3), self.counter.num_exceeding['PGA'].shape)
+        self.assertEqual([[0], [0]],
+                         self.counter.num_exceeding['SA(0.1)'].tolist())
+
+        poes = pp.exceedances_to_poes(
+            self.counter.num_exceeding['PGA'], 1.0, 1000.0)
+        expected_poes = [[0.63578, 0.39347, 0.07965],
+                         [0.63578, 0.28609, 0.02664]]
+        numpy.testing.assert_array_almost_equal(
+            expected_poes, poes, decimal=5)
+
+    def test_add_many_realizations(self):
+        self.counter.add('SA(0.1)', self.gmfs)
+        self.counter.add('SA(0.1)', self.gmfs)
+
+        expected = 2 * (self.gmfs >= 0.1).sum(axis=1)
+        self.assertEqual(expected.tolist(),
+                         self.counter.num_exceeding['SA(0.1)'][:, 0].tolist())
+
+    def test_sum_exceedances(self):
+        partials = [models.GmfExceedancePartial(
+            num_exceeding=numpy.array([[i, 2 * i]])) for i in xrange(1, 4)]
+
+        with mock.patch('openquake.db.models.GmfExceedancePartial.objects'
+                        '.filter') as filter_mock:
+            filter_mock.return_value.iterator.return_value = iter(partials)
+            num_exceeding = pp.sum_exceedances(7, 'PGA', 1, 2)
+
+        filter_mock.assert_called_once_with(lt_realization=7, imt='PGA')
+        self.assertEqual([[6, 12]], num_exceeding.tolist())
+
+    def test_sum_exceedances_no_partials(self):
+        with mock.patch('openquake.db.models.GmfExceedancePartial.objects'
+                        '.filter') as filter_mock:
+            filter_mock.return_value.iterator.return_value = iter([])
+            num_exceeding = pp.sum_exceedances(7, 'PGA', 2, 3)
+
+        self.assertEqual(numpy.zeros((2, 3)).tolist(), num_exceeding.tolist())
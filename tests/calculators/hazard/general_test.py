@@ -16,10 +16,16 @@
 
 
 import getpass
+import mock
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import kombu
 import nhlib
+import numpy
 
 from nhlib import geo as nhlib_geo
 from nose.plugins.attrib import attr
@@ -28,6 +34,7 @@ from openquake import engine2
 from openquake.calculators.hazard import general
 from openquake.calculators.hazard.classical import core as cls_core
 from openquake.db import models
+from openquake.utils import general as general_utils
 
 from tests.utils import helpers
 
@@ -365,6 +372,187 @@ class GetSiteCollectionTestCase(unittest.TestCase):
         self.assertTrue((job_mesh.lons == site_coll.mesh.lons).all())
         self.assertTrue((job_mesh.lats == site_coll.mesh.lats).all())
 
+    def test_get_site_collection_with_reference_site_data(self):
+        cfg = helpers.demo_file(
+            'simple_fault_demo_hazard/job.ini')
+        job = helpers.get_hazard_job(cfg, username=getpass.getuser())
+        hc = job.hazard_calculation
+
+        general.store_reference_site_data(hc)
+        try:
+            site_coll = general.get_site_collection(hc)
+
+            self.assertTrue((site_coll.vs30 == 760).all())
+            self.assertTrue((site_coll.vs30measured).all())
+            self.assertTrue((site_coll.z1pt0 == 5).all())
+            self.assertTrue((site_coll.z2pt5 == 100).all())
+
+            job_mesh = hc.points_to_compute()
+            self.assertTrue((job_mesh.lons == site_coll.mesh.lons).all())
+            self.assertTrue((job_mesh.lats == site_coll.mesh.lats).all())
+
+            # The site collection is built only once per process:
+            self.assertIs(site_coll, general.get_site_collection(hc))
+            # and it is shared, so it cannot be changed
+            for array in (site_coll.vs30, site_coll.vs30measured,
+                          site_coll.z1pt0, site_coll.z2pt5,
+                          site_coll.mesh.lons, site_coll.mesh.lats):
+                self.assertFalse(array.flags.writeable)
+        finally:
+            general.clear_site_collection_cache(hc.id)
+
+
+class NodeFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patch = mock.patch('tempfile.gettempdir', lambda: self.tmp_dir)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _touch(self, file_name, age):
+        path = os.path.join(self.tmp_dir, file_name)
+        open(path, 'w').close()
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_load_node_array(self):
+        compute = lambda: numpy.arange(3.0)
+        array = general.load_node_array(1, 'oq-hc-1-test.npy', compute)
+        self.assertEqual([0.0, 1.0, 2.0], array.tolist())
+
+        # the second time around, the array is loaded from the file
+        array = general.load_node_array(1, 'oq-hc-1-test.npy', None)
+        self.assertEqual([0.0, 1.0, 2.0], array.tolist())
+
+    def test_purge_node_files(self):
+        day = 24 * 60 * 60
+        self._touch('oq-hc-1-site-data-1.npy', 2 * day)
+        self._touch('oq-hc-2-site-data-2.npy', 2 * day)
+        self._touch('oq-hc-3-site-data-3.npy', 60)
+        self._touch('unrelated.npy', 2 * day)
+
+        general.purge_node_files(1, max_age=day)
+
+        # the old files of the other calculations are removed
+        self.assertEqual(
+            ['oq-hc-1-site-data-1.npy', 'oq-hc-3-site-data-3.npy',
+             'unrelated.npy'],
+            sorted(os.listdir(self.tmp_dir)))
+
+    def test_clear_site_collection_cache(self):
+        self._touch('oq-hc-1-site-data-1.npy', 0)
+        self._touch('oq-hc-12-site-data-2.npy', 0)
+
+        general.clear_site_collection_cache(1)
+
+        self.assertEqual(['oq-hc-12-site-data-2.npy'],
+                         os.listdir(self.tmp_dir))
+
+
+class GenSourcesTestCase(unittest.TestCase):
+
+    def test_gen_sources_caches_converted_sources(self):
+        cfg = helpers.demo_file('simple_fault_demo_hazard/job.ini')
+        job = helpers.get_hazard_job(cfg, username=getpass.getuser())
+        calc = cls_core.ClassicalHazardCalculator(job)
+        calc.initialize_sources()
+
+        src_ids = list(models.ParsedSource.objects.filter(
+            input__input2hcalc__hazard_calculation=job.hazard_calculation)
+            .values_list('id', flat=True))
+        applied = []
+
+        def apply_uncertainties(src):
+            applied.append(src)
+
+        params = (2.0, 0.1, 10.0)
+        general._get_source_cache().clear()
+
+        first = list(general.gen_sources(
+            src_ids, apply_uncertainties, *params))
+        cache = general._get_source_cache()
+        self.assertEqual(len(src_ids), len(cache))
+
+        # The second time around, the sources come from the cache; the
+        # uncertainties are applied to copies of the cached sources:
+        with helpers.patch('openquake.input.source.nrml_to_nhlib') as conv:
+            second = list(general.gen_sources(
+                src_ids, apply_uncertainties, *params))
+            self.assertEqual(0, conv.call_count)
+
+        self.assertEqual(len(src_ids), len(second))
+        self.assertEqual(first + second, applied)
+        for src_id, src in zip(src_ids, second):
+            cached = cache.get((src_id,) + params)
+            self.assertIsNot(src, cached)
+            self.assertIsNot(src.mfd, cached.mfd)
+
+    def test_gen_sources_with_evicted_source(self):
+        cfg = helpers.demo_file('event_based_hazard/job.ini')
+        job = helpers.get_hazard_job(cfg, username=getpass.getuser())
+        calc = cls_core.ClassicalHazardCalculator(job)
+        calc.initialize_sources()
+
+        src_ids = list(models.ParsedSource.objects.filter(
+            input__input2hcalc__hazard_calculation=job.hazard_calculation)
+            .values_list('id', flat=True))
+        self.assertTrue(len(src_ids) > 1)
+        params = (2.0, 0.1, 10.0)
+        no_uncertainties = lambda src: None
+
+        cache = general_utils.LRUCache(10 ** 9)
+        with mock.patch.object(general, '_SOURCE_CACHE', cache):
+            # only the first source is cached
+            list(general.gen_sources(src_ids[:1], no_uncertainties, *params))
+
+            # and it is evicted by the conversion of the other sources,
+            # before its turn comes
+            put = cache.put
+
+            def put_evicting(*args):
+                cache.clear()
+                put(*args)
+
+            with mock.patch.object(cache, 'put', put_evicting):
+                sources = list(general.gen_sources(
+                    src_ids[::-1], no_uncertainties, *params))
+
+        self.assertEqual(len(src_ids), len(sources))
+
+
+class EstimateNumRupturesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.src = mock.Mock()
+        self.src.mfd.get_annual_occurrence_rates.return_value = [
+            (5.0, 0.1), (5.5, 0.01)]
+        self.src.nodal_plane_distribution.data = [(0.5, None), (0.5, None)]
+        self.src.hypocenter_distribution.data = [(0.2, 5.0), (0.3, 10.0),
+                                                 (0.5, 15.0)]
+
+    def test_point(self):
+        self.assertEqual(
+            2 * 2 * 3, general.estimate_num_ruptures(self.src, 'point'))
+
+    def test_area(self):
+        self.src.polygon.discretize.return_value = range(4)
+
+        self.assertEqual(
+            2 * 2 * 3 * 4, general.estimate_num_ruptures(self.src, 'area'))
+        self.src.polygon.discretize.assert_called_once_with(
+            self.src.area_discretization)
+
+    def test_simple_fault(self):
+        with mock.patch('nhlib.geo.SimpleFaultSurface.from_fault_data') as fd:
+            fd.return_value.get_mesh.return_value.lons = numpy.zeros((3, 5))
+
+            self.assertEqual(
+                2 * 15, general.estimate_num_ruptures(self.src, 'simple'))
+
 
 class ImtsToNhlibTestCase(unittest.TestCase):
     """
@@ -13,12 +13,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import numpy
+
 from django.contrib.gis.geos.point import Point
 
 from openquake.db import models
 
 GmfNode = models._GroundMotionFieldNode
 
+
+def _gmf(imt, sa_period, sa_damping, gmf_nodes):
+    """
+    Build a :class:`openquake.db.models._GroundMotionField` from a list of
+    nodes.
+    """
+    return models._GroundMotionField(
+        imt=imt, sa_period=sa_period, sa_damping=sa_damping,
+        gmvs=numpy.array([node.iml for node in gmf_nodes]),
+        locations=[node.location for node in gmf_nodes])
+
+
 IMLS = iter([
     0.252294938306868,
     0.00894558476907964,
@@ -91,62 +105,62 @@ IMLS = iter([
 ])
 
 GMFS_GMF_SET_0 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(iml=IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(iml=IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(iml=IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
@@ -154,12 +168,12 @@ GMFS_GMF_SET_0 = [
 ]
 
 GMFS_GMF_SET_1 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
@@ -167,22 +181,22 @@ GMFS_GMF_SET_1 = [
 ]
 
 GMFS_GMF_SET_2 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
@@ -190,52 +204,52 @@ GMFS_GMF_SET_2 = [
 ]
 
 GMFS_GMF_SET_3 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
@@ -244,22 +258,22 @@ GMFS_GMF_SET_3 = [
 ]
 
 GMFS_GMF_SET_4 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
@@ -267,12 +281,12 @@ GMFS_GMF_SET_4 = [
 ]
 
 GMFS_GMF_SET_5 = [
-    models._GroundMotionField(
+    _gmf(
         imt='PGA', sa_period=None, sa_damping=None, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
         ]),
-    models._GroundMotionField(
+    _gmf(
         imt='SA', sa_period=0.1, sa_damping=5.0, gmf_nodes=[
             GmfNode(IMLS.next(), location=Point(0.0, 0.0)),
             GmfNode(IMLS.next(), location=Point(0.0, 0.5)),
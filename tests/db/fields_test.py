@@ -17,6 +17,8 @@
 import pickle
 import unittest
 
+import numpy
+
 from django import forms
 
 from openquake.db import fields
@@ -77,6 +79,37 @@ class FloatArrayFieldTestCase(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+class IntArrayFieldTestCase(unittest.TestCase):
+    """Tests for the custom :py:class:`openquake.db.models.IntArrayField`
+    type"""
+
+    def test_get_prep_value(self):
+        iaf = fields.IntArrayField()
+
+        self.assertEqual('{3, 10, 42}', iaf.get_prep_value([3, 10, 42]))
+        self.assertEqual('{}', iaf.get_prep_value([]))
+        self.assertIsNone(iaf.get_prep_value(None))
+
+
+class BinaryFloatArrayFieldTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.field = fields.BinaryFloatArrayField()
+
+    def test_round_trip(self):
+        value = numpy.array([[3.14, 10], [-0.111, 0.0]])
+
+        prep_value = self.field.get_prep_value(value)
+        # little-endian doubles, row-major
+        self.assertEqual(32, len(prep_value))
+
+        actual = self.field.to_python(prep_value)
+        numpy.testing.assert_array_equal(value.flatten(), actual)
+
+    def test_get_prep_value_none(self):
+        self.assertIsNone(self.field.get_prep_value(None))
+
+
 class CharArrayFieldTestCase(unittest.TestCase):
     """Tests for the custom :py:class:`openquake.db.models.CharArrayField`
     type"""
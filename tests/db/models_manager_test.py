@@ -23,6 +23,7 @@
 Test Django custom model managers
 """
 
+import mock
 import random
 import unittest
 from openquake.db import models
@@ -164,18 +165,43 @@ class HazardCurveDataManagerTestCase(TestCaseWithAJob):
         block_size = 1
         chunks = self.manager.individual_curves_chunks(
             self.job, location_block_size=block_size)
-        self.assertEqual(1, len(chunks))
+        # a chunk for each location
+        self.assertEqual(2, len(chunks))
 
         chunk = chunks[0].locations
         self.assertEqual(len(chunk), block_size)
         self.assertEqual(str(chunk[0]), self.a_location.wkb)
 
+        chunk = chunks[1].locations
+        self.assertEqual(str(chunk[0]), self.a_bigger_location.wkb)
+
+    def test_individual_curves_chunk_pages(self):
+        """
+        Test reading a chunk of individual curves in pages
+        """
+        with mock.patch.object(
+                models.IndividualHazardCurveChunk, 'PAGE_SIZE', 1):
+            [chunk] = self.manager.individual_curves_chunks(
+                self.job, location_block_size=2)
+
+        self.assertEqual(2, len(chunk.poes))
+
+        # a page for each location; the second one is read in background
+        pages = []
+        for page in chunk.pages():
+            pages.append(page.locations)
+        self.assertEqual(
+            [[self.a_location.wkb], [self.a_bigger_location.wkb]],
+            [[str(loc) for loc in locations] for locations in pages])
+
     def test_individual_curves_chunk(self):
         """
         Test getting a chunk of individual curves
         """
+        [first_id] = self.manager.filter(
+            location=self.a_location.wkt).values_list('id', flat=True)
         curves = self.manager.individual_curves_chunk(
-            self.job, "PGA", 0, 1)
+            self.job, "PGA", first_id, first_id)
         self.assertEqual(1, len(curves))
 
         curve = curves[0]
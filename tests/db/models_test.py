@@ -504,6 +504,22 @@ class FakeGmfSet(object):
         return iter(self.gmfs)
 
 
+class GroundMotionFieldTestCase(unittest.TestCase):
+
+    def test_iter(self):
+        locations = [GEOSGeometry('POINT(0.0 0.0)'),
+                     GEOSGeometry('POINT(0.0 0.5)')]
+        gmf = models._GroundMotionField(
+            imt='PGA', sa_period=None, sa_damping=None,
+            gmvs=numpy.array([0.1, 0.2]), locations=locations)
+
+        nodes = list(gmf)
+
+        self.assertEqual([0.1, 0.2], [node.iml for node in nodes])
+        self.assertEqual(0.5, nodes[1].location.y)
+        self.assertEqual(0.0, nodes[0].location.x)
+
+
 class GmfSetIterTestCase(unittest.TestCase):
     """
     Tests for the `__iter__` of :class:`openquake.db.models.GmfSet`.
@@ -625,3 +641,70 @@ class PrepGeometryTestCase(unittest.TestCase):
         }
 
         self.assertEqual(expected, models._prep_geometry(the_input))
+
+
+class HazardCurveMatrixTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cfg = helpers.demo_file('simple_fault_demo_hazard/job.ini')
+        cls.job = helpers.get_hazard_job(cfg)
+        hc = cls.job.hazard_calculation
+
+        cls.lons = numpy.array([10.0, 10.1, 10.2, 10.3, 10.4])
+        cls.lats = numpy.array([45.0, 45.1, 45.2, 45.3, 45.4])
+        site_mesh = models.SiteMesh.objects.create(
+            hazard_calculation=hc, num_sites=5, lons=cls.lons, lats=cls.lats)
+
+        cls.poes = []
+        for ordinal, weight in enumerate((0.4, 0.6)):
+            lt_rlz = models.LtRealization.objects.create(
+                hazard_calculation=hc, ordinal=ordinal, seed=0,
+                weight=weight, sm_lt_path='foo', gsim_lt_path='bar',
+                total_sources=0)
+            output = models.Output.objects.create(
+                oq_job=cls.job, owner=cls.job.owner, display_name='test',
+                output_type='hazard_curve')
+            haz_curve = models.HazardCurve.objects.create(
+                output=output, lt_realization=lt_rlz,
+                investigation_time=50.0, imt='PGA', imls=[0.1, 0.2, 0.3])
+            poes = numpy.arange(15, dtype=float).reshape((5, 3)) / (
+                100.0 * (ordinal + 1))
+            cls.poes.append(poes)
+            models.HazardCurveMatrix.objects.create(
+                hazard_curve=haz_curve, site_mesh=site_mesh, num_imls=3,
+                poes=poes)
+
+        cls.matrix = models.HazardCurveMatrix.objects.individual_matrices(
+            cls.job, 'PGA')[0]
+
+    def test_get_coords(self):
+        lons, lats = self.matrix.site_mesh.get_coords(1, 3)
+        numpy.testing.assert_array_equal(self.lons[1:3], lons)
+        numpy.testing.assert_array_equal(self.lats[1:3], lats)
+
+    def test_get_poes(self):
+        numpy.testing.assert_array_equal(
+            self.poes[0], self.matrix.get_poes())
+        numpy.testing.assert_array_equal(
+            self.poes[0][2:4], self.matrix.get_poes(2, 4))
+
+    def test_iter(self):
+        curves = list(self.matrix)
+        self.assertEqual(5, len(curves))
+        self.assertEqual((10.3, 45.3), curves[3].location.coords)
+        numpy.testing.assert_array_equal(self.poes[0][3], curves[3].poes)
+
+    def test_individual_curves_chunks(self):
+        chunks = models.HazardCurveMatrix.objects.individual_curves_chunks(
+            self.job, 'PGA', location_block_size=2)
+
+        self.assertEqual(3, len(chunks))
+        self.assertEqual([0.4, 0.6], map(float, chunks[0].weights))
+        self.assertEqual(2, chunks[0].curves_per_location)
+
+        # ordered by location, then by realization
+        last = chunks[2]
+        numpy.testing.assert_array_equal(
+            [self.poes[0][4], self.poes[1][4]], last.poes)
+        self.assertEqual(1, len(last.locations))
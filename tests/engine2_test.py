@@ -21,6 +21,8 @@ import subprocess
 import sys
 import unittest
 
+import mock
+
 from django.core import exceptions
 
 from openquake import engine2
@@ -357,3 +359,69 @@ class ReadJobProfileFromConfigFileTestCase(unittest.TestCase):
             instance=calculation, files=files
         )
         self.assertTrue(form.is_valid())
+
+
+class ResumeHazardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cfg = helpers.demo_file('simple_fault_demo_hazard/job.ini')
+        self.job = helpers.get_hazard_job(cfg)
+
+    def test_resume_hazard_wrong_status(self):
+        # Only jobs interrupted in the `executing` phase can be resumed.
+        for status in ('pre_executing', 'post_executing', 'complete'):
+            self.job.status = status
+            self.job.save()
+            self.assertRaises(RuntimeError, engine2.resume_hazard,
+                              self.job, 'warn', None, [])
+
+    def test_resume_hazard_running(self):
+        self.job.status = 'executing'
+        self.job.is_running = True
+        self.job.save()
+
+        with mock.patch('openquake.engine2._run_calc') as run_calc:
+            self.assertRaises(RuntimeError, engine2.resume_hazard,
+                              self.job, 'warn', None, [])
+        self.assertEqual(0, run_calc.call_count)
+
+    def test_resume_hazard_not_resumable(self):
+        cfg = helpers.demo_file('event_based_hazard/job.ini')
+        job = helpers.get_hazard_job(cfg)
+        job.status = 'executing'
+        job.save()
+
+        with mock.patch('openquake.engine2._run_calc') as run_calc:
+            self.assertRaises(RuntimeError, engine2.resume_hazard,
+                              job, 'warn', None, [])
+        self.assertEqual(0, run_calc.call_count)
+
+    def test_resume_hazard(self):
+        self.job.status = 'executing'
+        self.job.save()
+
+        with mock.patch('openquake.engine2._run_calc') as run_calc:
+            engine2.resume_hazard(self.job, 'warn', None, ['xml'])
+
+        self.assertEqual(1, run_calc.call_count)
+        args, kwargs = run_calc.call_args
+        self.assertEqual((self.job, 'warn', None, ['xml']), args[:4])
+        self.assertEqual('hazard', args[5])
+        self.assertEqual(dict(resume=True), kwargs)
+
+    def test_do_run_calc_resume(self):
+        # When resuming, the calculator `resume` method is called instead of
+        # `pre_execute` and the calculation goes on from `executing`.
+        calc = mock.Mock()
+
+        with mock.patch('openquake.engine2._switch_to_job_phase') as switch:
+            engine2._do_run_calc(self.job, [], calc, 'hazard', resume=True)
+
+        self.assertEqual(1, calc.resume.call_count)
+        self.assertEqual(0, calc.pre_execute.call_count)
+        self.assertEqual(1, calc.execute.call_count)
+        self.assertEqual(1, calc.post_execute.call_count)
+        self.assertEqual(
+            ['executing', 'post_executing', 'post_processing', 'export',
+             'clean_up', 'complete'],
+            [args[2] for args, _ in switch.call_args_list])
@@ -541,6 +541,88 @@ class ClassicalHazardCalculationFormTestCase(unittest.TestCase):
         )
         self.assertTrue(form.is_valid())
 
+    def test_adaptive_sampling_is_not_valid(self):
+        expected_errors = {
+            'logic_tree_convergence_tolerance': [
+                'Logic tree convergence tolerance must be > 0',
+                '`logic_tree_convergence_tolerance` is not available with '
+                'end branch enumeration'],
+            'logic_tree_samples_per_wave': [
+                'Number of logic tree samples per wave must be > 0'],
+        }
+
+        hc = models.HazardCalculation(
+            owner=helpers.default_user(),
+            description='',
+            region=(
+                'POLYGON((-122.0 38.113, -122.114 38.113, -122.57 38.111, '
+                '-122.0 38.113))'
+            ),
+            region_grid_spacing=0.001,
+            calculation_mode='classical',
+            random_seed=37,
+            number_of_logic_tree_samples=0,
+            logic_tree_convergence_tolerance=-0.01,
+            logic_tree_samples_per_wave=0,
+            rupture_mesh_spacing=0.001,
+            width_of_mfd_bin=0.001,
+            area_source_discretization=0.001,
+            reference_vs30_value=0.001,
+            reference_vs30_type='measured',
+            reference_depth_to_2pt5km_per_sec=0.001,
+            reference_depth_to_1pt0km_per_sec=0.001,
+            investigation_time=1.0,
+            intensity_measure_types_and_levels=VALID_IML_IMT,
+            truncation_level=0.0,
+            maximum_distance=100.0,
+        )
+
+        form = validation.ClassicalHazardCalculationForm(
+            instance=hc, files=None
+        )
+        self.assertFalse(form.is_valid())
+        equal, err = helpers.deep_eq(expected_errors, dict(form.errors))
+        self.assertTrue(equal, err)
+
+    def test_samples_per_wave_requires_tolerance(self):
+        expected_errors = {
+            'logic_tree_samples_per_wave': [
+                '`logic_tree_samples_per_wave` requires '
+                '`logic_tree_convergence_tolerance`'],
+        }
+
+        hc = models.HazardCalculation(
+            owner=helpers.default_user(),
+            description='',
+            region=(
+                'POLYGON((-122.0 38.113, -122.114 38.113, -122.57 38.111, '
+                '-122.0 38.113))'
+            ),
+            region_grid_spacing=0.001,
+            calculation_mode='classical',
+            random_seed=37,
+            number_of_logic_tree_samples=100,
+            logic_tree_samples_per_wave=10,
+            rupture_mesh_spacing=0.001,
+            width_of_mfd_bin=0.001,
+            area_source_discretization=0.001,
+            reference_vs30_value=0.001,
+            reference_vs30_type='measured',
+            reference_depth_to_2pt5km_per_sec=0.001,
+            reference_depth_to_1pt0km_per_sec=0.001,
+            investigation_time=1.0,
+            intensity_measure_types_and_levels=VALID_IML_IMT,
+            truncation_level=0.0,
+            maximum_distance=100.0,
+        )
+
+        form = validation.ClassicalHazardCalculationForm(
+            instance=hc, files=None
+        )
+        self.assertFalse(form.is_valid())
+        equal, err = helpers.deep_eq(expected_errors, dict(form.errors))
+        self.assertTrue(equal, err)
+
 
 class EventBasedHazardCalculationFormTestCase(unittest.TestCase):
 
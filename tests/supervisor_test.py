@@ -174,6 +174,18 @@ class SupervisorTestCase(unittest.TestCase):
             ((self.job.id,), {}),
             self.cleanup_after_job.call_args)
 
+    def test_supervise_resumed_job(self):
+        # the job stats of a resumed job are kept, with its start time
+        start_time = datetime(2012, 1, 1)
+        JobStats.objects.create(oq_job=self.job, start_time=start_time)
+        self.is_pid_running.return_value = False
+        self.get_job_status.return_value = 'succeeded'
+
+        supervisor.supervise(1, self.job.id, timeout=0.1)
+
+        [job_stats] = JobStats.objects.filter(oq_job=self.job.id)
+        self.assertEqual(start_time, job_stats.start_time)
+
     def test_actions_after_job_process_failures(self):
         # the job process is running but has some failure counters above zero
         # shorten the delay to checking failure counters
@@ -25,6 +25,7 @@ import unittest
 
 from openquake.utils import general
 from openquake.utils.general import block_splitter
+from openquake.utils.general import weighted_block_splitter
 
 
 class SingletonTestCase(unittest.TestCase):
@@ -149,3 +150,77 @@ class BlockSplitterTestCase(unittest.TestCase):
         ]
         actual = [x for x in block_splitter(data, 3)]
         self.assertEqual(expected, actual)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Tests for :class:`openquake.utils.general.LRUCache`."""
+
+    def test_get_and_put(self):
+        cache = general.LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(3, cache.get('c', 3))
+        self.assertEqual(8, cache.size)
+        self.assertEqual(2, len(cache))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = general.LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        # `a` is now the most recently used value
+        cache.get('a')
+        cache.put('c', 3, 4)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(8, cache.size)
+
+    def test_put_existing_key(self):
+        cache = general.LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('a', 2, 6)
+
+        self.assertEqual(2, cache.get('a'))
+        self.assertEqual(6, cache.size)
+        self.assertEqual(1, len(cache))
+
+    def test_value_bigger_than_cache(self):
+        cache = general.LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 11)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(4, cache.size)
+
+    def test_clear(self):
+        cache = general.LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.clear()
+
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.size)
+
+
+class WeightedBlockSplitterTestCase(unittest.TestCase):
+    """Tests for :func:`openquake.utils.general.weighted_block_splitter`."""
+
+    def test_weighted_block_splitter(self):
+        data = [('a', 1), ('b', 7), ('c', 3), ('d', 4), ('e', 5)]
+
+        blocks = weighted_block_splitter(data, 3)
+        # b -> 1st, e -> 2nd, d -> 3rd, c -> 3rd, a -> 2nd
+        self.assertEqual([['d', 'c'], ['b'], ['e', 'a']], blocks)
+
+    def test_weighted_block_splitter_more_blocks_than_items(self):
+        data = [('a', 1), ('b', 2)]
+
+        self.assertEqual([['b'], ['a']], weighted_block_splitter(data, 5))
+
+    def test_weighted_block_splitter_invalid_num_blocks(self):
+        self.assertRaises(ValueError, weighted_block_splitter, [('a', 1)], 0)